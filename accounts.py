@@ -0,0 +1,250 @@
+"""
+Double-entry insurer and clinic accounts for hbilling.
+
+The module docstring of hbilling says that settling a claim should
+"withdraw money from the relevant insurer account and deposit an
+equivalent amount to the relevant clinic accounts", but main() only kept
+one clinic balance. Accounts keeps one account per insurer and per
+clinic, in integer cents, and every movement of money is a transfer that
+debits one account and credits another by the same amount, so the books
+always balance:
+  balance of an account = its debits - its credits
+  total debits = total credits, and the balances add up to 0
+Opening balances are credited to an OPENING account so that they balance
+too.
+
+Settled claims are not posted one by one. accrue() adds a claim to the
+running net of its (insurer, clinic) pair, and settle_cycle() posts one
+transfer per pair for everything accrued since the last cycle, so a
+month of claims between three insurers and three clinics is at most
+nine journal entries per cycle. Balances (posted, and with what is
+accrued but not yet settled) are kept up to date as it goes, so reading
+one is a dict lookup. check() confirms the books balance.
+
+Example:
+  accounts = Accounts([INS1, INS2, INS3], [CLC1, CLC2, CLC3])
+  accounts.accrue(INS1, CLC1, to_cents(1001))
+  accounts.accrue(INS1, CLC1, to_cents(2002))
+  accounts.settle_cycle()              # one transfer of 300300 cents
+  accounts.balance(CLC1)               # 300300
+  accounts.balance(INS1)               # -300300
+  accounts.check()                     # [] when debits equal credits
+
+Usage:
+  python accounts.py                  # netting speed and transfer count for 1,000,000 claims
+  python accounts.py 5000000
+"""
+
+import random
+import sys
+import time
+from collections import namedtuple
+
+OPENING = "Opening balances"
+INSURER = "insurer"
+CLINIC = "clinic"
+#hbilling prices are whole dollars
+CENTS_PER_DOLLAR = 100
+#how many accrued claims are netted into each settlement cycle
+CYCLE_CLAIMS = 64
+
+Transfer = namedtuple("Transfer", ["seq", "debit", "credit", "cents", "claims", "memo"])
+
+DEBITS_NOT_CREDITS = "debits do not equal credits"
+BALANCES_NOT_ZERO = "balances do not add up to zero"
+ACCOUNT_MISMATCH = "account balance is not its debits less its credits"
+JOURNAL_MISMATCH = "journal does not add up to the balances"
+
+
+def to_cents(dollars):
+    return int(dollars) * CENTS_PER_DOLLAR
+
+
+def format_cents(cents):
+    """"$1,001.00" for 100100 cents, "-$1,001.00" for -100100."""
+    sign = "-" if cents < 0 else ""
+    whole, part = divmod(abs(int(cents)), CENTS_PER_DOLLAR)
+    return sign + "$" + format(whole, ",") + "." + str(part).zfill(2)
+
+
+class Accounts(object):
+    def __init__(self, insurers=(), clinics=()):
+        # account -> INSURER, CLINIC or OPENING
+        self.kinds = {OPENING: OPENING}
+        # account -> posted balance, debits and credits in cents
+        self.balances = {OPENING: 0}
+        self.debits = {OPENING: 0}
+        self.credits = {OPENING: 0}
+        self.journal = []
+        self.total_debits = 0
+        self.total_credits = 0
+        # (insurer, clinic) -> [claims, cents] accrued since the last cycle
+        self.pending = {}
+        # account -> the change its pending claims will make to its balance
+        self.pending_by_account = {}
+        self.pending_claims = 0
+        self.claims_settled = 0
+        self.cycles = 0
+        for insurer in insurers:
+            self.open(insurer, INSURER)
+        for clinic in clinics:
+            self.open(clinic, CLINIC)
+
+    def __contains__(self, account):
+        return account in self.kinds
+
+    def open(self, account, kind, opening_cents=0):
+        """Add an account, crediting any opening balance to the OPENING account."""
+        if account in self.kinds:
+            raise ValueError("Account already open: " + str(account))
+        self.kinds[account] = kind
+        self.balances[account] = 0
+        self.debits[account] = 0
+        self.credits[account] = 0
+        self.pending_by_account[account] = 0
+        if opening_cents:
+            self.transfer(account, OPENING, opening_cents, memo="opening balance")
+
+    def accounts(self, kind=None):
+        return [account for account in self.kinds if kind is None or self.kinds[account] == kind]
+
+    def balance(self, account, pending=False):
+        """Posted balance in cents; with pending=True, as if the accrued claims were settled now."""
+        if pending:
+            return self.balances[account] + self.pending_by_account.get(account, 0)
+        return self.balances[account]
+
+    def transfer(self, debit, credit, cents, claims=0, memo=""):
+        """Post cents from the credit account to the debit account; returns the journal entry."""
+        for account in (debit, credit):
+            if account not in self.kinds:
+                raise ValueError("No such account: " + str(account))
+        cents = int(cents)
+        entry = Transfer(len(self.journal), debit, credit, cents, claims, memo)
+        self.journal.append(entry)
+        self.debits[debit] += cents
+        self.balances[debit] += cents
+        self.credits[credit] += cents
+        self.balances[credit] -= cents
+        self.total_debits += cents
+        self.total_credits += cents
+        return entry
+
+    def accrue(self, insurer, clinic, cents):
+        """Add a settled claim that insurer owes clinic to the current cycle."""
+        if self.kinds.get(insurer) != INSURER:
+            raise ValueError("Not an insurer account: " + str(insurer))
+        if self.kinds.get(clinic) != CLINIC:
+            raise ValueError("Not a clinic account: " + str(clinic))
+        cents = int(cents)
+        net = self.pending.get((insurer, clinic))
+        if net is None:
+            self.pending[(insurer, clinic)] = [1, cents]
+        else:
+            net[0] += 1
+            net[1] += cents
+        self.pending_by_account[insurer] -= cents
+        self.pending_by_account[clinic] += cents
+        self.pending_claims += 1
+
+    def settle_cycle(self, memo="settlement"):
+        """Post one transfer per (insurer, clinic) pair for the claims accrued since the last cycle."""
+        transfers = []
+        for (insurer, clinic), (claims, cents) in self.pending.items():
+            if cents > 0:
+                transfers.append(self.transfer(clinic, insurer, cents, claims, memo))
+            elif cents < 0:
+                #refunds outweighed the claims, so the money goes back to the insurer
+                transfers.append(self.transfer(insurer, clinic, -cents, claims, memo))
+            self.pending_by_account[insurer] = 0
+            self.pending_by_account[clinic] = 0
+            self.claims_settled += claims
+        self.pending = {}
+        self.pending_claims = 0
+        self.cycles += 1
+        return transfers
+
+    def check(self, replay=False):
+        """
+        Return the ways the books do not balance ([] if they do). The totals
+        are checked in O(accounts); replay=True also adds up the whole journal.
+        """
+        problems = []
+        if self.total_debits != self.total_credits:
+            problems.append(DEBITS_NOT_CREDITS)
+        if sum(self.balances.values()) != 0:
+            problems.append(BALANCES_NOT_ZERO)
+        for account in self.kinds:
+            if self.balances[account] != self.debits[account] - self.credits[account]:
+                problems.append(ACCOUNT_MISMATCH + ": " + str(account))
+        if replay:
+            balances = dict.fromkeys(self.kinds, 0)
+            for entry in self.journal:
+                balances[entry.debit] += entry.cents
+                balances[entry.credit] -= entry.cents
+            if balances != self.balances:
+                problems.append(JOURNAL_MISMATCH)
+        return problems
+
+    def stats(self):
+        return {
+            "accounts": len(self.kinds) - 1,
+            "transfers": len(self.journal),
+            "cycles": self.cycles,
+            "claims settled": self.claims_settled,
+            "claims pending": self.pending_claims,
+            "debits": self.total_debits,
+            "credits": self.total_credits,
+        }
+
+
+def benchmark(count=1000000, cycle_claims=CYCLE_CLAIMS * 100, seed=2021):
+    """Accrue count claims over random insurer/clinic pairs, settling every cycle_claims."""
+    insurers = ["INS1", "INS2", "INS3"]
+    clinics = ["CLC1", "CLC2", "CLC3"]
+    prices = [to_cents(1001), to_cents(2002), to_cents(3033), to_cents(4404)]
+    rng = random.Random(seed)
+    claims = [(rng.choice(insurers), rng.choice(clinics), rng.choice(prices)) for i in range(count)]
+
+    accounts = Accounts(insurers, clinics)
+    start = time.perf_counter()
+    for insurer, clinic, cents in claims:
+        accounts.accrue(insurer, clinic, cents)
+        if accounts.pending_claims >= cycle_claims:
+            accounts.settle_cycle()
+    accounts.settle_cycle()
+    elapsed = time.perf_counter() - start
+    print("Claims: " + str(count) + " in " + str(round(elapsed, 2)) + " seconds, "
+          + str(int(count / elapsed)) + " claims/sec")
+    print("Transfers: " + str(len(accounts.journal)) + " in " + str(accounts.cycles) + " cycles, instead of "
+          + str(count) + " without netting")
+
+    reads = 1000000
+    start = time.perf_counter()
+    for i in range(reads // 2):
+        accounts.balance("CLC1")
+        accounts.balance("INS1", pending=True)
+    elapsed = time.perf_counter() - start
+    print("Balance reads: " + str(int(reads / elapsed)) + " reads/sec")
+
+    expected = sum(cents for insurer, clinic, cents in claims)
+    clinics_total = sum(accounts.balance(clinic) for clinic in clinics)
+    problems = accounts.check(replay=True)
+    print("Clinic balances: " + format_cents(clinics_total) + ", expected " + format_cents(expected))
+    print("Debits equal credits: " + str(not problems))
+    for problem in problems:
+        print("Problem: " + problem)
+    return not problems and clinics_total == expected
+
+
+def main():
+    args = sys.argv[1:]
+    count = 1000000
+    if args:
+        count = int(args[0])
+    if not benchmark(count):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Headless batch ingestion for hbilling.
+
+Claims arrive in bulk as admit sheets, so instead of pushing each one
+through main() one input() prompt at a time, this module streams them
+from a CSV or JSONL file through the same stage logic:
+patient -> reception -> clinic -> insurer -> auditor -> payment.
+The answers that the prompts would collect are read from data fields.
+
+Each line is an admit sheet in the usual shape
+    [pid, first, last, complaint, code]
+optionally followed by the answers given at the later stages
+    [..., cid, clinic_code, insurer_code, auditor_code]
+A missing answer defaults to the value of the stage before it, so a bare
+admit sheet is confirmed, coded and audited with its own pid and code.
+JSONL lines may be lists in that order or objects keyed by those names.
+A CSV header line starting with "pid" is skipped.
+
+Claims are read and settled one at a time, so memory stays bounded
+no matter how large the file is. Every admit whose pid reception
+confirmed is also checked against an IdentityIndex (see identity.py),
+which counts pids that come back under a different name and names that
+come back under a different pid.
+
+Usage:
+  python batchingest.py claims.csv
+  python batchingest.py claims.jsonl
+"""
+
+import csv
+import json
+import sys
+import time
+
+import hbilling
+from identity import IdentityIndex
+from ledger import pid_fits
+
+ADMIT_FIELDS = ["pid", "first", "last", "complaint", "code"]
+ANSWER_FIELDS = ["cid", "clinic_code", "insurer_code", "auditor_code"]
+CLAIM_FIELDS = ADMIT_FIELDS + ANSWER_FIELDS
+
+#how many claims go by between progress lines
+REPORT_EVERY = 10000
+#the reasons run_claim() rejects a claim before reception has confirmed its pid
+UNCONFIRMED = ("mismatch", "pid too long")
+
+
+def read_claims(filename):
+    """
+    Yield one claim at a time from a .csv or .jsonl file,
+    each as a list in CLAIM_FIELDS order (missing answers are None).
+    """
+    with open(filename, newline="") as claim_file:
+        if filename.endswith(".jsonl") or filename.endswith(".json"):
+            for line in claim_file:
+                line = line.strip()
+                if line:
+                    yield claim_row(json.loads(line))
+        else:
+            for row in csv.reader(claim_file):
+                if not row or row[0].strip().lower() == "pid":
+                    continue
+                yield claim_row(row)
+
+
+def claim_row(record):
+    """Normalize a list or dict record into a list in CLAIM_FIELDS order."""
+    if isinstance(record, dict):
+        record = [record.get(field) for field in CLAIM_FIELDS]
+    row = [None] * len(CLAIM_FIELDS)
+    for i in range(min(len(record), len(CLAIM_FIELDS))):
+        value = record[i]
+        if value is not None and value != "":
+            row[i] = str(value)
+    return row
+
+
+def run_claim(row):
+    """
+    Move one claim through every stage and return (sheet, payment).
+    A claim that cannot be settled returns (sheet, reason) where the
+    reason is a string: "mismatch", "pid too long", "missing code" or
+    "unknown code".
+    """
+    pid, first, last, complaint, code, cid, clinic_code, insurer_code, auditor_code = row
+
+    #patient
+    sheet = hbilling.new_admit_sheet(pid or "", first or "", last or "", complaint or "")
+
+    #reception: confirm the id against the admit sheet and record the reception code
+    if cid is None:
+        cid = sheet.pid
+    if not hbilling.identity_matches(sheet.pid, sheet.last, cid, sheet.last):
+        return sheet, "mismatch"
+    sheet.pid = cid
+    if not pid_fits(cid):
+        return sheet, "pid too long"
+    sheet.code = code or "0000"
+
+    #clinic
+    if clinic_code is None:
+        clinic_code = code
+    if not clinic_code:
+        return sheet, "missing code"
+    sheet.code = clinic_code
+
+    #insurer
+    if insurer_code is not None:
+        sheet.code = insurer_code
+
+    #auditor
+    if auditor_code is not None:
+        sheet.code = auditor_code
+
+    #payment
+    if sheet.code not in hbilling.PAYMENT_CODES:
+        return sheet, "unknown code"
+    return sheet, hbilling.service_payment(sheet.code)
+
+
+def ingest(claims, report_every=REPORT_EVERY, out=sys.stderr, identities=None):
+    """
+    Settle every claim from the claims iterable and return a summary dict
+    with the settled and rejected counts, the balance and claims per second.
+    If an IdentityIndex is given, every admit with a confirmed pid is
+    registered in it and the summary counts the identity problems it flagged.
+    """
+    current_balance = int(hbilling.INITIAL_CLINIC_BALANCE)
+    settled = 0
+    rejected = {}
+    flagged = {}
+    start = time.perf_counter()
+    count = 0
+    for row in claims:
+        count += 1
+        sheet, result = run_claim(row)
+        if identities is not None and result not in UNCONFIRMED:
+            for problem in identities.add(sheet.pid, sheet.first, sheet.last):
+                flagged[problem] = flagged.get(problem, 0) + 1
+        if isinstance(result, str):
+            rejected[result] = rejected.get(result, 0) + 1
+        else:
+            current_balance += result
+            settled += 1
+        if report_every and count % report_every == 0 and out is not None:
+            elapsed = time.perf_counter() - start
+            print(str(count) + " claims, " + str(int(count / elapsed)) + " claims/sec", file=out)
+    elapsed = time.perf_counter() - start
+    summary = {
+        "claims": count,
+        "settled": settled,
+        "rejected": rejected,
+        "identity": flagged,
+        "balance": current_balance,
+        "seconds": elapsed,
+        "claims_per_sec": count / elapsed if elapsed > 0 else 0.0,
+    }
+    return summary
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) != 1:
+        print("Usage: python batchingest.py claims.csv|claims.jsonl")
+        return
+    summary = ingest(read_claims(args[0]), identities=IdentityIndex())
+    print("Claims read: " + str(summary["claims"]))
+    print("Claims settled: " + str(summary["settled"]))
+    for reason in summary["rejected"]:
+        print("Claims rejected (" + reason + "): " + str(summary["rejected"][reason]))
+    for problem in summary["identity"]:
+        print("Claims flagged (" + problem + "): " + str(summary["identity"][problem]))
+    print("The new clinic balance is: $" + str(summary["balance"]))
+    print("Throughput: " + str(int(summary["claims_per_sec"])) + " claims/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Benchmark suite for hbilling.
+
+Runs a seeded synthetic workload (see workload.py) through
+  - each stage function on its own: patient_entry, reception_entry,
+    clinic_entry, insurer_entry, auditor_entry and process_payment,
+  - the whole pipeline: hbilling.main() with every role taking turns,
+with scripted answers instead of a keyboard. For every stage it reports
+calls per second and p50/p99 latency; for the pipeline, claims per second
+and peak traced memory, and it checks the final clinic balance.
+
+Results can be saved as a baseline. Later runs are compared with it and
+fail when throughput drops or p99 latency grows by more than TOLERANCE.
+Baselines are only comparable on the same machine.
+
+The startup check imports hbilling in a fresh interpreter and fails when
+that takes longer than STARTUP_BUDGET or pulls in a module that should
+only load on first use (the photo backend, the metrics web server).
+
+Usage:
+  python bench.py                  # run and compare with bench_baseline.json if there is one
+  python bench.py save             # run and save the results as the baseline
+  python bench.py 20000            # a bigger workload
+  python bench.py save 20000
+  python bench.py startup          # only the import-time budget check
+"""
+
+import builtins
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import hbilling
+import store
+import workload
+
+BASELINE_FILE = "bench_baseline.json"
+VISITS = 5000
+#how much slower than the baseline a run may be before it counts as a regression
+TOLERANCE = 0.25
+#seconds "import hbilling" may take in a fresh interpreter (best of STARTUP_RUNS)
+STARTUP_BUDGET = 0.15
+STARTUP_RUNS = 5
+#modules that only load when a photo is shown or metrics are served
+LAZY_MODULES = ["PIL", "simpleimage", "http.server"]
+
+
+def percentile(ordered, p):
+    """The p-th percentile of an already sorted list."""
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(name, latencies):
+    """Calls per second and p50/p99 latency in microseconds for a list of nanosecond timings."""
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        "name": name,
+        "calls": len(ordered),
+        "per_second": int(len(ordered) / (total / 1e9)) if total else 0,
+        "p50_us": round(percentile(ordered, 50) / 1000, 1),
+        "p99_us": round(percentile(ordered, 99) / 1000, 1),
+    }
+
+
+class Scripted(object):
+    """
+    Swaps input() for a script of answers, stdout for /dev/null and the
+    ledger, claim store and rollups for files in a temporary folder.
+    """
+    def __init__(self):
+        self.answers = iter(())
+
+    def feed(self, answers):
+        self.answers = iter(answers)
+
+    def __enter__(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.devnull = open(os.devnull, "w")
+        self.saved = (builtins.input, sys.stdout, hbilling.PAYMENT_LEDGER_FILE, hbilling.CLAIM_STORE_FILE,
+                      hbilling.ROLLUP_FILE)
+        hbilling.PAYMENT_LEDGER_FILE = os.path.join(self.folder.name, "bench.ledger")
+        hbilling.CLAIM_STORE_FILE = os.path.join(self.folder.name, "bench.db")
+        hbilling.ROLLUP_FILE = os.path.join(self.folder.name, "bench.rollups")
+        builtins.input = lambda prompt="": next(self.answers)
+        sys.stdout = self.devnull
+        return self
+
+    def __exit__(self, *exc):
+        (builtins.input, sys.stdout, hbilling.PAYMENT_LEDGER_FILE, hbilling.CLAIM_STORE_FILE,
+         hbilling.ROLLUP_FILE) = self.saved
+        store.close_stores()
+        self.devnull.close()
+        self.folder.cleanup()
+        return False
+
+
+def stage_benchmark(visits):
+    """Time every stage function once per visit; returns a list of latency summaries."""
+    timings = {"patient_entry": [], "reception_entry": [], "clinic_entry": [], "insurer_entry": [],
+               "auditor_entry": [], "process_payment": []}
+    clock = time.perf_counter_ns
+    with Scripted() as script:
+        for visit in visits:
+            script.feed(workload.patient_answers(visit))
+            start = clock()
+            sheet = hbilling.patient_entry()
+            timings["patient_entry"].append(clock() - start)
+
+            script.feed(workload.reception_answers(visit))
+            start = clock()
+            sheet = hbilling.reception_entry(sheet)
+            timings["reception_entry"].append(clock() - start)
+
+            script.feed(workload.clinic_answers(visit))
+            start = clock()
+            sheet = hbilling.clinic_entry(sheet)
+            timings["clinic_entry"].append(clock() - start)
+
+            script.feed(workload.insurer_answers(visit))
+            start = clock()
+            sheet = hbilling.insurer_entry(sheet)
+            timings["insurer_entry"].append(clock() - start)
+
+            script.feed(workload.auditor_answers(visit))
+            start = clock()
+            sheet = hbilling.auditor_entry(sheet)
+            timings["auditor_entry"].append(clock() - start)
+
+            start = clock()
+            hbilling.process_payment(sheet.code)
+            timings["process_payment"].append(clock() - start)
+    return [latency_summary(name, timings[name]) for name in timings]
+
+
+def pipeline_benchmark(visits, batch=10):
+    """Run hbilling.main() over every visit; returns throughput, peak memory and whether the balance is right."""
+    with Scripted() as script:
+        script.feed(workload.session_answers(visits, batch))
+        start = time.perf_counter()
+        hbilling.main()
+        elapsed = time.perf_counter() - start
+        balance = hbilling.PaymentLedger(hbilling.PAYMENT_LEDGER_FILE,
+                                         initial_balance=hbilling.INITIAL_CLINIC_BALANCE)
+        correct = balance.balance == workload.expected_balance(visits)
+        balance.close()
+
+    #a second run under tracemalloc for the memory peak, since tracing slows everything down
+    with Scripted() as script:
+        script.feed(workload.session_answers(visits, batch))
+        tracemalloc.start()
+        try:
+            hbilling.main()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {
+        "name": "pipeline",
+        "claims": len(visits),
+        "per_second": int(len(visits) / elapsed),
+        "seconds": round(elapsed, 3),
+        "peak_bytes": peak,
+        "balance_correct": correct,
+    }
+
+
+def startup_benchmark(runs=STARTUP_RUNS):
+    """Time "import hbilling" in fresh interpreters; returns the best time and any lazy modules it loaded."""
+    script = ("import sys, time\n"
+              "start = time.perf_counter()\n"
+              "import hbilling\n"
+              "elapsed = time.perf_counter() - start\n"
+              "print(elapsed)\n"
+              "print(' '.join(name for name in " + repr(LAZY_MODULES) + " if name in sys.modules))\n")
+    folder = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    loaded = []
+    for run_number in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], cwd=folder, capture_output=True,
+                                text=True, check=True).stdout.split("\n")
+        elapsed = float(output[0])
+        if best is None or elapsed < best:
+            best = elapsed
+        loaded = output[1].split()
+    return {"name": "startup", "seconds": round(best, 4), "loaded": loaded}
+
+
+def startup_problems(startup, budget=STARTUP_BUDGET):
+    found = []
+    if startup["seconds"] > budget:
+        found.append("import hbilling took " + str(startup["seconds"]) + " seconds, budget " + str(budget))
+    for name in startup["loaded"]:
+        found.append("import hbilling loaded " + name)
+    return found
+
+
+def run(count=VISITS, seed=workload.SEED):
+    visits = workload.generate(count, seed)
+    results = {"visits": count, "seed": seed, "stages": stage_benchmark(visits)}
+    results["pipeline"] = pipeline_benchmark(visits)
+    results["startup"] = startup_benchmark()
+    return results
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    """Return a description of every result that is worse than the baseline by more than tolerance."""
+    found = []
+    old_stages = {stage["name"]: stage for stage in baseline.get("stages", [])}
+    for stage in results["stages"] + [results["pipeline"]]:
+        old = old_stages.get(stage["name"])
+        if stage["name"] == "pipeline":
+            old = baseline.get("pipeline")
+        if old is None:
+            continue
+        if stage["per_second"] < old["per_second"] * (1 - tolerance):
+            found.append(stage["name"] + ": " + str(stage["per_second"]) + "/sec, baseline "
+                         + str(old["per_second"]) + "/sec")
+        if "p99_us" in stage and stage["p99_us"] > old["p99_us"] * (1 + tolerance):
+            found.append(stage["name"] + ": p99 " + str(stage["p99_us"]) + " us, baseline "
+                         + str(old["p99_us"]) + " us")
+    old = baseline.get("startup")
+    if old is not None and "startup" in results and results["startup"]["seconds"] > old["seconds"] * (1 + tolerance):
+        found.append("startup: " + str(results["startup"]["seconds"]) + " seconds, baseline "
+                     + str(old["seconds"]) + " seconds")
+    return found
+
+
+def print_results(results):
+    print("Workload: " + str(results["visits"]) + " visits, seed " + str(results["seed"]))
+    for stage in results["stages"]:
+        print(stage["name"].ljust(16) + str(stage["per_second"]).rjust(10) + " calls/sec   p50 "
+              + str(stage["p50_us"]).rjust(8) + " us   p99 " + str(stage["p99_us"]).rjust(8) + " us")
+    pipeline = results["pipeline"]
+    print("pipeline".ljust(16) + str(pipeline["per_second"]).rjust(10) + " claims/sec  "
+          + str(pipeline["seconds"]) + " seconds, peak memory " + str(pipeline["peak_bytes"] // 1024) + " KiB")
+    print("Final balance correct: " + str(pipeline["balance_correct"]))
+    if "startup" in results:
+        print_startup(results["startup"])
+
+
+def print_startup(startup):
+    loaded = ", ".join(startup["loaded"]) or "none"
+    print("startup".ljust(16) + str(int(startup["seconds"] * 1000)).rjust(10) + " ms to import hbilling, "
+          + "lazy modules loaded: " + loaded)
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "startup":
+        startup = startup_benchmark()
+        print_startup(startup)
+        found = startup_problems(startup)
+        for problem in found:
+            print("Regression: " + problem)
+        if found:
+            sys.exit(1)
+        print("Startup within " + str(STARTUP_BUDGET) + " seconds")
+        return
+    save = False
+    if args and args[0] == "save":
+        save = True
+        args = args[1:]
+    count = VISITS
+    if args:
+        count = int(args[0])
+    results = run(count)
+    print_results(results)
+    if not results["pipeline"]["balance_correct"]:
+        print("BENCHMARK FAILED: wrong final balance")
+        sys.exit(1)
+    found = startup_problems(results["startup"])
+    for problem in found:
+        print("Regression: " + problem)
+    if found:
+        sys.exit(1)
+    if save:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=1)
+        print("Baseline saved to " + BASELINE_FILE)
+        return
+    if not os.path.exists(BASELINE_FILE):
+        print("No baseline yet; run python bench.py save to keep these results")
+        return
+    with open(BASELINE_FILE) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get("visits") != count:
+        print("Baseline was run with " + str(baseline.get("visits")) + " visits; results may not compare")
+    found = regressions(results, baseline)
+    for regression in found:
+        print("Regression: " + regression)
+    if found:
+        sys.exit(1)
+    print("No regressions against " + BASELINE_FILE)
+
+
+if __name__ == '__main__':
+    main()
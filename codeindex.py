@@ -0,0 +1,176 @@
+"""
+Procedure code suggestions for hbilling.
+
+Clinicians, insurers and auditors type procedure codes by hand, and the
+only help was printing the whole MEDICAL_CODES dict. CodeIndex is an
+inverted index from words to codes, built over the code descriptions
+and over the complaints of past claims with the codes they were settled
+under. A suggestion only visits the postings of the words in the
+complaint, so it stays fast with tens of thousands of codes.
+
+Scores are tf-idf: a word that points at few codes (like "foot") counts
+for more than one that points at many (like "treatment").
+
+Example:
+  index = CodeIndex(MEDICAL_CODES)
+  index.learn("sore foot after a fall", "1111")
+  index.suggest("my foot hurts")        # [("1111", 2.1), ...]
+
+Batch mode pre-codes an ingest file for batchingest.py, filling in the
+code of every claim that has none (or 0000) with the best suggestion,
+optionally learning from a file of past claims first:
+  python codeindex.py claims.csv coded.csv
+  python codeindex.py claims.csv coded.csv history.csv
+"""
+
+import csv
+import heapq
+import math
+import re
+import sys
+
+WORD = re.compile(r"[a-z0-9]+")
+
+#words that say nothing about which service was given
+STOP_WORDS = {
+    "a", "an", "and", "are", "at", "for", "has", "have", "i", "in", "is", "it", "my", "of",
+    "on", "the", "to", "was", "with", "patient", "visit", "treatment", "treated",
+}
+
+SUGGESTIONS = 3
+
+
+def words(text):
+    """Lower-case the text and split it into index words, dropping stop words and plural s."""
+    found = []
+    for word in WORD.findall(str(text).lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        found.append(word)
+    return found
+
+
+class CodeIndex(object):
+    def __init__(self, descriptions=None):
+        # word -> {code: count}
+        self.postings = {}
+        # code -> description
+        self.descriptions = {}
+        if descriptions:
+            for code in descriptions:
+                self.add_code(code, descriptions[code])
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def add_code(self, code, description):
+        """Index a code under the words of its description."""
+        code = str(code)
+        self.descriptions[code] = description
+        self.learn(description, code)
+
+    def learn(self, text, code):
+        """Index a complaint (or any text) under the code it was settled with."""
+        code = str(code)
+        if code not in self.descriptions:
+            self.descriptions[code] = ""
+        for word in words(text):
+            codes = self.postings.get(word)
+            if codes is None:
+                codes = {}
+                self.postings[word] = codes
+            codes[code] = codes.get(code, 0) + 1
+
+    def learn_claims(self, sheets):
+        """Learn from settled claims ([pid, first, last, complaint, code] or ClaimSheet)."""
+        for sheet in sheets:
+            self.learn(sheet[3], sheet[4])
+
+    def suggest(self, text, count=SUGGESTIONS):
+        """Return up to count (code, score) pairs for the text, best first."""
+        scores = {}
+        total_codes = len(self.descriptions) + 1
+        for word in set(words(text)):
+            codes = self.postings.get(word)
+            if not codes:
+                continue
+            idf = math.log(total_codes / len(codes)) + 1.0
+            for code in codes:
+                scores[code] = scores.get(code, 0.0) + (1.0 + math.log(codes[code])) * idf
+        best = heapq.nlargest(count, scores.items(), key=lambda item: (item[1], item[0]))
+        return [(code, round(score, 3)) for code, score in best]
+
+    def best_code(self, text, default="0000"):
+        best = self.suggest(text, 1)
+        if not best:
+            return default
+        return best[0][0]
+
+    def suggestion_text(self, text, count=SUGGESTIONS):
+        """One line listing the suggested codes with their descriptions, for the entry prompts."""
+        suggestions = self.suggest(text, count)
+        if not suggestions:
+            return "No code suggestions for this complaint."
+        parts = []
+        for code, score in suggestions:
+            description = self.descriptions.get(code)
+            if description:
+                parts.append(code + " (" + description + ")")
+            else:
+                parts.append(code)
+        return "Suggested codes: " + ", ".join(parts)
+
+
+def precode_file(in_filename, out_filename, index=None):
+    """
+    Copy a CSV ingest file, filling the code column of every claim with no
+    code (or 0000) with the best suggestion for its complaint.
+    Returns (claims, coded).
+    """
+    if index is None:
+        #imported here because hbilling imports this module
+        import hbilling
+        index = CodeIndex(hbilling.MEDICAL_CODES)
+    claims = 0
+    coded = 0
+    with open(in_filename, newline="") as in_file, open(out_filename, "w", newline="") as out_file:
+        writer = csv.writer(out_file)
+        for row in csv.reader(in_file):
+            if row and row[0].strip().lower() != "pid":
+                claims += 1
+                while len(row) < 5:
+                    row.append("")
+                if row[4] in ("", "0000", "xxxx"):
+                    row[4] = index.best_code(row[3])
+                    if row[4] != "0000":
+                        coded += 1
+            writer.writerow(row)
+    return claims, coded
+
+
+def learn_file(index, filename):
+    """Learn from a CSV file of past claims in the admit sheet shape."""
+    with open(filename, newline="") as history_file:
+        for row in csv.reader(history_file):
+            if len(row) >= 5 and row[0].strip().lower() != "pid":
+                index.learn(row[3], row[4])
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) not in (2, 3):
+        print("Usage: python codeindex.py claims.csv coded.csv [history.csv]")
+        return
+    import hbilling
+    index = CodeIndex(hbilling.MEDICAL_CODES)
+    if len(args) == 3:
+        learn_file(index, args[2])
+    claims, coded = precode_file(args[0], args[1], index)
+    print("Claims read: " + str(claims))
+    print("Claims coded: " + str(coded))
+
+
+if __name__ == '__main__':
+    main()
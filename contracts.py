@@ -0,0 +1,170 @@
+"""
+Contract rate table for hbilling.
+
+An insurer can hold different contracts with different clinics, with
+different prices for the same service code. PAYMENT_CODES only has one
+price per code, so ContractRates keeps a price for every
+(insurer, clinic, code) instead.
+
+Each (insurer, clinic) pair and each code gets a dense integer id, and
+the prices live in one NumPy array indexed by [contract id, code id].
+A lookup is two dict lookups and an array read, so it stays O(1) with
+hundreds of contracts and tens of thousands of codes. Changing a rate
+writes one cell in place; new contracts and codes grow the array by
+doubling, so the table is never rebuilt for an update. Codes are keyed
+as in settlement.code_key, so the integer 0 and "0000" are one code.
+
+Example:
+  rates = ContractRates.from_payment_codes([INS1, INS2], [CLC1, CLC2])
+  rates.set_rate(INS1, CLC2, "1111", 950)
+  rates.rate(INS1, CLC2, "1111")     # 950
+  rates.rate(INS2, CLC2, "1111")     # 1001
+  rates.load([(INS3, CLC1, "2222", 1800), (INS3, CLC1, "3333", 2900)])
+"""
+
+# If the following line fails, "numpy" needs to be installed
+import numpy as np
+
+import hbilling
+from settlement import code_key
+
+#the price stored for codes an insurer has no contract rate for
+NO_RATE = -1
+#the price lookup_batch returns for claims whose insurer and clinic hold no contract at all
+NO_CONTRACT = -2
+
+
+class ContractRates(object):
+    def __init__(self, contract_capacity=8, code_capacity=64):
+        # (insurer, clinic) -> contract id
+        self._contracts = {}
+        # code -> code id
+        self._codes = {}
+        self._rates = np.full((contract_capacity, code_capacity), NO_RATE, dtype=np.int64)
+
+    @classmethod
+    def from_payment_codes(cls, insurers, clinics, payment_codes=None):
+        """Create a table where every insurer/clinic contract pays the PAYMENT_CODES prices."""
+        if payment_codes is None:
+            payment_codes = hbilling.PAYMENT_CODES
+        rates = cls()
+        rows = []
+        for insurer in insurers:
+            for clinic in clinics:
+                for code in payment_codes:
+                    rows.append((insurer, clinic, code, payment_codes[code]))
+        rates.load(rows)
+        return rates
+
+    def __len__(self):
+        """Number of (insurer, clinic, code) rates on file."""
+        used = self._rates[:len(self._contracts), :len(self._codes)]
+        return int(np.count_nonzero(used != NO_RATE))
+
+    @property
+    def contracts(self):
+        return list(self._contracts)
+
+    @property
+    def codes(self):
+        return list(self._codes)
+
+    def rate(self, insurer, clinic, code):
+        """Return the contracted price, or raise KeyError if there is none."""
+        contract_id = self._contracts.get((insurer, clinic))
+        code_id = self._codes.get(code_key(code))
+        if contract_id is None or code_id is None:
+            raise KeyError((insurer, clinic, code))
+        price = self._rates[contract_id, code_id]
+        if price == NO_RATE:
+            raise KeyError((insurer, clinic, code))
+        return int(price)
+
+    def get(self, insurer, clinic, code, default=None):
+        try:
+            return self.rate(insurer, clinic, code)
+        except KeyError:
+            return default
+
+    def set_rate(self, insurer, clinic, code, price):
+        """Add or change one rate in place."""
+        contract_id = self._contract_id(insurer, clinic)
+        code_id = self._code_id(code_key(code))
+        self._grow()
+        self._rates[contract_id, code_id] = int(price)
+
+    def remove_rate(self, insurer, clinic, code):
+        contract_id = self._contracts.get((insurer, clinic))
+        code_id = self._codes.get(code_key(code))
+        if contract_id is not None and code_id is not None:
+            self._rates[contract_id, code_id] = NO_RATE
+
+    def load(self, rows):
+        """
+        Bulk load (insurer, clinic, code, price) rows.
+        Ids are assigned first, the array grows at most once, and the
+        prices are written in one vectorized assignment.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        insurers = [row[0] for row in rows]
+        clinics = [row[1] for row in rows]
+        codes = [code_key(row[2]) for row in rows]
+        prices = [row[3] for row in rows]
+        for insurer, clinic in dict.fromkeys(zip(insurers, clinics)):
+            self._contract_id(insurer, clinic)
+        for code in dict.fromkeys(codes):
+            self._code_id(code)
+        self._grow()
+        count = len(rows)
+        contract_ids = np.fromiter(map(self._contracts.__getitem__, zip(insurers, clinics)),
+                                   dtype=np.intp, count=count)
+        code_ids = np.fromiter(map(self._codes.__getitem__, codes), dtype=np.intp, count=count)
+        self._rates[contract_ids, code_ids] = np.fromiter(map(int, prices), dtype=np.int64, count=count)
+
+    def lookup_batch(self, insurers, clinics, codes):
+        """
+        Return an int64 array with the price of every claim: NO_CONTRACT
+        where the insurer and clinic hold no contract, NO_RATE where their
+        contract has no rate for the code.
+        """
+        count = len(codes)
+        contract_ids = np.fromiter((self._contracts.get(pair, -1) for pair in zip(insurers, clinics)),
+                                   dtype=np.intp, count=count)
+        code_ids = np.fromiter((self._codes.get(code_key(code), -1) for code in codes),
+                               dtype=np.intp, count=count)
+        found = (contract_ids >= 0) & (code_ids >= 0)
+        prices = np.full(count, NO_RATE, dtype=np.int64)
+        prices[found] = self._rates[contract_ids[found], code_ids[found]]
+        prices[contract_ids < 0] = NO_CONTRACT
+        return prices
+
+    def _contract_id(self, insurer, clinic):
+        key = (insurer, clinic)
+        contract_id = self._contracts.get(key)
+        if contract_id is None:
+            contract_id = len(self._contracts)
+            self._contracts[key] = contract_id
+        return contract_id
+
+    def _code_id(self, code):
+        code_id = self._codes.get(code)
+        if code_id is None:
+            code_id = len(self._codes)
+            self._codes[code] = code_id
+        return code_id
+
+    def _grow(self):
+        #double whichever dimension ran out of room, so growth is amortized O(1) per new key
+        rows, columns = self._rates.shape
+        new_rows = rows
+        new_columns = columns
+        while new_rows < len(self._contracts):
+            new_rows *= 2
+        while new_columns < len(self._codes):
+            new_columns *= 2
+        if new_rows != rows or new_columns != columns:
+            grown = np.full((new_rows, new_columns), NO_RATE, dtype=np.int64)
+            grown[:rows, :columns] = self._rates
+            self._rates = grown
@@ -0,0 +1,276 @@
+"""
+Streaming export of hbilling claims and settled payments.
+
+Getting data out used to mean scraping what main() prints. This module
+writes
+  claims     every claim in the claim store with the stage it is at
+             (or only the claims at one stage)
+  payments   every settlement in the payment ledger: the service code,
+             the amount billed for it (PAYMENT_CODES) and the clinic
+             balance after it
+to CSV or JSONL, optionally compressed with gzip or zstd, picked from
+the file name: claims.csv, payments.jsonl.gz, payments.csv.zst ...
+
+Rows are read and written CHUNK_ROWS at a time (claims are paged by id,
+the ledger is read through a memory map), so memory stays the same for a
+month of data as for a day. Every chunk is compressed as its own gzip
+member / zstd frame, which decompress as one stream, and after each one
+the output is flushed and a checkpoint next to it records how far the
+export got. An interrupted export picks up from its checkpoint, and
+running it again later only appends what was added since. Claims are
+written at the stage they are at when read, and a claim that moves on
+after it was exported is not written again; delete the checkpoint to
+start over with a fresh snapshot.
+
+zstd needs the zstandard package; gzip and plain files need nothing.
+
+Example:
+  export_payments("payments.jsonl.gz")
+  export_claims("waiting.csv", stage="waiting")
+
+Usage:
+  python export.py claims claims.csv.gz
+  python export.py claims waiting.csv waiting    # only the claims at one stage
+  python export.py payments payments.jsonl.zst
+  python export.py bench                         # speed, memory and resume test on 200,000 payments
+  python export.py bench 2000000
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+import hbilling
+from ledger import read_records
+from store import get_store
+
+CHUNK_ROWS = 10000
+CLAIM_FIELDS = ["id", "pid", "first", "last", "complaint", "code", "stage"]
+PAYMENT_FIELDS = ["seq", "pid", "code", "amount", "balance"]
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl"}
+JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+
+def output_kind(filename):
+    """Return (format, compression) for an output file name, e.g. ("csv", "gzip") for claims.csv.gz."""
+    stem, extension = os.path.splitext(filename)
+    compression = COMPRESSIONS.get(extension)
+    if compression is not None:
+        stem, extension = os.path.splitext(stem)
+    if extension not in FORMATS:
+        raise ValueError("Cannot tell the export format of " + filename + "; use .csv or .jsonl, "
+                         "optionally followed by .gz or .zst")
+    return FORMATS[extension], compression
+
+
+def compressor(compression):
+    """A function that compresses one chunk into a self-contained gzip member or zstd frame."""
+    if compression is None:
+        return lambda data: data
+    if compression == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=6)
+    #imported here so that plain and gzip exports do not need it
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression needs the zstandard package (pip install zstandard)")
+    return zstandard.ZstdCompressor(level=3).compress
+
+
+def encode_chunk(rows, fields, file_format, header=False):
+    if file_format == "csv":
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator="\n")
+        if header:
+            writer.writerow(fields)
+        writer.writerows(rows)
+        return text.getvalue().encode()
+    encode = JSON_ENCODER.encode
+    lines = [encode(dict(zip(fields, row))) for row in rows]
+    lines.append("")
+    return "\n".join(lines).encode()
+
+
+def claim_chunks(store, stage=None, chunk_rows=CHUNK_ROWS):
+    """A reader for export(): yields (rows, position) pages of claims after the claim id position."""
+    def read(position):
+        while True:
+            rows = store.claims_after(position, chunk_rows, stage)
+            if not rows:
+                return
+            position = rows[-1][0]
+            yield rows, position
+    return read
+
+
+def payment_chunks(ledger_filename, chunk_rows=CHUNK_ROWS):
+    """A reader for export(): yields (rows, position) chunks of settlements from seq position."""
+    def read(position):
+        records = read_records(ledger_filename, position)
+        while True:
+            rows = [[payment["seq"], payment["pid"], payment["code"], payment["amount"], payment["balance"]]
+                    for payment in islice(records, chunk_rows)]
+            if not rows:
+                return
+            position = rows[-1][0] + 1
+            yield rows, position
+    return read
+
+
+def load_checkpoint(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(filename, state):
+    #write then rename, so a crash never leaves half a checkpoint
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as checkpoint_file:
+        json.dump(state, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temp_filename, filename)
+
+
+def export(read, fields, output, source, max_chunks=None):
+    """
+    Stream the chunks of a reader (see claim_chunks, payment_chunks) to output,
+    resuming from output's checkpoint if there is one. source names what is
+    exported, so a checkpoint is never resumed into a different export.
+    max_chunks stops early, as an interruption would. Returns a summary dict.
+    """
+    file_format, compression = output_kind(output)
+    compress = compressor(compression)
+    checkpoint_filename = output + ".checkpoint"
+    state = load_checkpoint(checkpoint_filename)
+    resumed = state is not None and os.path.exists(output)
+    if resumed:
+        if state["source"] != source or state["fields"] != fields:
+            raise ValueError(output + " holds a different export (" + state["source"] + "); "
+                             "delete " + checkpoint_filename + " to start over")
+        output_file = open(output, "r+b")
+        #drop anything written after the last checkpoint, such as a chunk cut off by a crash
+        output_file.truncate(state["offset"])
+        output_file.seek(state["offset"])
+    else:
+        state = {"source": source, "fields": fields, "position": 0, "rows": 0, "offset": 0}
+        output_file = open(output, "wb")
+
+    start = time.perf_counter()
+    rows_written = 0
+    chunks = 0
+    with output_file:
+        for rows, position in read(state["position"]):
+            data = compress(encode_chunk(rows, fields, file_format, header=state["offset"] == 0))
+            output_file.write(data)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            state["position"] = position
+            state["rows"] += len(rows)
+            state["offset"] += len(data)
+            save_checkpoint(checkpoint_filename, state)
+            rows_written += len(rows)
+            chunks += 1
+            if max_chunks is not None and chunks >= max_chunks:
+                break
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows_written,
+        "total_rows": state["rows"],
+        "bytes": state["offset"],
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": int(rows_written / elapsed) if elapsed else 0,
+        "resumed": resumed,
+    }
+
+
+def export_claims(output, store_filename=None, stage=None, chunk_rows=CHUNK_ROWS, max_chunks=None):
+    store = get_store(store_filename or hbilling.CLAIM_STORE_FILE)
+    source = "claims" if stage is None else "claims at " + stage
+    return export(claim_chunks(store, stage, chunk_rows), CLAIM_FIELDS, output, source, max_chunks)
+
+
+def export_payments(output, ledger_filename=None, chunk_rows=CHUNK_ROWS, max_chunks=None):
+    read = payment_chunks(ledger_filename or hbilling.PAYMENT_LEDGER_FILE, chunk_rows)
+    return export(read, PAYMENT_FIELDS, output, "payments", max_chunks)
+
+
+def benchmark(count=200000):
+    """Export a synthetic ledger in one go and in two interrupted halves; both must match."""
+    #imported here so that importing the exporter stays quick
+    import tempfile
+    import tracemalloc
+    from ledger import PaymentLedger
+
+    codes = list(hbilling.PAYMENT_CODES)
+    with tempfile.TemporaryDirectory() as folder:
+        ledger_filename = os.path.join(folder, "bench.ledger")
+        payment_register = PaymentLedger(ledger_filename, commit_every=4096)
+        for i in range(count):
+            code = codes[i % len(codes)]
+            payment_register.append(code, hbilling.PAYMENT_CODES[code], pid=str(i))
+        payment_register.close()
+
+        whole = os.path.join(folder, "whole.jsonl.gz")
+        summary = export_payments(whole, ledger_filename)
+        print("Exported: " + str(summary["rows"]) + " payments in " + str(summary["seconds"]) + " seconds, "
+              + str(summary["rows_per_sec"]) + " rows/sec, " + str(summary["bytes"] // 1024) + " KiB gzipped")
+
+        halves = os.path.join(folder, "halves.jsonl.gz")
+        chunks = max(1, count // CHUNK_ROWS // 2)
+        export_payments(halves, ledger_filename, max_chunks=chunks)
+        #a torn chunk after the checkpoint, as a crash mid-write would leave
+        with open(halves, "ab") as torn:
+            torn.write(b"\x1f\x8b\x08garbage")
+        #the resumed half runs under tracemalloc, which slows it down too much to time
+        tracemalloc.start()
+        try:
+            resumed = export_payments(halves, ledger_filename)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        with gzip.open(whole) as whole_file, gzip.open(halves) as halves_file:
+            same = whole_file.read() == halves_file.read()
+        print("Resumed after " + str(summary["total_rows"] - resumed["rows"]) + " rows, output identical: "
+              + str(same and resumed["resumed"]))
+        print("Peak traced memory exporting the other " + str(resumed["rows"]) + " rows: " + str(peak // 1024) + " KiB")
+        return same and resumed["resumed"]
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "bench":
+        count = 200000
+        if len(args) > 1:
+            count = int(args[1])
+        if not benchmark(count):
+            sys.exit(1)
+        return
+    if len(args) < 2 or args[0] not in ("claims", "payments"):
+        print("Usage: python export.py claims|payments output.csv|output.jsonl[.gz|.zst] [stage]")
+        return
+    try:
+        if args[0] == "claims":
+            stage = args[2] if len(args) > 2 else None
+            summary = export_claims(args[1], stage=stage)
+        else:
+            summary = export_payments(args[1])
+    except (ImportError, ValueError) as error:
+        print(error)
+        sys.exit(1)
+    if summary["resumed"]:
+        print("Resumed from " + args[1] + ".checkpoint")
+    print("Rows exported: " + str(summary["rows"]) + " (" + str(summary["total_rows"]) + " in " + args[1] + ")")
+    print("Throughput: " + str(summary["rows_per_sec"]) + " rows/sec")
+
+
+if __name__ == '__main__':
+    main()
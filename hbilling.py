@@ -80,7 +80,22 @@ clinic accounts.
 
 """
 
-from simpleimage import SimpleImage
+import os
+import time
+
+from photocache import PhotoCache
+from photoregistry import PhotoRegistry
+from triage import TriageQueue, triage_class, URGENT, SOON, ROUTINE
+from statusview import StatusView
+from ledger import PaymentLedger, pid_fits, PID_BYTES
+from store import get_store, close_stores
+from claims import ClaimSheet
+from codeindex import CodeIndex
+from metrics import BillingMetrics, serve_metrics, FileExporter
+from identity import IdentityIndex, PID_REUSED, NAME_REUSED
+from invoicing import InvoiceBook
+from rollups import Rollups
+from accounts import Accounts, to_cents, format_cents, INSURER, CLINIC, OPENING
 
 #These could be used in a future more complex version of this program
 INS1 = "BlueCross BlueShield"
@@ -91,32 +106,110 @@ CLC1 = "University Medical Centre"
 CLC2 = "Covenant Hospital"
 CLC3 = "Quaker Urgent Care Clinic"
 
-
+#until admit sheets carry their own accounts, every claim is billed to these
+DEFAULT_INSURER = INS1
+DEFAULT_CLINIC = CLC1
+
+
+
+#The main loop is a state machine: each state produces an event and this table gives the next state.
+#Starting over (an invalid role, EXIT, or a receptionist pressing 1) is just a transition back to "role",
+#so the stack stays flat and the patients already in the queues are kept.
+#Choosing a role with nobody in its queue is the "empty" event, which goes straight back to "role".
+RESTART = "RESTART"
+SESSION_TRANSITIONS = {
+    ("role", "chosen"): "entry",
+    ("role", "invalid"): "role",
+    ("role", "empty"): "role",
+    ("role", "exit"): "exit",
+    ("role", "status"): "status",
+    ("status", "shown"): "role",
+    ("role", "query"): "query",
+    ("query", "shown"): "role",
+    ("entry", "entered"): "apply",
+    ("entry", "restart"): "role",
+    ("apply", "applied"): "role",
+}
 
 #These are some constants used in the program.
 #I used integers for payments to avoid the float variance problem, but floats with decimals would be better
 INITIAL_CLINIC_BALANCE = int(0)
+PAYMENT_LEDGER_FILE = "payment_register.ledger"
+CLAIM_STORE_FILE = "hbilling.db"
+ROLLUP_FILE = "hbilling.rollups"
+#how many settled claims are netted into one transfer per insurer and clinic
+NETTING_CYCLE = 64
 PAYMENT_CODES = {"1111": int(1001), "2222": int(2002), "3333": int(3033), "4444": int(4404)}
 MEDICAL_CODES = {"1111": "foot treatment", "2222": "hand treatment", "3333": "head treatment", "4444": "whole body treatment"}
 
+#ID photos are found by pid or name in the photo folder (and its shard folders)
+PHOTO_FOLDER = "images"
+PHOTO_REGISTRY = PhotoRegistry(PHOTO_FOLDER)
 
-def main():
+#decoded ID photos are kept in memory up to this many bytes, shrunk to fit this size on screen
+#the photo backend (and Pillow) is only loaded when the first photo is needed; without a screen set
+#HBILLING_PHOTO_BACKEND=file to save photos into a folder, or none to skip them (see photocache.py)
+PHOTO_CACHE_BYTES = 64 * 1024 * 1024
+PHOTO_SIZE = (800, 800)
+PHOTO_BACKEND = os.environ.get("HBILLING_PHOTO_BACKEND", "simpleimage")
+PHOTO_CACHE = PhotoCache(PHOTO_CACHE_BYTES, PHOTO_SIZE, PHOTO_REGISTRY.mtime, PHOTO_BACKEND)
 
-    #here are some mutable data sets used in the program
-    waiting_room = []
-    patients_for_processing = []
-    patients_in_treatment = []
-    insured_for_auditing = []
-    invoices_for_payment = {}
-    payment_register = []
-    current_balance = int(0)
+#handler latencies, time in each stage, queue depths and settlements in the Prometheus format (see metrics.py)
+#set HBILLING_METRICS_PORT to serve them over HTTP, or HBILLING_METRICS_FILE to write them to a file
+METRICS_PORT = os.environ.get("HBILLING_METRICS_PORT")
+METRICS_FILE = os.environ.get("HBILLING_METRICS_FILE")
+ROLE_NAMES = {"1": "patient", "2": "receptionist", "3": "clinician", "4": "insurer", "5": "auditor"}
+
+#every pid with the name it was first registered under, to flag a reused pid or a name under several pids
+IDENTITIES = IdentityIndex()
 
-   #these two variabls just provide some starting data for the main loop
-   #the resolved variable could be worked into the payments function 
-   #so that the main function could resolve and end the program when all data has been processed
+#the code suggestions shown to clinicians, insurers and auditors; settled claims are added as they are audited
+CODE_SUGGESTIONS = CodeIndex(MEDICAL_CODES)
 
-    resolved = "working"
-    starting_data = ["Enter New Patient", "To Enter New Patient", "Press 1", "PatientEntryNeeded", "PatientEntryNeeded"] 
+
+def main():
+
+    #here are some mutable data sets used in the program
+    #the stage queues hand claims on by triage class, with aging so routine claims still get their turn,
+    #and keep a pid index (see triage.py and stagequeue.py)
+    waiting_room = TriageQueue("waiting room")
+    patients_for_processing = TriageQueue("sent to treatment")
+    patients_in_treatment = TriageQueue("treated")
+    insured_for_auditing = TriageQueue("insured for auditing")
+    #the queue each role takes its next claim from
+    role_queues = {"2": waiting_room, "3": patients_for_processing, "4": patients_in_treatment,
+                   "5": insured_for_auditing}
+    status = StatusView([("waiting", waiting_room), ("to treatment", patients_for_processing),
+                         ("treated", patients_in_treatment), ("for auditing", insured_for_auditing)])
+    metrics = BillingMetrics(status.stages)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = serve_metrics(metrics.registry, int(METRICS_PORT))
+    metrics_file = None
+    if METRICS_FILE:
+        metrics_file = FileExporter(metrics.registry, METRICS_FILE).start()
+    #every audited visit is its own line item, with running totals per pid, insurer and clinic (see invoicing.py)
+    invoices_for_payment = InvoiceBook()
+    #settled payments are written ahead to the ledger file so a crash does not lose them (see ledger.py)
+    payment_register = PaymentLedger(PAYMENT_LEDGER_FILE, initial_balance=INITIAL_CLINIC_BALANCE)
+    current_balance = payment_register.balance
+    #every admit sheet is also kept in the SQLite claim store as it moves through the stages (see store.py)
+    claim_store = get_store(CLAIM_STORE_FILE)
+    IDENTITIES.add_patients(claim_store.confirmed_patients())
+    reopened = reopen_claims(claim_store, status.stages)
+    if reopened:
+        print("Claims still open from the last session, back in their queues: " + str(reopened))
+    #totals by code, insurer, clinic, day and patient, kept up to date as claims are settled (see rollups.py)
+    rollups = Rollups.load(ROLLUP_FILE)
+    rollups.catch_up(payment_register, DEFAULT_INSURER, DEFAULT_CLINIC)
+    #one double-entry account per insurer and clinic in cents; claims are netted per pair each cycle (see accounts.py)
+    accounts = Accounts([INS1, INS2, INS3], [CLC1, CLC2, CLC3])
+    open_accounts(accounts, payment_register.balance)
+
+   #this variable just provides some starting data for the main loop
+   #the loop itself is a small state machine (see SESSION_TRANSITIONS) that ends when the user types exit
+
+    starting_data = ClaimSheet("Enter New Patient", "To Enter New Patient", "Press 1", "PatientEntryNeeded", "PatientEntryNeeded") 
 
 #user input loop
 #this is the main loop that produces a data_input variable as a return from
@@ -130,112 +223,228 @@ def main():
 # users are as noted in the introduction: patient, receptionist, clinician, insurer, auditor
 # the initial_role_entry initiates the program by establishing the user-role:
 
-    while resolved == "working":
-        user = initial_role_entry("NewEntry")
-        user_role = str(user)
+    state = "role"
+    while state != "exit":
+        if state == "role":
+            user = initial_role_entry("NewEntry")
+            user_role = str(user)
+            event = role_event(user)
+            #roles 2 to 5 work on the first claim in their queue, so there is nothing to do without one
+            if event == "chosen" and user in role_queues and not role_queues[user]:
+                print("No patients waiting for the " + ROLE_NAMES[user] + ".")
+                event = "empty"
+
+# the status_entry function shows a page of one of the stage queues
+        elif state == "status":
+            status_entry(status)
+            event = "shown"
+
+# the query_entry function shows billing totals from the rollups
+        elif state == "query":
+            query_entry(rollups, accounts)
+            event = "shown"
 
 # the role_entry function calls the data entry function specific to each user
-        data_input = role_entry(user, starting_data)
+        elif state == "entry":
+            started = time.perf_counter()
+            #an urgent claim may have come in since the last action, so the role works on whoever is next now
+            if role_queues.get(user):
+                starting_data = role_queues[user].first()
+            data_input = role_entry(user, starting_data)
+            metrics.handled(ROLE_NAMES[user], time.perf_counter() - started)
+            if data_input == RESTART:
+                event = "restart"
+            else:
+                event = "entered"
 
+        elif state == "apply":
+            started = time.perf_counter()
 #each piece of this five-part if statement prepares data for the next iteration of the main function
 #each part feeds data into the mutable data sets above
 
 #user 1 is the patient who enters his or her own data which is passed to the clinic
-        if user_role == "1":
-            waiting_room.append(data_input)
-            if len(waiting_room) > 0:
-                starting_data = waiting_room[0]
-            else:
-                starting_data = ["Enter New Patient", "To Enter New Patient", "Press 1", "PatientEntryNeeded", "PatientEntryNeeded"]
-            print("These patients are in the waiting room: ")
-            for i in range (len(waiting_room)):
-                print(str(waiting_room[i]))
+            if user_role == "1":
+                waiting_room.append(data_input)
+                metrics.entered("waiting", data_input, started)
+                claim_store.save(data_input, "waiting")
+                if len(waiting_room) > 0:
+                    starting_data = waiting_room.first()
+                else:
+                    starting_data = ClaimSheet("Enter New Patient", "To Enter New Patient", "Press 1", "PatientEntryNeeded", "PatientEntryNeeded")
 
 #user 2 is the receptionist
-        elif user_role == "2":
-            patients_for_processing.append(data_input)
-            waiting_room.pop(0)
-            if len(waiting_room) > 0:
-                starting_data = waiting_room[0]
-            else:
-                starting_data = patients_for_processing[0]
-            print("These patients are in the waiting room: ")
-            for i in range (len(waiting_room)):
-                 print(str(waiting_room[i]))
-            print("These patients have been sent to treatment: ")
-            for i in range (len(patients_for_processing)):
-                print(str(patients_for_processing[i]))
+            elif user_role == "2":
+                patients_for_processing.append(data_input)
+                metrics.entered("to treatment", data_input, started)
+                admitted = waiting_room.popleft()
+                metrics.left("waiting", admitted, started)
+                claim_store.save(data_input, "to treatment", replaces=admitted)
+                #only a pid reception has confirmed is registered, and whatever is wrong with it is shown
+                for problem in IDENTITIES.add(data_input.pid, data_input.first, data_input.last):
+                    print("Registered with an identity problem (" + problem + "): " + str(data_input.pid)
+                          + " " + str(data_input.first) + " " + str(data_input.last))
+                if len(waiting_room) > 0:
+                    starting_data = waiting_room.first()
+                else:
+                    starting_data = patients_for_processing.first()
 
 # user 3 is the clinician or doctor who treats the patient
-        elif user_role == "3":
-            patients_in_treatment.append(data_input)
-            patients_for_processing.pop(0)
-            if len(patients_for_processing) > 0:
-                starting_data = patients_for_processing[0]
-            else:
-                starting_data = patients_in_treatment[0]
-            print("These patients are in the waiting room: ")
-            for i in range (len(waiting_room)):
-                 print(str(waiting_room[i]))
-            print("These patients have been sent to treatment: ")
-            for i in range (len(patients_for_processing)):
-                print(str(patients_for_processing[i]))
-            print("These patients have been treated: ")
-            for i in range (len(patients_in_treatment)):
-                print(str(patients_in_treatment[i]))
+            elif user_role == "3":
+                patients_in_treatment.append(data_input)
+                metrics.entered("treated", data_input, started)
+                processed = patients_for_processing.popleft()
+                metrics.left("to treatment", processed, started)
+                claim_store.save(data_input, "treated", replaces=processed)
+                if len(patients_for_processing) > 0:
+                    starting_data = patients_for_processing.first()
+                else:
+                    starting_data = patients_in_treatment.first()
 
 # user 4 is the insurer who reviews the treatment and assigns a medical code
-        elif user_role == "4":
-            insured_for_auditing.append(data_input)
-            patients_in_treatment.pop(0)
-            if len(patients_in_treatment) > 0:
-                starting_data = patients_in_treatment[0]
-            else:
-                starting_data = insured_for_auditing[0]
-            print("These insured have been processed: ")
-            for i in range(len(insured_for_auditing)):
-                print(str(insured_for_auditing[i]))
+            elif user_role == "4":
+                insured_for_auditing.append(data_input)
+                metrics.entered("for auditing", data_input, started)
+                treated = patients_in_treatment.popleft()
+                metrics.left("treated", treated, started)
+                claim_store.save(data_input, "for auditing", replaces=treated)
+                claim_store.save_insured(data_input.pid, data_input.first, data_input.last)
+                if len(patients_in_treatment) > 0:
+                    starting_data = patients_in_treatment.first()
+                else:
+                    starting_data = insured_for_auditing.first()
 
 # user 5 is the auditor who reviews the treatment and medical code and approves payments
-        elif user_role == "5":
-            invoices_for_payment[str(insured_for_auditing[0][0])] = insured_for_auditing[0][4]
-            print("These insured have been processed: ")
-            for i in range(len(insured_for_auditing)):
-                print(str(insured_for_auditing[i]))
-            print("These cases are ready for invoicing and payment: ")
-            for key in invoices_for_payment:
-                print(str(invoices_for_payment[key]))
-            insured_for_auditing.pop(0)
-            if len(insured_for_auditing) > 0:
-                starting_data = insured_for_auditing[0]
-            else:
-                starting_data = data_input
+            elif user_role == "5":
+                invoices_for_payment.add(data_input.pid, data_input.code, service_payment(data_input.code),
+                                         DEFAULT_INSURER, DEFAULT_CLINIC)
+                print("These cases are ready for invoicing and payment: ")
+                for item in invoices_for_payment.unpaid():
+                    print(str(item.code))
+                audited = insured_for_auditing.popleft()
+                metrics.left("for auditing", audited, started)
+                CODE_SUGGESTIONS.learn(data_input.complaint, data_input.code)
+                claim_store.settle(data_input, "settled", replaces=audited)
+                if len(insured_for_auditing) > 0:
+                    starting_data = insured_for_auditing.first()
+                else:
+                    starting_data = data_input
 
 # this step calls the payment function
-            for key in invoices_for_payment:
-                current_balance += process_payment(invoices_for_payment[key])
-                print("The new clinic balance is: $" + str(current_balance))
-            invoices_for_payment.clear()
-            print("These patients are in the waiting room: ")
-            for i in range (len(waiting_room)):
-                 print(str(waiting_room[i]))
-            print("These patients have been sent to treatment: ")
-            for i in range (len(patients_for_processing)):
-                print(str(patients_for_processing[i]))
-            print("These patients have been treated: ")
-            for i in range (len(patients_in_treatment)):
-                print(str(patients_in_treatment[i]))
-            print("These insured have been processed: ")
-            for i in range(len(insured_for_auditing)):
-                print(str(insured_for_auditing[i]))
+                settle_started = time.perf_counter()
+                for item in invoices_for_payment.take_unpaid():
+                    payment = process_payment(item.code)
+                    seq = payment_register.append(item.code, payment, pid=item.pid)
+                    rollups.settle(item.pid, item.code, payment, item.insurer, item.clinic, seq=seq)
+                    accounts.accrue(item.insurer, item.clinic, to_cents(payment))
+                    current_balance = payment_register.balance
+                    metrics.settled(item.code, payment, current_balance)
+                    print("The new clinic balance is: $" + str(current_balance))
+                print("Visits billed to patient " + str(data_input.pid) + ": "
+                      + str(invoices_for_payment.visits(data_input.pid))
+                      + ", total $" + str(invoices_for_payment.pid_total(data_input.pid)))
+                payment_register.commit()
+                if accounts.pending_claims >= NETTING_CYCLE:
+                    accounts.settle_cycle()
+                metrics.settle_time(time.perf_counter() - settle_started)
+
+#only the changes and the stage counts are printed; type s at the role prompt for a full listing
+            print(status.report())
+            if waiting_room:
+                PHOTO_CACHE.prefetch(photo_filename(waiting_room.first()))
+            metrics.applied(ROLE_NAMES[user_role], time.perf_counter() - started)
+            event = "applied"
+
+# every state change goes through the transition table, so a restart keeps the queues
+        state = SESSION_TRANSITIONS[(state, event)]
+
+    payment_register.close()
+    accounts.settle_cycle()
+    rollups.save(ROLLUP_FILE)
+    close_stores()
+    if metrics_file is not None:
+        metrics_file.stop()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 def initial_role_entry(initial_user):
     user = initial_user
-    user = input("Please enter your user role \n 1 for Patient \n 2 for Receptionist \n 3 for Clinician \n 4 for Insurer \n 5 for Auditor \n Type exit to exit the program \n Entry: ")
-    if user == "1" or user == "2" or user == "3" or user == "4" or user == "5" or user == "exit":
+    user = input("Please enter your user role \n 1 for Patient \n 2 for Receptionist \n 3 for Clinician \n 4 for Insurer \n 5 for Auditor \n Type s to list patients \n Type q for billing totals \n Type exit to exit the program \n Entry: ")
+    if user == "1" or user == "2" or user == "3" or user == "4" or user == "5" or user == "s" or user == "q" or user == "exit":
         return user
     else:
-        main()
+        return RESTART
+
+#the role_event function turns the role entry into an event for SESSION_TRANSITIONS
+def role_event(user):
+    if user == "exit":
+        return "exit"
+    elif user == "s":
+        return "status"
+    elif user == "q":
+        return "query"
+    elif user == RESTART:
+        return "invalid"
+    else:
+        return "chosen"
+
+#the status_entry function lists one stage queue a page at a time
+def status_entry(status):
+    labels = [label for label, queue in status.stages]
+    print(status.report())
+    for i in range(len(labels)):
+        print(" " + str(i + 1) + " for " + labels[i])
+    choice = input("Which patients would you like to list? ")
+    if not choice.isdigit() or int(choice) < 1 or int(choice) > len(labels):
+        return
+    label = labels[int(choice) - 1]
+    page_number = 1
+    while True:
+        print(status.page(label, page_number))
+        if page_number >= status.page_count(label):
+            return
+        more = input("Press Enter for the next page or type q to stop: ")
+        if more == "q":
+            return
+        page_number += 1
+
+#the query_entry function answers billing questions from the rollups without reading the claims again
+def query_entry(rollups, accounts):
+    print("Settled claims: " + str(rollups.claims) + ", total $" + str(rollups.total))
+    print(" 1 for totals by medical code \n 2 for totals by insurer \n 3 for totals by clinic \n 4 for totals by day \n 5 for the top patients \n 6 for the insurer and clinic accounts")
+    choice = input("Which totals would you like to see? ")
+    if choice == "1":
+        for code in sorted(rollups.by_code):
+            claims, dollars = rollups.code_total(code)
+            print(str(code) + " " + str(MEDICAL_CODES.get(code, "unknown")) + ": " + str(claims) + " claims, $" + str(dollars))
+    elif choice == "2":
+        for insurer in rollups.by_insurer:
+            claims, dollars = rollups.insurer_total(insurer)
+            print(str(insurer) + ": " + str(claims) + " claims, $" + str(dollars))
+    elif choice == "3":
+        for clinic in rollups.by_clinic:
+            claims, dollars = rollups.clinic_total(clinic)
+            print(str(clinic) + ": " + str(claims) + " claims, $" + str(dollars))
+    elif choice == "4":
+        first_day = input("First day (YYYY-MM-DD), or press Enter for every day: ")
+        last_day = "9999-12-31"
+        if first_day != "":
+            last_day = input("Last day (YYYY-MM-DD): ")
+        for day, claims, dollars in rollups.days_between(first_day, last_day):
+            print(day + ": " + str(claims) + " claims, $" + str(dollars))
+    elif choice == "5":
+        top = rollups.top_patients(10)
+        for i in range(len(top)):
+            print(str(i + 1) + ". patient " + str(top[i][0]) + ": $" + str(top[i][1]))
+    elif choice == "6":
+        for kind in (INSURER, CLINIC):
+            for account in accounts.accounts(kind):
+                print(str(account) + ": " + format_cents(accounts.balance(account)) + " settled, "
+                      + format_cents(accounts.balance(account, pending=True)) + " with the claims not yet netted")
+        problems = accounts.check()
+        if problems:
+            print("The accounts do not balance: " + ", ".join(problems))
+        else:
+            print("Debits equal credits: " + format_cents(accounts.total_debits))
 
 #the role_entry function calls the specific user data entry functions and returns a data_input
 def role_entry(user, starting_data):
@@ -260,148 +469,208 @@ def role_entry(user, starting_data):
 
 def patient_entry():
     pfirstname = input("Please enter your first name (or type EXIT to start over): ")
-    pfirstname = pfirstname.strip()
-    accidental_full = pfirstname.split(" ")
-    pfirstname = str(accidental_full[0])
-    if pfirstname == "EXIT":
-        main()
-    pfirstname = pfirstname.lower()
+    if first_name_only(pfirstname) == "EXIT":
+        return RESTART
     plastname = input("Please enter your last name: ")
-    plastname = plastname.strip()
-    plastname = plastname.lower()
     pid = input("Please enter your patient identification number: ")
     pcomplaint = input("Please explain your symptoms or reason for this visit: ")
-    pcode = "xxxx"
-    padmit_sheet = [pid, pfirstname, plastname, pcomplaint, pcode]
+    padmit_sheet = new_admit_sheet(pid, pfirstname, plastname, pcomplaint)
     return padmit_sheet
 
 def reception_entry(padmit_sheet):
-    pid = padmit_sheet[0]
-    plastname = padmit_sheet[2]
+    pid = padmit_sheet.pid
+    plastname = padmit_sheet.last
+    #the photo is found by the pid the patient gave, so look it up before the pid is cleared below,
+    #and start decoding it now so it is ready if the receptionist asks for it
+    image = photo_filename(padmit_sheet)
+    PHOTO_CACHE.prefetch(image)
     cid = input("To enter new patient information, press 1, or press enter to continue: ")
     if cid == "1":
-        main()
+        return RESTART
     else:
         cadmit_sheet = padmit_sheet
-        cadmit_sheet[0] = "NoEntry"
-        print("Please confirm identity and enter the identification number for: " + str(cadmit_sheet[1]) + " " + str(cadmit_sheet[2])) 
+        cadmit_sheet.pid = "NoEntry"
+        print("Please confirm identity and enter the identification number for: " + str(cadmit_sheet.first) + " " + str(cadmit_sheet.last)) 
         show_photo = input("Press p to view the photo: ")
-        #image = "images/" + str(padmit_sheet[1]) + str(padmit_sheet[2]) + ".jpg"
         if show_photo == "p":
-            image = "images/" + str(padmit_sheet[1]) + str(padmit_sheet[2]) + ".jpg"
-            if str(image) == "images/fredflintstone.jpg":
-                photo = SimpleImage(image)
-                photo.show()
-            elif str(image) == "images/wilmaflintstone.jpg":
-                photo = SimpleImage(image)
-                photo.show()
-            elif str(image) == "images/barneyrubble.jpg":
-                photo = SimpleImage(image)
-                photo.show()
-            elif str(image) == "images/bettyrubble.jpg":
-                photo = SimpleImage(image)
+            photo = None
+            if image is not None:
+                #the photo may have been deleted since the registry scanned the folder, or be corrupt,
+                #which is no reason to end the session (a prefetch skips it the same way)
+                try:
+                    photo = PHOTO_CACHE.get(image)
+                except (OSError, ValueError):
+                    photo = None
+            if photo is not None:
                 photo.show()
             else:
                 print("No photo available.")
     different_patient = input("If this is not the patient you are treating, type 'diff' here, otherwise press Enter: ")
     if different_patient == "diff":
         pfirstname = input("Please enter patient's first name: ")
-        pfirstname = pfirstname.strip()
-        accidental_full = pfirstname.split(" ")
-        pfirstname = str(accidental_full[0])
-        pfirstname = pfirstname.lower()
         plastname = input("Please enter patient's last name: ")
-        plastname = plastname.strip()
-        plastname = plastname.lower()
         pid = input("Please enter the new patient's identification number: ")
         pcomplaint = input("Please detail the patient's symptoms: ") 
-        pcode = "xxxx"
-        cadmit_sheet = [pid, pfirstname, plastname, pcomplaint, pcode]
+        cadmit_sheet = new_admit_sheet(pid, pfirstname, plastname, pcomplaint)
+        plastname = cadmit_sheet.last
     different_patient = "done"
     cid = input("Please confirm patient's ID number: ")            
-    cadmit_sheet[0] = cid
-    cid = cadmit_sheet[0]
-    clastname = cadmit_sheet[2]
-    if (str(pid) + str(plastname)) != (str(cid) + str(clastname)):
+    cadmit_sheet.pid = cid
+    cid = cadmit_sheet.pid
+    clastname = cadmit_sheet.last
+    if not identity_matches(pid, plastname, cid, clastname):
         cid = input("ID number does not match. Please re-enter patient ID number: ")            
-        cadmit_sheet[0] = cid
+        cadmit_sheet.pid = cid
     else:
-        cadmit_sheet[0] = cid
+        cadmit_sheet.pid = cid
+    #the payment ledger keeps PID_BYTES bytes of the ID number, so a longer one is asked for again
+    while not pid_fits(cid):
+        cid = input("ID numbers are at most " + str(PID_BYTES) + " bytes long. Please re-enter patient ID number: ")
+        cadmit_sheet.pid = cid
+    #check the ID number and the name against the patients already on file
+    problems = IDENTITIES.check(cid, cadmit_sheet.first, clastname)
+    if PID_REUSED in problems:
+        on_file = get_store(CLAIM_STORE_FILE).find_patient(cid)
+        if on_file is not None:
+            print("Note: ID number " + str(cid) + " is on file for a patient named " + str(on_file[1]) + " " + str(on_file[2]))
+    if NAME_REUSED in problems:
+        print("Note: " + str(cadmit_sheet.first) + " " + str(clastname) + " is on file under a different ID number")
     ccomplaint = input("Please give details about the patient's stated symptoms: ")
-    cadmit_sheet[3] = ccomplaint
+    cadmit_sheet.complaint = ccomplaint
     ccode = input("Please enter relevant medical code (type 0000 if unknown): ")
-    cadmit_sheet[4] = ccode
+    cadmit_sheet.code = ccode
+    cadmit_sheet.priority = triage_entry(cadmit_sheet)
     print("This patient has been sent to treatment: " + str(cadmit_sheet))
     return cadmit_sheet
 
 def clinic_entry(cadmit_sheet):
     ctreatment_sheet = cadmit_sheet
-    print(str(ctreatment_sheet[1]) + " " + str(ctreatment_sheet[2]) + " complained of " + str(ctreatment_sheet[3]))
+    print(str(ctreatment_sheet.first) + " " + str(ctreatment_sheet.last) + " complained of " + str(ctreatment_sheet.complaint))
     different_patient = input("If this is not the patient you are treating, type 'diff' here, otherwise press Enter: ")
     if different_patient == "diff":
         pfirstname = input("Please enter patient's first name: ")
-        pfirstname = pfirstname.strip()
-        accidental_full = pfirstname.split(" ")
-        pfirstname = str(accidental_full[0])
-        pfirstname = pfirstname.lower()
         plastname = input("Please enter patient's last name: ")
-        plastname = plastname.strip()
-        plastname = plastname.lower()
         pid = input("Please enter the patient's identification number: ")
         pcomplaint = input("Please detail your treatment of the patient: ") 
-        pcode = "xxxx"
-        ctreatment_sheet = [pid, pfirstname, plastname, pcomplaint, pcode]
+        ctreatment_sheet = new_admit_sheet(pid, pfirstname, plastname, pcomplaint)
     different_patient = "done"
     print("Enter proposed medical code below.")
+    print(CODE_SUGGESTIONS.suggestion_text(ctreatment_sheet.complaint))
     get_help = input("For help with codes, press h or press Enter to continue: ")
     if get_help == "h":
         print(MEDICAL_CODES)
     ccode = input("Please enter relevant medical code: ")
     if ccode == "":
         ccode = input("A code must be entered here. Please enter relevant medical code: ")
-    ctreatment_sheet[4] = ccode
+    ctreatment_sheet.code = ccode
     return ctreatment_sheet
 
 
 def insurer_entry(ctreatment_sheet):
     ins_treatment_sheet = ctreatment_sheet
-    print("The patient was treated for " + str(ctreatment_sheet[3]))
-    print("The treatment given was coded by the clinic as: " + str(ctreatment_sheet[4]))
+    print("The patient was treated for " + str(ctreatment_sheet.complaint))
+    print("The treatment given was coded by the clinic as: " + str(ctreatment_sheet.code))
+    print(CODE_SUGGESTIONS.suggestion_text(ctreatment_sheet.complaint))
     help = input("For help with codes, press h, to continue press Enter: ")
     if help == "h":
         print(MEDICAL_CODES)
     ins_code = input("Is the given medical code correct? If so, please re-type it here, or type the correct code: ")
-    if ins_code == str(ctreatment_sheet[4]):
+    if ins_code == str(ctreatment_sheet.code):
         ins_treatment_sheet = ctreatment_sheet
     else:
-        ins_treatment_sheet[4] = str(ins_code)
+        ins_treatment_sheet.code = str(ins_code)
     return ins_treatment_sheet
 
 def auditor_entry(ins_treatment_sheet):
         auditor_sheet = ins_treatment_sheet
-        print("The patient was treated for " + str(ins_treatment_sheet[3]))
-        print("The treatment given was coded by the INSURER as: " + str(ins_treatment_sheet[4]))
+        print("The patient was treated for " + str(ins_treatment_sheet.complaint))
+        print("The treatment given was coded by the INSURER as: " + str(ins_treatment_sheet.code))
+        print(CODE_SUGGESTIONS.suggestion_text(ins_treatment_sheet.complaint))
         get_help = input("For help with codes, press h or press Enter to continue: ")
         if get_help == "h":
             print(MEDICAL_CODES)
         auditor_code_1 = input("Please type the correct medical code here or type EXIT: ")
         if auditor_code_1 == "EXIT":
-            main()
+            return RESTART
         auditor_code_2 = input("Double check: Please re-enter the correct medical code here or type EXIT: ")
         if auditor_code_2 == "EXIT":
-            main()
+            return RESTART
         if auditor_code_1 == auditor_code_2:
-            auditor_sheet[4] = auditor_code_2
+            auditor_sheet.code = auditor_code_2
         else:
             auditor_code_3 = input("Double check: Please re-enter the correct medical code here: ")
-            auditor_sheet[4] = auditor_code_3
+            auditor_sheet.code = auditor_code_3
         return auditor_sheet
 
+#the triage_entry function lets reception confirm or change the triage class the complaint was given
+def triage_entry(cadmit_sheet):
+    suggested = triage_class(cadmit_sheet.complaint)
+    choice = input("Triage: " + suggested + ". Type u for urgent, s for soon, r for routine, or press Enter to keep it: ")
+    if choice == "u":
+        return URGENT
+    elif choice == "s":
+        return SOON
+    elif choice == "r":
+        return ROUTINE
+    else:
+        return None
+
 #this is the main payment function
 def process_payment(service_code):
     print("Service Code " + str(service_code) + " is billed at $" + str(PAYMENT_CODES[service_code]))
-    payment_amount = int(PAYMENT_CODES[service_code])
+    payment_amount = service_payment(service_code)
     return payment_amount
+
+#this gives the file name of a patient's ID photo, or None if there is no photo on file
+def photo_filename(padmit_sheet):
+    return PHOTO_REGISTRY.photo_for(padmit_sheet)
+
+#this looks up a payment without printing it, so batch jobs can settle quietly
+def service_payment(service_code):
+    return int(PAYMENT_CODES[service_code])
+
+#the accounts live in memory, so each session opens them from the ledger: the initial clinic balance
+#and everything settled before, which the ledger does not split by account, between the default pair
+def open_accounts(accounts, ledger_balance):
+    if INITIAL_CLINIC_BALANCE:
+        accounts.transfer(DEFAULT_CLINIC, OPENING, to_cents(INITIAL_CLINIC_BALANCE), memo="opening balance")
+    settled = int(ledger_balance) - int(INITIAL_CLINIC_BALANCE)
+    if settled:
+        accounts.transfer(DEFAULT_CLINIC, DEFAULT_INSURER, to_cents(settled), memo="settled before this session")
+
+#these helpers hold the stage logic of the entry functions without the input() prompts
+#so that the same logic can be driven from data files (see batchingest.py)
+def first_name_only(pfirstname):
+    pfirstname = pfirstname.strip()
+    accidental_full = pfirstname.split(" ")
+    return str(accidental_full[0])
+
+def new_admit_sheet(pid, pfirstname, plastname, pcomplaint):
+    pfirstname = first_name_only(pfirstname).lower()
+    plastname = plastname.strip().lower()
+    pcode = "xxxx"
+    padmit_sheet = ClaimSheet(pid, pfirstname, plastname, pcomplaint, pcode)
+    return padmit_sheet
+
+def reopen_claims(claim_store, stages):
+    """
+    Queue the claims the store still has at a stage again, oldest first, so
+    that claims open when the last session stopped or crashed carry on from
+    where they were. stages is [(stage name, queue)] as in StatusView; the
+    triage class comes from the complaint, as reception's choice is not stored.
+    Returns how many claims were queued.
+    """
+    queues = dict(stages)
+    count = 0
+    for claim_id, pid, first, last, complaint, code, stage in claim_store.open_claims(queues):
+        sheet = ClaimSheet(pid, first, last, complaint, code)
+        sheet.claim_id = claim_id
+        queues[stage].append(sheet)
+        count += 1
+    return count
+
+def identity_matches(pid, plastname, cid, clastname):
+    return (str(pid) + str(plastname)) == (str(cid) + str(clastname))
     
 #this function is not used
 def make_payments(payment_register):
@@ -415,7 +684,7 @@ def add_insured():
     iid = input("Please enter the insured's identification number: ")
     icomplaint = input("Please enter the insured's sytomps: ")
     icode = input("Please enter the relevant medical code: ")
-    insured = [iid, ifirstname, ilastname, icomplaint, icode]
+    insured = ClaimSheet(iid, ifirstname, ilastname, icomplaint, icode)
     return insured
 
 
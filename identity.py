@@ -0,0 +1,271 @@
+"""
+Identity index for pid / name reconciliation.
+
+reception_entry compares str(pid) + str(plastname) with str(cid) +
+str(clastname) for one patient, and nothing compares an admit with the
+patients already on file. IdentityIndex remembers, for every pid, the
+name it was first registered under, and for every name the first pid it
+was registered under, so an admit can be flagged when
+  - a pid on file comes in under a different name (PID_REUSED), or
+  - a name on file comes in under a different pid (NAME_REUSED).
+
+The index has to hold tens of millions of identities, so it does not keep
+strings. Pids and names are hashed to 64 bits and kept in two
+open-addressing tables in flat arrays (12 bytes a slot), and a Bloom
+filter in front of the pid table answers "never seen this pid" without
+probing the table, which is the usual case for a new patient.
+
+Example:
+  index = IdentityIndex(expected=1000000)
+  index.add("12", "fred", "flintstone")       # []
+  index.check("12", "barney", "rubble")       # [PID_REUSED]
+  index.check("13", "fred", "flintstone")     # [NAME_REUSED]
+
+Usage:
+  python identity.py                  # memory and speed for 1,000,000 identities
+  python identity.py 10000000
+"""
+
+import math
+import sys
+import time
+from array import array
+
+PID_REUSED = "pid reused"
+NAME_REUSED = "name under several pids"
+
+EXPECTED = 1 << 16
+ERROR_RATE = 0.01
+#the tables are doubled when they are this full
+MAX_LOAD = 0.7
+EMPTY = 0
+
+
+def canonical_name(first, last):
+    """The name an identity is compared by: lower case, single spaces."""
+    return " ".join((str(first) + " " + str(last)).lower().split())
+
+
+def key_hash(text):
+    """
+    64-bit hash of a string (never 0, which marks an empty slot). Python's
+    string hash is salted per process, so the index is rebuilt from the
+    claim store on start rather than saved.
+    """
+    return (hash(str(text)) & 0xffffffffffffffff) or 1
+
+
+class BloomFilter(object):
+    """
+    Blocked Bloom filter: each value sets 6 bits inside one 64-bit word, so
+    a lookup reads one array item and compares it with a mask instead of
+    testing bits spread over the whole filter.
+    """
+    def __init__(self, expected=EXPECTED, error_rate=ERROR_RATE):
+        expected = max(1, expected)
+        bits = -expected * math.log(error_rate) / (math.log(2) ** 2)
+        self.blocks = max(1, int(bits) // 64 + 1)
+        self.words = array("Q", bytes(8 * self.blocks))
+
+    #the low 36 bits of a value pick the 6 bits in the word, the rest of it picks the word
+    def add(self, value):
+        mask = ((1 << (value & 63)) | (1 << ((value >> 6) & 63)) | (1 << ((value >> 12) & 63))
+                | (1 << ((value >> 18) & 63)) | (1 << ((value >> 24) & 63)) | (1 << ((value >> 30) & 63)))
+        self.words[(value >> 36) % self.blocks] |= mask
+
+    def __contains__(self, value):
+        mask = ((1 << (value & 63)) | (1 << ((value >> 6) & 63)) | (1 << ((value >> 12) & 63))
+                | (1 << ((value >> 18) & 63)) | (1 << ((value >> 24) & 63)) | (1 << ((value >> 30) & 63)))
+        return self.words[(value >> 36) % self.blocks] & mask == mask
+
+    def nbytes(self):
+        return 8 * self.blocks
+
+
+class HashTable(object):
+    """Open-addressing map from a 64-bit key hash to a 32-bit value, in two flat arrays."""
+    def __init__(self, expected=EXPECTED):
+        capacity = 16
+        while capacity * MAX_LOAD < expected:
+            capacity *= 2
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.keys = array("Q", bytes(8 * capacity))
+        self.values = array("I", bytes(4 * capacity))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, key):
+        slot = (key ^ (key >> 29)) & self.mask
+        keys = self.keys
+        while keys[slot] != EMPTY and keys[slot] != key:
+            slot = (slot + 1) & self.mask
+        return slot
+
+    def get(self, key, default=None):
+        slot = self._slot(key)
+        if self.keys[slot] == EMPTY:
+            return default
+        return self.values[slot]
+
+    def setdefault(self, key, value):
+        """Store value for key unless the key is there already; returns the stored value."""
+        slot = self._slot(key)
+        if self.keys[slot] != EMPTY:
+            return self.values[slot]
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.count += 1
+        if self.count > self.capacity * MAX_LOAD:
+            self._grow()
+        return value
+
+    def items(self):
+        for slot in range(self.capacity):
+            if self.keys[slot] != EMPTY:
+                yield self.keys[slot], self.values[slot]
+
+    def _grow(self):
+        old_keys = self.keys
+        old_values = self.values
+        self._allocate(self.capacity * 2)
+        for slot in range(len(old_keys)):
+            if old_keys[slot] != EMPTY:
+                new_slot = self._slot(old_keys[slot])
+                self.keys[new_slot] = old_keys[slot]
+                self.values[new_slot] = old_values[slot]
+                self.count += 1
+
+    def nbytes(self):
+        return self.keys.itemsize * len(self.keys) + self.values.itemsize * len(self.values)
+
+
+class IdentityIndex(object):
+    def __init__(self, expected=EXPECTED, error_rate=ERROR_RATE):
+        self.error_rate = error_rate
+        # pid hash -> low 32 bits of the hash of the name it was first registered under
+        self.names = HashTable(expected)
+        # name hash -> low 32 bits of the hash of the first pid registered under it
+        self.pids = HashTable(expected)
+        #built on the first check(), so a batch that only adds never pays for it
+        self.bloom = None
+        self._bloom_capacity = None
+        self.bloom_skips = 0
+        self.lookups = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, pid):
+        return self._name_for(key_hash(pid)) is not None
+
+    def check(self, pid, first, last):
+        """Return the problems with an admit under this pid and name, without adding it."""
+        return self._check(key_hash(pid), key_hash(canonical_name(first, last)))
+
+    def add(self, pid, first, last):
+        """
+        Check an admit and register it; returns its problems. A pid or name
+        already on file keeps the identity it was first registered with.
+        """
+        pid_hash = key_hash(pid)
+        name_hash = key_hash(canonical_name(first, last))
+        #adding has to probe the tables to find a free slot anyway, so the Bloom filter
+        #only speeds up check(); setdefault() hands back what was on file for the comparison
+        problems = []
+        if self.names.setdefault(pid_hash, name_hash & 0xffffffff) != name_hash & 0xffffffff:
+            problems.append(PID_REUSED)
+        if self.pids.setdefault(name_hash, pid_hash & 0xffffffff) != pid_hash & 0xffffffff:
+            problems.append(NAME_REUSED)
+        if self.bloom is not None:
+            self.bloom.add(pid_hash)
+            if self.names.capacity != self._bloom_capacity:
+                #the pid table outgrew the filter, so rebuild it for the new size to keep false positives rare
+                self._rebuild_bloom()
+        return problems
+
+    def add_patients(self, patients):
+        """Register (pid, first, last) rows, such as ClaimStore.confirmed_patients(); returns how many were new."""
+        before = len(self)
+        for pid, first, last in patients:
+            self.add(pid, first, last)
+        return len(self) - before
+
+    def stats(self):
+        return {
+            "identities": len(self.names),
+            "names": len(self.pids),
+            "lookups": self.lookups,
+            "bloom skips": self.bloom_skips,
+            "bytes": self.names.nbytes() + self.pids.nbytes() + (self.bloom.nbytes() if self.bloom else 0),
+        }
+
+    def _name_for(self, pid_hash):
+        self.lookups += 1
+        if self.bloom is None:
+            self._rebuild_bloom()
+        if pid_hash not in self.bloom:
+            self.bloom_skips += 1
+            return None
+        return self.names.get(pid_hash)
+
+    def _check(self, pid_hash, name_hash):
+        problems = []
+        name_on_file = self._name_for(pid_hash)
+        if name_on_file is not None and name_on_file != name_hash & 0xffffffff:
+            problems.append(PID_REUSED)
+        #a pid with a Bloom miss is new, but its name may still be on file under another pid
+        pid_on_file = self.pids.get(name_hash)
+        if pid_on_file is not None and pid_on_file != pid_hash & 0xffffffff:
+            problems.append(NAME_REUSED)
+        return problems
+
+    def _rebuild_bloom(self):
+        self.bloom = BloomFilter(self.names.capacity, self.error_rate)
+        self._bloom_capacity = self.names.capacity
+        for pid_hash, name in self.names.items():
+            self.bloom.add(pid_hash)
+
+
+def benchmark(count=1000000):
+    index = IdentityIndex(expected=count)
+    start = time.perf_counter()
+    for i in range(count):
+        index.add(str(i), "first" + str(i % 5000), "last" + str(i // 5000))
+    elapsed = time.perf_counter() - start
+    memory = index.stats()["bytes"]
+    print("Identities: " + str(len(index)) + " in " + str(round(elapsed, 2)) + " seconds, "
+          + str(int(count / elapsed)) + " adds/sec")
+    print("Index size: " + str(memory // (1024 * 1024)) + " MiB, " + str(round(memory / count, 1)) + " bytes per identity")
+
+    new = 100000
+    #the first check builds the Bloom filter
+    index.check("0", "first0", "last0")
+    start = time.perf_counter()
+    for i in range(count, count + new):
+        index.check(str(i), "first" + str(i), "new")
+    elapsed = time.perf_counter() - start
+    print("New pids checked: " + str(int(new / elapsed)) + " checks/sec, " + str(index.bloom_skips)
+          + " of " + str(index.lookups) + " lookups skipped by the Bloom filter")
+    flagged = (index.check("7", "someone", "else") == [PID_REUSED]
+               and index.check(str(count + 1), "first7", "last0") == [NAME_REUSED])
+    print("Reused pid and reused name flagged: " + str(flagged))
+    return flagged
+
+
+def main():
+    args = sys.argv[1:]
+    count = 1000000
+    if args:
+        count = int(args[0])
+    if not benchmark(count):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Invoices for hbilling, one line item per audited visit.
+
+The auditor branch of main() used to collect invoices in a dict keyed by
+pid, so a second visit by the same patient overwrote the first before it
+was paid. InvoiceBook keeps every audited visit as its own line item and
+adds its amount to running totals per pid, per insurer, per clinic and
+per (insurer, clinic) pair as it is added, so an invoice total is a dict
+lookup instead of a pass over the claims. Line items are only kept until
+take_unpaid() hands them on for payment (the payment ledger records them
+from then on); the totals and the visit count per pid stay.
+
+Example:
+  invoices = InvoiceBook()
+  invoices.add("12", "1111", 1001, INS1, CLC1)
+  invoices.add("12", "2222", 2002, INS1, CLC2)
+  invoices.pid_total("12")         # 3003, both visits
+  invoices.clinic_total(CLC1)      # 1001
+  for item in invoices.take_unpaid():
+      payment_register.append(item.code, item.amount, pid=item.pid)
+  invoices.line_items("12")        # [], both were handed on
+  invoices.visits("12")            # 2
+"""
+
+from collections import namedtuple
+
+LineItem = namedtuple("LineItem", ["pid", "visit", "code", "amount", "insurer", "clinic"])
+
+
+class InvoiceBook(object):
+    def __init__(self):
+        # pid -> line items not yet taken for payment, in the order they were audited
+        self.items = {}
+        self._unpaid = []
+        # pid -> visits billed, paid or not
+        self.visit_counts = {}
+        self.by_pid = {}
+        self.by_insurer = {}
+        self.by_clinic = {}
+        self.by_pair = {}
+        self.total = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, pid, code, amount, insurer=None, clinic=None):
+        """Add an audited visit as a new line item and count it in the totals; returns the item."""
+        pid = str(pid)
+        visit = self.visit_counts.get(pid, 0) + 1
+        self.visit_counts[pid] = visit
+        item = LineItem(pid, visit, str(code), int(amount), insurer, clinic)
+        self.items.setdefault(pid, []).append(item)
+        self._unpaid.append(item)
+        self.by_pid[pid] = self.by_pid.get(pid, 0) + item.amount
+        self.by_insurer[insurer] = self.by_insurer.get(insurer, 0) + item.amount
+        self.by_clinic[clinic] = self.by_clinic.get(clinic, 0) + item.amount
+        self.by_pair[(insurer, clinic)] = self.by_pair.get((insurer, clinic), 0) + item.amount
+        self.total += item.amount
+        self.count += 1
+        return item
+
+    def unpaid(self):
+        """Line items added since the last take_unpaid(), oldest first."""
+        return list(self._unpaid)
+
+    def take_unpaid(self):
+        """Return the unpaid line items and drop them from the book; their totals stay."""
+        unpaid = self._unpaid
+        self._unpaid = []
+        #every item still in the book was unpaid, so nothing is left to keep
+        self.items = {}
+        return unpaid
+
+    def line_items(self, pid):
+        """A pid's line items not yet taken for payment."""
+        return list(self.items.get(str(pid), ()))
+
+    def visits(self, pid):
+        """How many visits have been billed to a pid, paid or not."""
+        return self.visit_counts.get(str(pid), 0)
+
+    def invoice(self, pid):
+        """The unpaid visits of a pid, with the total of every visit billed to it."""
+        return {"pid": str(pid), "items": self.line_items(pid), "total": self.pid_total(pid)}
+
+    def pid_total(self, pid):
+        return self.by_pid.get(str(pid), 0)
+
+    def insurer_total(self, insurer):
+        return self.by_insurer.get(insurer, 0)
+
+    def clinic_total(self, clinic):
+        return self.by_clinic.get(clinic, 0)
+
+    def pair_total(self, insurer, clinic):
+        return self.by_pair.get((insurer, clinic), 0)
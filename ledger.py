@@ -0,0 +1,322 @@
+"""
+Durable append-only payment ledger for hbilling.
+
+Settled payments used to live only in current_balance inside main(),
+so a crash lost every one of them. PaymentLedger writes each settlement
+to an append-only file before it counts as done (a write-ahead log).
+
+Records are fixed-size and checksummed:
+    seq, amount, resulting balance, service code, pid, crc32
+The service code holds up to CODE_BYTES and the pid up to PID_BYTES
+bytes of UTF-8; append() refuses anything longer with a ValueError
+rather than cutting it short, so two pids never collapse into one.
+Appends are buffered and written with one fsync per batch (group commit),
+so durability does not cost one disk flush per payment. A checkpoint file
+holds the balance at a known offset; on startup the ledger loads the
+checkpoint and replays only the log after it. A torn or corrupt record at
+the end of the file (from a crash mid-write) is cut off during recovery.
+History is read through a memory map.
+
+Example:
+  payment_register = PaymentLedger("payment_register.ledger", commit_every=64)
+  payment_register.append("1111", 1001, pid="12")
+  payment_register.commit()
+  payment_register.balance
+  for payment in payment_register.history():
+      print(payment)
+
+Running this file benchmarks settlements per second at several commit
+batch sizes, or runs the crash-injection test:
+  python ledger.py
+  python ledger.py crash
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+RECORD = struct.Struct("<Qqq8s16s")
+CHECKSUM = struct.Struct("<I")
+RECORD_SIZE = RECORD.size + CHECKSUM.size
+
+#the sizes of the service code and pid fields of RECORD
+CODE_BYTES = 8
+PID_BYTES = 16
+
+COMMIT_EVERY = 64
+CHECKPOINT_EVERY = 10000
+
+
+def pid_fits(pid):
+    """True if a pid fits the pid field of a ledger record."""
+    return len(str(pid).encode()) <= PID_BYTES
+
+
+def pack_record(seq, amount, balance, service_code, pid):
+    service_code = str(service_code).encode()
+    pid = str(pid).encode()
+    if len(service_code) > CODE_BYTES:
+        raise ValueError("Service code " + repr(service_code.decode()) + " is longer than " + str(CODE_BYTES)
+                         + " bytes")
+    if len(pid) > PID_BYTES:
+        raise ValueError("Patient ID " + repr(pid.decode()) + " is longer than " + str(PID_BYTES) + " bytes")
+    body = RECORD.pack(seq, amount, balance, service_code, pid)
+    return body + CHECKSUM.pack(zlib.crc32(body))
+
+
+def unpack_record(data, offset=0):
+    """Return the record at offset as a dict, or None if it is torn or corrupt."""
+    if len(data) - offset < RECORD_SIZE:
+        return None
+    body = bytes(data[offset:offset + RECORD.size])
+    crc = CHECKSUM.unpack_from(data, offset + RECORD.size)[0]
+    if zlib.crc32(body) != crc:
+        return None
+    seq, amount, balance, service_code, pid = RECORD.unpack(body)
+    return {
+        "seq": seq,
+        #records written before pids were checked may end in a cut character, so never fail on one
+        "code": service_code.rstrip(b"\0").decode(errors="replace"),
+        "pid": pid.rstrip(b"\0").decode(errors="replace"),
+        "amount": amount,
+        "balance": balance,
+    }
+
+
+def read_records(filename, start=0):
+    """
+    Yield the records of a ledger file from seq start without opening it for
+    writing, so a reader never truncates the tail a running writer is appending
+    to. Stops at the end of the file or at the first torn or corrupt record.
+    """
+    if not os.path.exists(filename):
+        return
+    size = os.path.getsize(filename)
+    if size < (start + 1) * RECORD_SIZE:
+        return
+    with open(filename, "rb") as ledger_file:
+        with mmap.mmap(ledger_file.fileno(), size, access=mmap.ACCESS_READ) as view:
+            for offset in range(start * RECORD_SIZE, size - RECORD_SIZE + 1, RECORD_SIZE):
+                payment = unpack_record(view, offset)
+                if payment is None or payment["seq"] != offset // RECORD_SIZE:
+                    return
+                yield payment
+
+
+class PaymentLedger(object):
+    def __init__(self, filename, commit_every=COMMIT_EVERY, checkpoint_every=CHECKPOINT_EVERY,
+                 initial_balance=0):
+        self.filename = filename
+        self.checkpoint_filename = filename + ".checkpoint"
+        self.commit_every = max(1, commit_every)
+        self.checkpoint_every = checkpoint_every
+        self.balance = int(initial_balance)
+        self.next_seq = 0
+        self._committed_offset = 0
+        self._pending = []
+        self._since_checkpoint = 0
+        self._recover()
+        self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __len__(self):
+        return self.next_seq
+
+    def append(self, service_code, amount, pid=""):
+        """
+        Add a settlement and return its sequence number.
+        The payment is durable once the batch it is in has been committed.
+        Raises ValueError, leaving the ledger as it was, if the code or pid
+        does not fit a record.
+        """
+        seq = self.next_seq
+        record = pack_record(seq, int(amount), self.balance + int(amount), service_code, pid)
+        self.balance += int(amount)
+        self._pending.append(record)
+        self.next_seq += 1
+        if len(self._pending) >= self.commit_every:
+            self.commit()
+        return seq
+
+    def commit(self):
+        """Write every pending settlement with a single fsync."""
+        if not self._pending:
+            return
+        data = b"".join(self._pending)
+        written = 0
+        while written < len(data):
+            written += os.write(self._fd, data[written:])
+        os.fsync(self._fd)
+        self._committed_offset += len(data)
+        self._since_checkpoint += len(self._pending)
+        self._pending = []
+        if self.checkpoint_every and self._since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Save the committed balance and offset so recovery can skip the log before it."""
+        committed_records = self._committed_offset // RECORD_SIZE
+        if committed_records == 0:
+            return
+        last = self.record(committed_records - 1)
+        state = {"seq": last["seq"] + 1, "balance": last["balance"], "offset": self._committed_offset}
+        temp_filename = self.checkpoint_filename + ".tmp"
+        with open(temp_filename, "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_filename, self.checkpoint_filename)
+        self._since_checkpoint = 0
+
+    def close(self):
+        self.commit()
+        self.checkpoint()
+        os.close(self._fd)
+
+    def record(self, seq):
+        """Return one committed record by sequence number."""
+        with open(self.filename, "rb") as ledger_file:
+            ledger_file.seek(seq * RECORD_SIZE)
+            return unpack_record(ledger_file.read(RECORD_SIZE))
+
+    def history(self, start=0, stop=None):
+        """Yield committed records from seq start up to (not including) stop."""
+        end = self._committed_offset // RECORD_SIZE
+        if stop is not None:
+            end = min(end, stop)
+        if start >= end:
+            return
+        with open(self.filename, "rb") as ledger_file:
+            with mmap.mmap(ledger_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for seq in range(start, end):
+                    yield unpack_record(view, seq * RECORD_SIZE)
+
+    def _recover(self):
+        #start from the checkpoint if there is one, then replay the log after it
+        offset = 0
+        if os.path.exists(self.checkpoint_filename):
+            with open(self.checkpoint_filename) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) >= state["offset"]:
+                offset = state["offset"]
+                self.balance = state["balance"]
+                self.next_seq = state["seq"]
+        if not os.path.exists(self.filename):
+            self._committed_offset = offset
+            return
+        size = os.path.getsize(self.filename)
+        if size > offset:
+            with open(self.filename, "rb") as ledger_file:
+                with mmap.mmap(ledger_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    while offset + RECORD_SIZE <= size:
+                        payment = unpack_record(view, offset)
+                        if payment is None or payment["seq"] != self.next_seq:
+                            break
+                        self.balance = payment["balance"]
+                        self.next_seq += 1
+                        offset += RECORD_SIZE
+        if offset < size:
+            #cut off a torn or corrupt tail left by a crash
+            with open(self.filename, "r+b") as ledger_file:
+                ledger_file.truncate(offset)
+                ledger_file.flush()
+                os.fsync(ledger_file.fileno())
+        self._committed_offset = offset
+
+
+def benchmark(batch_sizes=(1, 8, 64, 512, 4096), count=20000):
+    """Print settlements per second for each commit batch size."""
+    #imported here so that importing the ledger stays quick
+    import tempfile
+    for commit_every in batch_sizes:
+        settlements = count
+        if commit_every == 1:
+            settlements = min(count, 2000)
+        with tempfile.TemporaryDirectory() as folder:
+            payment_register = PaymentLedger(os.path.join(folder, "bench.ledger"), commit_every=commit_every)
+            start = time.perf_counter()
+            for i in range(settlements):
+                payment_register.append("1111", 1001, pid=str(i))
+            payment_register.commit()
+            elapsed = time.perf_counter() - start
+            payment_register.close()
+        print("commit every " + str(commit_every) + ": "
+              + str(int(settlements / elapsed)) + " settlements/sec")
+
+
+def crash_pid(i):
+    #non-ASCII pids that fill the pid field, so recovery has to read multibyte characters back whole
+    return "\u00e9" * 6 + str(i % 10000).zfill(4)
+
+
+def crash_child(filename, committed, uncommitted):
+    #commit some payments, leave more in the buffer, write half a record, then die without cleanup
+    payment_register = PaymentLedger(filename, commit_every=committed + uncommitted + 1, checkpoint_every=100)
+    for i in range(committed):
+        payment_register.append("2222", 2002, pid=crash_pid(i))
+    payment_register.commit()
+    for i in range(uncommitted):
+        payment_register.append("1111", 1001, pid=str(i))
+    torn = pack_record(committed, 1001, 0, "1111", "torn")[:RECORD_SIZE // 2]
+    with open(filename, "ab") as ledger_file:
+        ledger_file.write(torn)
+    os._exit(1)
+
+
+def crash_test(committed=250, uncommitted=17):
+    """
+    Kill a process in the middle of a batch and check that recovery keeps
+    exactly the committed payments and cuts off the torn record; returns
+    True if it did.
+    """
+    import subprocess
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "crash.ledger")
+        subprocess.run([sys.executable, __file__, "crash-child", filename, str(committed), str(uncommitted)])
+        payment_register = PaymentLedger(filename)
+        payments = list(payment_register.history())
+        passed = (len(payment_register) == committed
+                  and payment_register.balance == committed * 2002
+                  and len(payments) == committed
+                  and [payment["pid"] for payment in payments] == [crash_pid(i) for i in range(committed)]
+                  and os.path.getsize(filename) == committed * RECORD_SIZE)
+        #the ledger keeps working after recovery
+        payment_register.append("1111", 1001, pid="after")
+        payment_register.close()
+        reopened = PaymentLedger(filename)
+        passed = passed and reopened.balance == committed * 2002 + 1001
+        #a pid that would not fit is refused without touching the ledger; one that just fits comes back whole
+        for pid in ["a" + "\u00e9" * 8, "12345678901234567"]:
+            try:
+                reopened.append("1111", 1001, pid=pid)
+                passed = False
+            except ValueError:
+                pass
+        reopened.append("1111", 1001, pid="\u00e9" * 8)
+        reopened.close()
+        reopened = PaymentLedger(filename)
+        passed = (passed and reopened.balance == committed * 2002 + 2002
+                  and reopened.record(committed + 1)["pid"] == "\u00e9" * 8)
+        reopened.close()
+    print("Recovered " + str(len(payments)) + " of " + str(committed) + " committed payments")
+    print("CRASH TEST PASSED" if passed else "CRASH TEST FAILED")
+    return passed
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) == 4 and args[0] == "crash-child":
+        crash_child(args[1], int(args[2]), int(args[3]))
+    elif len(args) == 1 and args[0] == "crash":
+        if not crash_test():
+            sys.exit(1)
+    else:
+        benchmark()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Metrics for hbilling in the Prometheus text format.
+
+BillingMetrics records, for the interactive loop or the server:
+  hbilling_handler_seconds{role}          time spent in each role's entry handler
+  hbilling_apply_seconds{role}            time spent handing the claim on to the next stage
+  hbilling_time_in_stage_seconds{stage}   how long claims waited in each stage queue
+  hbilling_queue_depth{stage}             claims in each stage queue right now
+  hbilling_settle_seconds                 time to settle one auditor batch
+  hbilling_claims_settled_total{code}     claims settled
+  hbilling_settled_amount_total{code}     dollars settled
+  hbilling_clinic_balance                 clinic balance after the last settlement
+
+Recording is a bisect into a short bucket list and a few additions, and
+queue depths are only read when the metrics are scraped, so the metrics
+can stay on all the time. They are served over HTTP on a local port
+(serve_metrics) or written to a file every few seconds (FileExporter).
+
+Example:
+  metrics = BillingMetrics([("waiting", waiting_room), ...])
+  server = serve_metrics(metrics.registry, 9464)      # curl localhost:9464/metrics
+  metrics.handled("receptionist", 0.002)
+  print(metrics.registry.exposition())
+"""
+
+import os
+import threading
+from bisect import bisect_left
+
+#seconds; handlers include the time someone spends typing at the prompts
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#seconds a claim waits in a stage queue, up to a day
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400)
+EXPORT_INTERVAL = 15
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(name + '="' + value + '"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, pairs):
+        return [name + _format_labels(pairs) + " " + _format_value(self.value)]
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = 0
+        #if set, called at scrape time instead of using value
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self, name, pairs):
+        value = self.value
+        if self.function is not None:
+            value = self.function()
+        return [name + _format_labels(pairs) + " " + _format_value(value)]
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        #counts[i] is the observations in (buckets[i - 1], buckets[i]], the last one is above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, pairs):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            lines.append(name + "_bucket" + _format_labels(pairs + [("le", _format_value(float(bound)))]) + " "
+                         + str(cumulative))
+        lines.append(name + "_sum" + _format_labels(pairs) + " " + _format_value(self.sum))
+        lines.append(name + "_count" + _format_labels(pairs) + " " + str(self.count))
+        return lines
+
+
+class Metric(object):
+    """One metric name with a child Counter, Gauge or Histogram per set of label values."""
+    def __init__(self, name, help, kind, label_names=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self._children = {}
+        #label value -> child, for the common one-label case without building a tuple per call
+        self._by_value = {}
+        if not self.label_names:
+            self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(self.name + " takes labels " + str(self.label_names))
+            if self.kind == "counter":
+                child = Counter()
+            elif self.kind == "gauge":
+                child = Gauge()
+            else:
+                child = Histogram(self.buckets or LATENCY_BUCKETS)
+            self._children[values] = child
+        return child
+
+    def label(self, value):
+        """labels() for a metric with one label, cheap enough for every claim."""
+        child = self._by_value.get(value)
+        if child is None:
+            child = self.labels(value)
+            self._by_value[value] = child
+        return child
+
+    def lines(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.kind]
+        for values in list(self._children):
+            pairs = list(zip(self.label_names, values))
+            lines += self._children[values].samples(self.name, pairs)
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.add(Metric(name, help, "counter", label_names))
+
+    def gauge(self, name, help, label_names=()):
+        return self.add(Metric(name, help, "gauge", label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.add(Metric(name, help, "histogram", label_names, buckets))
+
+    def exposition(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.lines()
+        return "\n".join(lines) + "\n"
+
+
+class BillingMetrics(object):
+    def __init__(self, stages=(), registry=None):
+        if registry is None:
+            registry = MetricsRegistry()
+        self.registry = registry
+        self.handler = registry.histogram("hbilling_handler_seconds", "Time spent in each role's entry handler.",
+                                          ["role"])
+        self.apply = registry.histogram("hbilling_apply_seconds",
+                                        "Time spent handing a claim on to the next stage.", ["role"])
+        self.time_in_stage = registry.histogram("hbilling_time_in_stage_seconds",
+                                                "Time claims waited in each stage queue.", ["stage"], WAIT_BUCKETS)
+        self.queue_depth = registry.gauge("hbilling_queue_depth", "Claims in each stage queue.", ["stage"])
+        self.settle = registry.histogram("hbilling_settle_seconds", "Time to settle one auditor batch.")
+        self.claims_settled = registry.counter("hbilling_claims_settled_total", "Claims settled.", ["code"])
+        self.amount_settled = registry.counter("hbilling_settled_amount_total", "Dollars settled.", ["code"])
+        self.balance = registry.gauge("hbilling_clinic_balance", "Clinic balance after the last settlement.")
+        # (stage, id(claim sheet)) -> time it entered the stage queue
+        #(keyed by stage too, because a role often hands on the same sheet it took)
+        self._entered = {}
+        for label, queue in stages:
+            self.watch(label, queue)
+
+    def watch(self, stage, queue):
+        """Report the length of a stage queue as its depth whenever the metrics are read."""
+        self.queue_depth.labels(stage).set_function(queue.__len__)
+
+    def handled(self, role, seconds):
+        self.handler.label(role).observe(seconds)
+
+    def applied(self, role, seconds):
+        self.apply.label(role).observe(seconds)
+
+    def entered(self, stage, sheet, now):
+        self._entered[(stage, id(sheet))] = now
+
+    def left(self, stage, sheet, now):
+        entered = self._entered.pop((stage, id(sheet)), None)
+        if entered is not None:
+            self.time_in_stage.label(stage).observe(now - entered)
+
+    def settled(self, code, amount, balance):
+        self.claims_settled.label(code).inc()
+        self.amount_settled.label(code).inc(amount)
+        self.balance.labels().set(balance)
+
+    def settle_time(self, seconds):
+        self.settle.labels().observe(seconds)
+
+
+def serve_metrics(registry, port, host="127.0.0.1"):
+    """Serve the metrics at http://host:port/metrics from a background thread; returns the server."""
+    #http.server is only imported when metrics are served, it is slow to import
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            #scrapes every few seconds would flood the terminal
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class FileExporter(object):
+    """Writes the metrics to a file every interval seconds, for node_exporter's textfile collector."""
+    def __init__(self, registry, filename, interval=EXPORT_INTERVAL):
+        self.registry = registry
+        self.filename = filename
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        #write then rename, so a reader never sees half a file
+        partial = self.filename + ".tmp"
+        with open(partial, "w") as metrics_file:
+            metrics_file.write(self.registry.exposition())
+        os.replace(partial, self.filename)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
@@ -0,0 +1,207 @@
+"""
+Decoded ID-photo cache for the hbilling reception flow.
+
+Every time a receptionist pressed "p", reception_entry built
+SimpleImage(image), which decodes the whole JPEG from disk again, even
+for a patient looked at a minute ago. PhotoCache keeps decoded photos
+(optionally shrunk to a display size) in least-recently-used order
+within a byte budget, drops a photo when its file's mtime changes, and
+counts hits and misses. The mtimes can come from a PhotoRegistry, so
+only photos it has on record are served. Photos are decoded by a backend (see
+BACKENDS) that is only imported on the first decode, and if Pillow is
+missing the cache hands out NoPhoto placeholders instead. prefetch() decodes a photo on a background
+thread, so the photo of the next patient in the waiting room is usually
+ready before the receptionist asks for it.
+
+Example:
+  cache = PhotoCache(byte_budget=64 * 1024 * 1024, max_size=(400, 400), mtime=registry.mtime)
+  cache.prefetch("images/fredflintstone.jpg")
+  photo = cache.get("images/fredflintstone.jpg")
+  photo.show()
+  cache.stats()      # {"hits": 1, "misses": 0, ...}
+"""
+
+import importlib
+import os
+import threading
+from collections import OrderedDict
+
+BYTE_BUDGET = 64 * 1024 * 1024
+#Pillow keeps an RGB pixel in 32 bits (the fourth byte is padding), so a decoded photo
+#takes width * height * 4 bytes
+BYTES_PER_PIXEL = 4
+
+#photo backends as "module:class"; the module is imported the first time a photo is decoded,
+#so starting hbilling does not load Pillow. Any other "module:class" works too.
+BACKENDS = {
+    "simpleimage": "simpleimage:SimpleImage",   # show() opens a viewer
+    "file": "simpleimage:FileImage",            # show() saves the photo into a folder
+    "none": "photocache:NoPhoto",               # no decoding and no Pillow; show() only says so
+}
+BACKEND = "simpleimage"
+
+
+class NoPhoto(object):
+    """Stands in for a photo when photos are turned off or Pillow is not installed."""
+    def __init__(self, filename, reason="photos are turned off"):
+        self.filename = filename
+        self.reason = reason
+        self.width = 0
+        self.height = 0
+
+    def shrink_to_fit(self, max_width, max_height):
+        pass
+
+    def show(self):
+        print("Photo not shown (" + self.reason + "): " + str(self.filename))
+
+
+def load_backend(name):
+    """Return the photo class for a backend name or "module:class" spec."""
+    spec = BACKENDS.get(name, name)
+    module_name, separator, class_name = spec.partition(":")
+    if not separator:
+        raise ValueError("photo backend must be one of " + ", ".join(BACKENDS) + " or module:class, got " + repr(name))
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def file_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+class PhotoCache(object):
+    def __init__(self, byte_budget=BYTE_BUDGET, max_size=None, mtime=file_mtime, backend=BACKEND):
+        self.byte_budget = byte_budget
+        self.max_size = max_size
+        self.backend = backend
+        #the backend's photo class, loaded on the first decode
+        self._photo_class = None
+        #filename -> mtime, or None if there is no such photo
+        self.mtime = mtime
+        # filename -> (mtime, photo, bytes), least recently used first
+        self._photos = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # filename -> Event set when its prefetch finishes
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._photos)
+
+    def __contains__(self, filename):
+        return filename in self._photos
+
+    @property
+    def bytes_used(self):
+        return self._bytes
+
+    def get(self, filename):
+        """Return the decoded photo for filename, decoding it only if it is not cached or has changed."""
+        mtime = self.mtime(filename)
+        if mtime is None:
+            raise FileNotFoundError(filename)
+        loading = self._loading.get(filename)
+        if loading is not None:
+            #a prefetch is decoding this photo right now, so wait for it instead of decoding twice
+            loading.wait()
+        with self._lock:
+            cached = self._photos.get(filename)
+            if cached is not None:
+                if cached[0] == mtime:
+                    self._photos.move_to_end(filename)
+                    self.hits += 1
+                    return cached[1]
+                self._drop(filename)
+                self.invalidations += 1
+            self.misses += 1
+        photo = self._decode(filename)
+        self._put(filename, mtime, photo)
+        return photo
+
+    def prefetch(self, filename):
+        """Start decoding a photo on a background thread if it is not cached already."""
+        if not filename:
+            return None
+        mtime = self.mtime(filename)
+        if mtime is None:
+            return None
+        with self._lock:
+            if filename in self._photos or filename in self._loading:
+                return None
+            done = threading.Event()
+            self._loading[filename] = done
+        thread = threading.Thread(target=self._prefetch, args=(filename, mtime, done), daemon=True)
+        thread.start()
+        return thread
+
+    def invalidate(self, filename):
+        with self._lock:
+            if filename in self._photos:
+                self._drop(filename)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._photos.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "photos": len(self._photos),
+            "bytes": self._bytes,
+        }
+
+    def _prefetch(self, filename, mtime, done):
+        try:
+            self._put(filename, mtime, self._decode(filename))
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._loading.pop(filename, None)
+            done.set()
+
+    def photo_class(self):
+        if self._photo_class is None:
+            try:
+                self._photo_class = load_backend(self.backend)
+            except ImportError as error:
+                #no Pillow (or no such module): keep going without photos
+                reason = "the " + self.backend + " photo backend is not available: " + str(error)
+                self._photo_class = lambda filename: NoPhoto(filename, reason)
+        return self._photo_class
+
+    def _decode(self, filename):
+        photo = self.photo_class()(filename)
+        if self.max_size is not None:
+            photo.shrink_to_fit(self.max_size[0], self.max_size[1])
+        return photo
+
+    def _put(self, filename, mtime, photo):
+        size = photo.width * photo.height * BYTES_PER_PIXEL
+        with self._lock:
+            if filename in self._photos:
+                self._drop(filename)
+            if size > self.byte_budget:
+                return
+            self._photos[filename] = (mtime, photo, size)
+            self._bytes += size
+            while self._bytes > self.byte_budget:
+                oldest = next(iter(self._photos))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, filename):
+        mtime, photo, size = self._photos.pop(filename)
+        self._bytes -= size
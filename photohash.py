@@ -0,0 +1,236 @@
+"""
+Perceptual-hash index of patient ID photos.
+
+Identity checks in reception_entry rely on a person looking at the photo
+and on comparing pid + last name strings. PhotoHashIndex hashes every
+photo in the photo store with a 64-bit perceptual hash (dHash, or aHash)
+and files the hashes in a multi-index, so "which photos look like this
+one" is a Hamming-distance query that only compares a few candidates.
+That lets us flag one face registered under several identities across
+hundreds of thousands of photos without comparing every pair.
+
+Hashing decodes each photo at a reduced size (JPEG draft mode) and runs
+in a process pool.
+
+Example:
+  index = PhotoHashIndex(max_distance=6)
+  index.add_photos(["images/fredflintstone.jpg", "images/fredflint.jpg"])
+  index.matches(dhash("images/fredflintstone.jpg"), max_distance=6)
+  index.duplicates(max_distance=6)     # [["fredflint", "fredflintstone"]]
+
+Usage:
+  python photohash.py images            # list faces found under more than one identity
+  python photohash.py images 8          # ... allowing 8 differing bits
+"""
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# If the following line fails, "Pillow" needs to be installed
+from PIL import Image
+
+HASH_SIZE = 8
+MAX_DISTANCE = 6
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def _small_gray(filename, width, height):
+    image = Image.open(filename)
+    #let the JPEG decoder skip most of the work, we only need a few pixels
+    image.draft("L", (width * 8, height * 8))
+    return image.convert("L").resize((width, height), Image.LANCZOS)
+
+
+def dhash(filename, hash_size=HASH_SIZE):
+    """Difference hash: one bit per pixel, set when it is brighter than its right neighbour."""
+    pixels = _small_gray(filename, hash_size + 1, hash_size).tobytes()
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def ahash(filename, hash_size=HASH_SIZE):
+    """Average hash: one bit per pixel, set when it is brighter than the mean."""
+    pixels = _small_gray(filename, hash_size, hash_size).tobytes()
+    mean = sum(pixels) / len(pixels)
+    value = 0
+    for pixel in pixels:
+        value = (value << 1) | (pixel > mean)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def photo_identity(filename):
+    """The identity a photo is filed under: its file name without folder or extension."""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def find_photos(folder):
+    """Yield every photo file under folder, including sharded subfolders."""
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            yield from find_photos(entry.path)
+        elif entry.name.lower().endswith(PHOTO_EXTENSIONS):
+            yield entry.path
+
+
+def _hash_one(args):
+    filename, hash_function = args
+    try:
+        return filename, hash_function(filename)
+    except (OSError, ValueError):
+        return filename, None
+
+
+def hash_photos(filenames, hash_function=dhash, workers=None, chunksize=64):
+    """Hash photos in a process pool; yields (filename, hash), hash None if unreadable."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = ((filename, hash_function) for filename in filenames)
+        for result in pool.map(_hash_one, jobs, chunksize=chunksize):
+            yield result
+
+
+class MultiIndex(object):
+    """
+    Multi-index hashing over 64-bit hashes. Each hash is cut into
+    max_distance + 1 chunks and filed under every chunk. Two hashes that
+    differ in at most max_distance bits must agree exactly on at least one
+    chunk, so a query only compares against the hashes sharing a chunk
+    with it instead of against every hash.
+    """
+    def __init__(self, max_distance=MAX_DISTANCE, bits=HASH_SIZE * HASH_SIZE):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        # (shift, mask) for every chunk
+        self.chunks = []
+        shift = 0
+        for i in range(chunks):
+            width = bits // chunks + (1 if i < bits % chunks else 0)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        # one table per chunk: chunk value -> list of hashes
+        self.tables = [{} for chunk in self.chunks]
+        self.values = set()
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        """Add a hash; returns False if it was already in the index."""
+        if value in self.values:
+            return False
+        self.values.add(value)
+        for i in range(len(self.chunks)):
+            shift, mask = self.chunks[i]
+            self.tables[i].setdefault((value >> shift) & mask, []).append(value)
+        return True
+
+    def query(self, value, max_distance=None):
+        """Return [(distance, hash)] for every hash within max_distance of value."""
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        candidates = set()
+        for i in range(len(self.chunks)):
+            shift, mask = self.chunks[i]
+            candidates.update(self.tables[i].get((value >> shift) & mask, ()))
+        found = []
+        for candidate in candidates:
+            distance = hamming(value, candidate)
+            if distance <= max_distance:
+                found.append((distance, candidate))
+        return found
+
+
+class PhotoHashIndex(object):
+    def __init__(self, hash_function=dhash, max_distance=MAX_DISTANCE):
+        self.hash_function = hash_function
+        self.hash_index = MultiIndex(max_distance)
+        # hash -> set of identities with a photo with that hash
+        self.identities = {}
+        # identity -> hash
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, identity, value):
+        old = self.hashes.get(identity)
+        if old is not None:
+            self.identities[old].discard(identity)
+        self.hashes[identity] = value
+        self.hash_index.add(value)
+        self.identities.setdefault(value, set()).add(identity)
+
+    def add_photos(self, filenames, workers=None, identity=photo_identity):
+        """Hash photos in a process pool and add them; returns the unreadable files."""
+        unreadable = []
+        for filename, value in hash_photos(filenames, self.hash_function, workers):
+            if value is None:
+                unreadable.append(filename)
+            else:
+                self.add(identity(filename), value)
+        return unreadable
+
+    def matches(self, value, max_distance=None):
+        """Return [(distance, identity)] for every photo that looks like the hash, closest first."""
+        found = []
+        for distance, match in self.hash_index.query(value, max_distance):
+            for identity in self.identities.get(match, ()):
+                found.append((distance, identity))
+        found.sort()
+        return found
+
+    def duplicates(self, max_distance=None):
+        """Return groups of identities whose photos are within max_distance of each other."""
+        parent = {}
+
+        def find(identity):
+            while parent.get(identity, identity) != identity:
+                identity = parent[identity]
+            return identity
+
+        for value in self.identities:
+            here = sorted(self.identities[value])
+            if not here:
+                continue
+            for distance, match in self.hash_index.query(value, max_distance):
+                for identity in self.identities.get(match, ()):
+                    if identity != here[0]:
+                        parent[find(identity)] = find(here[0])
+            for identity in here[1:]:
+                parent[find(identity)] = find(here[0])
+        groups = {}
+        for identity in self.hashes:
+            groups.setdefault(find(identity), []).append(identity)
+        return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) not in (1, 2):
+        print("Usage: python photohash.py photo_folder [max_distance]")
+        return
+    max_distance = MAX_DISTANCE
+    if len(args) == 2:
+        max_distance = int(args[1])
+    index = PhotoHashIndex(max_distance=max_distance)
+    unreadable = index.add_photos(find_photos(args[0]))
+    print("Photos hashed: " + str(len(index)))
+    for filename in unreadable:
+        print("Could not read " + filename)
+    groups = index.duplicates(max_distance)
+    for group in groups:
+        print("Same face under: " + ", ".join(group))
+    print("Faces under more than one identity: " + str(len(groups)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Registry of patient ID photos.
+
+reception_entry used to build "images/" + first + last + ".jpg" and
+compare it with four hard-coded file names, so every other patient got
+"No photo available." PhotoRegistry scans the photo folder once into two
+dicts, one keyed by pid and one keyed by normalized name, so finding a
+patient's photo is a dict lookup with no stat of the photo file.
+
+A photo's file name says who it belongs to:
+  fredflintstone.jpg           by name
+  1234.jpg                     by pid
+  1234_fred_flintstone.jpg     by pid and by name
+Upper case, spaces, dashes and underscores in names are ignored.
+
+Photos can sit in shard folders (see shard_path), so no folder has to
+hold hundreds of thousands of files:
+  images/3f/1234_fredflintstone.jpg
+
+The registry refreshes itself at most every max_age seconds. A refresh
+only stats the folders; folders whose mtime has not changed (no photo
+added or removed) are not listed again. Overwriting a photo in place
+does not change its folder's mtime, so mtime() stats the photo itself.
+
+Example:
+  registry = PhotoRegistry("images")
+  registry.photo_for(sheet)                              # "images/fredflintstone.jpg" or None
+  registry.find(pid="1234", first="Fred", last="Flintstone")
+
+Usage:
+  python photoregistry.py images             # scan the folder and show what was found
+  python photoregistry.py shard images       # move photos into shard folders
+"""
+
+import os
+import sys
+import time
+import zlib
+
+PHOTO_FOLDER = "images"
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png")
+#seconds before a lookup rescans the photo folders
+MAX_AGE = 30
+SHARDS = 256
+
+
+def normalize_name(name):
+    """Lower case letters and digits only, so "Fred Flintstone" and "fred_flintstone" match."""
+    return "".join(c for c in str(name).lower() if c.isalnum())
+
+
+def photo_keys(filename):
+    """Return (pid, name) for a photo file, either may be None."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    pid = None
+    name_parts = []
+    for part in stem.replace("-", "_").split("_"):
+        if part.isdigit() and pid is None and not name_parts:
+            pid = part
+        else:
+            name_parts.append(part)
+    name = normalize_name("".join(name_parts)) or None
+    return pid, name
+
+
+def shard_path(folder, filename, shards=SHARDS):
+    """Where a photo belongs in a sharded folder: folder/<shard>/filename."""
+    pid, name = photo_keys(filename)
+    key = pid if pid is not None else (name or "")
+    shard = zlib.crc32(key.encode()) % shards
+    return os.path.join(folder, format(shard, "02x"), os.path.basename(filename))
+
+
+class PhotoRegistry(object):
+    def __init__(self, folder=PHOTO_FOLDER, max_age=MAX_AGE):
+        self.folder = folder
+        self.max_age = max_age
+        # folder -> (mtime, photo files in it, subfolders in it)
+        self._folders = {}
+        # photo file -> (mtime, pid, name)
+        self._files = {}
+        self._by_pid = {}
+        self._by_name = {}
+        self._scanned = None
+        self.scans = 0
+        self.folders_listed = 0
+
+    def __len__(self):
+        self._maybe_refresh()
+        return len(self._files)
+
+    def __contains__(self, filename):
+        self._maybe_refresh()
+        return filename in self._files
+
+    def find(self, pid=None, first="", last="", name=None):
+        """Return the photo file for a pid, or failing that for a name, or None."""
+        self._maybe_refresh()
+        if pid is not None:
+            filename = self._by_pid.get(str(pid))
+            if filename is not None:
+                return filename
+        if name is None:
+            name = str(first) + str(last)
+        return self._by_name.get(normalize_name(name))
+
+    def photo_for(self, sheet):
+        return self.find(sheet.pid, sheet.first, sheet.last)
+
+    def mtime(self, filename):
+        """The photo file's mtime now, or None if it is not a photo on file or has gone."""
+        self._maybe_refresh()
+        entry = self._files.get(filename)
+        if entry is None:
+            return None
+        #a photo overwritten in place leaves its folder's mtime alone, so the folder scan cannot see it
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != entry[0]:
+            self._files[filename] = (mtime, entry[1], entry[2])
+        return mtime
+
+    def refresh(self):
+        """Bring the registry up to date, only listing folders that changed since the last scan."""
+        self.scans += 1
+        self._refresh_folder(self.folder)
+        self._scanned = time.monotonic()
+
+    def stats(self):
+        return {
+            "photos": len(self._files),
+            "by pid": len(self._by_pid),
+            "by name": len(self._by_name),
+            "folders": len(self._folders),
+            "scans": self.scans,
+            "folders listed": self.folders_listed,
+        }
+
+    def _maybe_refresh(self):
+        if self._scanned is None or time.monotonic() - self._scanned > self.max_age:
+            self.refresh()
+
+    def _refresh_folder(self, folder):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            self._forget_folder(folder)
+            return
+        known = self._folders.get(folder)
+        if known is not None and known[0] == mtime:
+            #nothing was added, removed or replaced here, but a subfolder may have changed
+            for subfolder in known[2]:
+                self._refresh_folder(subfolder)
+            return
+        self.folders_listed += 1
+        files = set()
+        subfolders = set()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.add(entry.path)
+            elif entry.name.lower().endswith(PHOTO_EXTENSIONS):
+                files.add(entry.path)
+                self._add(entry.path, entry.stat().st_mtime_ns)
+        if known is not None:
+            for filename in known[1] - files:
+                self._remove(filename)
+            for subfolder in known[2] - subfolders:
+                self._forget_folder(subfolder)
+        self._folders[folder] = (mtime, files, subfolders)
+        for subfolder in subfolders:
+            self._refresh_folder(subfolder)
+
+    def _forget_folder(self, folder):
+        known = self._folders.pop(folder, None)
+        if known is None:
+            return
+        for filename in known[1]:
+            self._remove(filename)
+        for subfolder in known[2]:
+            self._forget_folder(subfolder)
+
+    def _add(self, filename, mtime):
+        if filename in self._files:
+            self._remove(filename)
+        pid, name = photo_keys(filename)
+        self._files[filename] = (mtime, pid, name)
+        if pid is not None:
+            self._by_pid[pid] = filename
+        if name is not None:
+            self._by_name[name] = filename
+
+    def _remove(self, filename):
+        mtime, pid, name = self._files.pop(filename)
+        if pid is not None and self._by_pid.get(pid) == filename:
+            del self._by_pid[pid]
+        if name is not None and self._by_name.get(name) == filename:
+            del self._by_name[name]
+
+
+def shard_folder(folder, shards=SHARDS):
+    """Move the photos directly inside folder into shard folders; returns how many were moved."""
+    moved = 0
+    for entry in list(os.scandir(folder)):
+        if entry.is_file() and entry.name.lower().endswith(PHOTO_EXTENSIONS):
+            destination = shard_path(folder, entry.name, shards)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(entry.path, destination)
+            moved += 1
+    return moved
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) == 2 and args[0] == "shard":
+        print("Photos moved into shard folders: " + str(shard_folder(args[1])))
+        return
+    if len(args) != 1:
+        print("Usage: python photoregistry.py photo_folder | python photoregistry.py shard photo_folder")
+        return
+    registry = PhotoRegistry(args[0])
+    start = time.perf_counter()
+    registry.refresh()
+    scan_time = time.perf_counter() - start
+    start = time.perf_counter()
+    registry.refresh()
+    refresh_time = time.perf_counter() - start
+    stats = registry.stats()
+    for key in stats:
+        print(key + ": " + str(stats[key]))
+    print("First scan: " + str(round(scan_time, 3)) + " seconds")
+    print("Refresh with nothing changed: " + str(round(refresh_time, 3)) + " seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Materialized rollups of settled claims for hbilling queries.
+
+The introduction lists "Query" and "Audit" among the user activities, but
+the only way to see anything was the dumps printed by main(). Rollups
+keeps totals by procedure code, insurer, clinic and day, and each
+patient's spend, and updates them as the auditor settles each claim, so
+a question like "how much has Medicaid paid this week" or "who are our
+ten biggest patients" is answered from the totals instead of by reading
+every claim again:
+  code_total, insurer_total, clinic_total, day_total   O(1)
+  days_between                                         O(log days) + the days returned
+  top_patients(n)                                      O(k log k), k = top_size
+
+Each rollup remembers the ledger sequence number it covers, so after a
+restart catch_up() only replays the payments settled since it was saved.
+
+Example:
+  rollups = Rollups.load("hbilling.rollups")
+  rollups.catch_up(payment_register, INS1, CLC1)
+  rollups.settle("12", "1111", 1001, INS1, CLC1, seq=0)
+  rollups.code_total("1111")            # (claims, dollars)
+  rollups.top_patients(10)              # [(pid, dollars), ...] biggest first
+  rollups.save("hbilling.rollups")
+"""
+
+import heapq
+import json
+import os
+import time
+from bisect import bisect_left, bisect_right, insort
+
+TOP_SIZE = 100
+
+
+def today():
+    return time.strftime("%Y-%m-%d")
+
+
+class TopSpenders(object):
+    """
+    The top_size patients by total spend. Totals only grow, so a patient
+    outside the top can only get in by passing the smallest total in it,
+    and a min-heap (with stale entries skipped lazily) finds that total.
+    """
+    def __init__(self, top_size=TOP_SIZE):
+        self.top_size = top_size
+        # pid -> total, for the patients in the top
+        self.members = {}
+        # (total, pid), including stale entries for members whose total has grown
+        self._heap = []
+
+    def __len__(self):
+        return len(self.members)
+
+    def update(self, pid, total):
+        """Record a patient's new total (never lower than before)."""
+        if pid in self.members:
+            self.members[pid] = total
+            heapq.heappush(self._heap, (total, pid))
+            if len(self._heap) > 4 * self.top_size:
+                self._compact()
+        elif len(self.members) < self.top_size:
+            self.members[pid] = total
+            heapq.heappush(self._heap, (total, pid))
+        elif total > self._smallest()[0]:
+            smallest, evicted = heapq.heappop(self._heap)
+            del self.members[evicted]
+            self.members[pid] = total
+            heapq.heappush(self._heap, (total, pid))
+
+    def top(self, n):
+        ranked = sorted(self.members.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:n]
+
+    def _smallest(self):
+        while self.members.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def _compact(self):
+        self._heap = [(total, pid) for pid, total in self.members.items()]
+        heapq.heapify(self._heap)
+
+
+class Rollups(object):
+    def __init__(self, top_size=TOP_SIZE):
+        # key -> [claims, dollars]
+        self.by_code = {}
+        self.by_insurer = {}
+        self.by_clinic = {}
+        self.by_day = {}
+        # the days in by_day, in order
+        self.days = []
+        # pid -> dollars
+        self.by_pid = {}
+        self.top = TopSpenders(top_size)
+        self.claims = 0
+        self.total = 0
+        #the next ledger sequence number not yet counted
+        self.through_seq = 0
+
+    def settle(self, pid, code, amount, insurer=None, clinic=None, day=None, seq=None):
+        """Count one settled claim in every rollup."""
+        pid = str(pid)
+        amount = int(amount)
+        if day is None:
+            day = today()
+        for rollup, key in ((self.by_code, str(code)), (self.by_insurer, insurer), (self.by_clinic, clinic)):
+            totals = rollup.get(key)
+            if totals is None:
+                rollup[key] = [1, amount]
+            else:
+                totals[0] += 1
+                totals[1] += amount
+        totals = self.by_day.get(day)
+        if totals is None:
+            self.by_day[day] = [1, amount]
+            insort(self.days, day)
+        else:
+            totals[0] += 1
+            totals[1] += amount
+        spend = self.by_pid.get(pid, 0) + amount
+        self.by_pid[pid] = spend
+        self.top.update(pid, spend)
+        self.claims += 1
+        self.total += amount
+        if seq is not None:
+            self.through_seq = max(self.through_seq, seq + 1)
+
+    def catch_up(self, payment_register, insurer=None, clinic=None):
+        """
+        Count the payments in the ledger that were settled after these rollups
+        were saved. The ledger does not record accounts or dates, so they are
+        counted under the given insurer and clinic and today's date. Returns
+        how many were counted.
+        """
+        counted = 0
+        for payment in payment_register.history(self.through_seq):
+            self.settle(payment["pid"], payment["code"], payment["amount"], insurer, clinic, seq=payment["seq"])
+            counted += 1
+        return counted
+
+    def code_total(self, code):
+        return tuple(self.by_code.get(str(code), (0, 0)))
+
+    def insurer_total(self, insurer):
+        return tuple(self.by_insurer.get(insurer, (0, 0)))
+
+    def clinic_total(self, clinic):
+        return tuple(self.by_clinic.get(clinic, (0, 0)))
+
+    def day_total(self, day):
+        return tuple(self.by_day.get(day, (0, 0)))
+
+    def days_between(self, first, last):
+        """[(day, claims, dollars)] for every day from first to last (YYYY-MM-DD), inclusive."""
+        start = bisect_left(self.days, first)
+        stop = bisect_right(self.days, last)
+        return [(day, self.by_day[day][0], self.by_day[day][1]) for day in self.days[start:stop]]
+
+    def patient_total(self, pid):
+        return self.by_pid.get(str(pid), 0)
+
+    def top_patients(self, n=10):
+        """[(pid, dollars)] for the n biggest patients (n up to top_size), biggest first."""
+        return self.top.top(n)
+
+    def save(self, filename):
+        #write then rename, so a crash never leaves half a file
+        state = {
+            "by_code": self.by_code,
+            "by_insurer": [[key, totals] for key, totals in self.by_insurer.items()],
+            "by_clinic": [[key, totals] for key, totals in self.by_clinic.items()],
+            "by_day": self.by_day,
+            "by_pid": self.by_pid,
+            "claims": self.claims,
+            "total": self.total,
+            "through_seq": self.through_seq,
+            "top_size": self.top.top_size,
+        }
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as rollup_file:
+            json.dump(state, rollup_file)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, top_size=TOP_SIZE):
+        """Load saved rollups, or start empty ones if the file does not exist."""
+        if not os.path.exists(filename):
+            return cls(top_size)
+        with open(filename) as rollup_file:
+            state = json.load(rollup_file)
+        rollups = cls(state.get("top_size", top_size))
+        rollups.by_code = state["by_code"]
+        rollups.by_insurer = {key: totals for key, totals in state["by_insurer"]}
+        rollups.by_clinic = {key: totals for key, totals in state["by_clinic"]}
+        rollups.by_day = state["by_day"]
+        rollups.days = sorted(rollups.by_day)
+        rollups.by_pid = state["by_pid"]
+        for pid in rollups.by_pid:
+            rollups.top.update(pid, rollups.by_pid[pid])
+        rollups.claims = state["claims"]
+        rollups.total = state["total"]
+        rollups.through_seq = state["through_seq"]
+        return rollups
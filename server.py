@@ -0,0 +1,328 @@
+"""
+Multi-terminal service mode for hbilling.
+
+main() is one loop around blocking input(), so a receptionist can't
+admit while a clinician is coding. BillingServer keeps the stage queues
+in one asyncio process and lets every role connect over a local socket
+and work at the same time.
+
+Each request is one line of JSON and gets one line of JSON back:
+  {"role": "patient", "pid": "12", "first": "Fred", "last": "Flintstone", "complaint": "foot pain"}
+  {"role": "receptionist", "cid": "12", "complaint": "foot pain", "code": "1111", "priority": "soon"}
+  {"role": "clinician", "code": "1111"}
+  {"role": "insurer", "code": "1111"}
+  {"role": "auditor", "code": "1111"}
+  {"role": "status"}
+The reply is {"ok": true, "sheet": [...]} with the sheet the role worked on,
+plus "payment", "balance" and the patient's "patient_total" over all
+their visits for the auditor. An auditor's reply is only sent once the
+payment is committed to the ledger; settlements that arrive together
+share one commit. Fields a role leaves out keep the value the sheet
+already has, like pressing Enter at the prompt.
+
+Roles after the patient take the next claim from their stage queue, by
+triage class with aging (see triage.py); the receptionist's optional
+"priority" (urgent, soon or routine) overrides the class the complaint
+gives. If the queue is empty the request waits until a claim arrives (or
+fails right away with "wait": false). Taking a claim from one queue and
+handing it to the next happens with no await in between, so two
+clinicians can never take the same claim.
+
+Usage:
+  python server.py                          # serve on 127.0.0.1:8421
+  HBILLING_METRICS_PORT=9464 python server.py      # ... with metrics at 127.0.0.1:9464/metrics
+  python server.py loadtest                 # 200 clients per role against localhost
+  python server.py loadtest 500 20          # 500 clients per role, 20 claims each
+"""
+
+import asyncio
+import json
+import sys
+import time
+
+import hbilling
+from ledger import PaymentLedger, pid_fits, PID_BYTES
+from metrics import BillingMetrics, serve_metrics
+from invoicing import InvoiceBook
+from triage import TriageQueue, CLASSES
+
+HOST = "127.0.0.1"
+PORT = 8421
+
+ROLES = ["patient", "receptionist", "clinician", "insurer", "auditor"]
+
+
+class BillingServer(object):
+    def __init__(self, payment_register=None):
+        self.waiting_room = TriageQueue("waiting room")
+        self.patients_for_processing = TriageQueue("sent to treatment")
+        self.patients_in_treatment = TriageQueue("treated")
+        self.insured_for_auditing = TriageQueue("insured for auditing")
+        self.payment_register = payment_register
+        if payment_register is not None:
+            self.current_balance = payment_register.balance
+        else:
+            self.current_balance = int(hbilling.INITIAL_CLINIC_BALANCE)
+        self.settled = 0
+        self.invoices = InvoiceBook()
+        self._arrivals = {}
+        #futures of the settlements waiting for the next ledger commit
+        self._commit_waiters = None
+        self.metrics = BillingMetrics([("waiting", self.waiting_room),
+                                       ("to treatment", self.patients_for_processing),
+                                       ("treated", self.patients_in_treatment),
+                                       ("for auditing", self.insured_for_auditing)])
+
+    def _arrival(self, queue):
+        #one condition per queue, created lazily so it binds to the running loop
+        condition = self._arrivals.get(queue.name)
+        if condition is None:
+            condition = asyncio.Condition()
+            self._arrivals[queue.name] = condition
+        return condition
+
+    async def _hand_on(self, queue, sheet):
+        queue.append(sheet)
+        self.metrics.entered(queue.name, sheet, time.perf_counter())
+        condition = self._arrival(queue)
+        async with condition:
+            condition.notify()
+
+    async def _durable(self):
+        """
+        Wait until the settlements appended so far are committed to the ledger.
+        Every auditor that settles before the commit runs shares its fsync.
+        """
+        if self.payment_register is None:
+            return
+        loop = asyncio.get_running_loop()
+        if self._commit_waiters is None:
+            self._commit_waiters = []
+            loop.call_soon(self._commit)
+        waiter = loop.create_future()
+        self._commit_waiters.append(waiter)
+        await waiter
+
+    def _commit(self):
+        waiters = self._commit_waiters
+        self._commit_waiters = None
+        try:
+            self.payment_register.commit()
+        except OSError as error:
+            for waiter in waiters:
+                waiter.set_exception(error)
+            return
+        for waiter in waiters:
+            waiter.set_result(None)
+
+    async def _take(self, queue, wait=True):
+        condition = self._arrival(queue)
+        async with condition:
+            while not queue:
+                if not wait:
+                    return None
+                await condition.wait()
+            sheet = queue.popleft()
+            self.metrics.left(queue.name, sheet, time.perf_counter())
+            return sheet
+
+    async def handle(self, request):
+        """Run one role request and return the reply dict."""
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "a request must be a JSON object, not " + type(request).__name__}
+        started = time.perf_counter()
+        reply = await self._handle(request)
+        if request.get("role") in ROLES:
+            #includes the time a role waited for a claim to arrive
+            self.metrics.handled(request["role"], time.perf_counter() - started)
+        return reply
+
+    async def _handle(self, request):
+        role = request.get("role")
+        wait = request.get("wait", True)
+        if role == "status":
+            return {"ok": True, "counts": self.counts(), "balance": self.current_balance, "settled": self.settled}
+        if role == "patient":
+            if not pid_fits(request.get("pid", "")):
+                return {"ok": False, "error": "ID number is longer than " + str(PID_BYTES) + " bytes"}
+            sheet = hbilling.new_admit_sheet(str(request.get("pid", "")), str(request.get("first", "")),
+                                             str(request.get("last", "")), str(request.get("complaint", "")))
+            await self._hand_on(self.waiting_room, sheet)
+            return {"ok": True, "sheet": list(sheet)}
+        stages = {
+            "receptionist": (self.waiting_room, self.patients_for_processing),
+            "clinician": (self.patients_for_processing, self.patients_in_treatment),
+            "insurer": (self.patients_in_treatment, self.insured_for_auditing),
+            "auditor": (self.insured_for_auditing, None),
+        }
+        if role not in stages:
+            return {"ok": False, "error": "unknown role " + repr(role)}
+        source, destination = stages[role]
+        sheet = await self._take(source, wait)
+        if sheet is None:
+            return {"ok": False, "error": "no patients waiting for the " + role}
+
+        if role == "receptionist":
+            cid = str(request.get("cid", sheet.pid))
+            if not hbilling.identity_matches(sheet.pid, sheet.last, cid, sheet.last):
+                #send the claim to the back of the waiting room so it can be confirmed again
+                await self._hand_on(source, sheet)
+                return {"ok": False, "error": "ID number does not match", "sheet": list(sheet)}
+            sheet.pid = cid
+            if "complaint" in request:
+                sheet.complaint = str(request["complaint"])
+            sheet.code = str(request.get("code", "0000"))
+            if request.get("priority") in CLASSES:
+                sheet.priority = request["priority"]
+        elif role == "auditor" and str(request.get("code", sheet.code)) not in hbilling.PAYMENT_CODES:
+            #send the claim back for auditing with the code it had, so it is not lost
+            await self._hand_on(source, sheet)
+            return {"ok": False, "error": "unknown code " + str(request.get("code", sheet.code)),
+                    "sheet": list(sheet)}
+        elif "code" in request:
+            sheet.code = str(request["code"])
+
+        if destination is not None:
+            await self._hand_on(destination, sheet)
+            return {"ok": True, "sheet": list(sheet)}
+
+        #the auditor settles the claim
+        payment = hbilling.service_payment(sheet.code)
+        self.invoices.add(sheet.pid, sheet.code, payment, hbilling.DEFAULT_INSURER, hbilling.DEFAULT_CLINIC)
+        #the claim is paid right away, so it does not stay in the unpaid list
+        self.invoices.take_unpaid()
+        if self.payment_register is not None:
+            self.payment_register.append(sheet.code, payment, pid=sheet.pid)
+            self.current_balance = self.payment_register.balance
+        else:
+            self.current_balance += payment
+        self.settled += 1
+        self.metrics.settled(sheet.code, payment, self.current_balance)
+        reply = {"ok": True, "sheet": list(sheet), "payment": payment, "balance": self.current_balance,
+                 "patient_total": self.invoices.pid_total(sheet.pid)}
+        #the reply tells the client the claim is paid, so it waits until the payment is on disk
+        await self._durable()
+        return reply
+
+    def counts(self):
+        return {
+            "waiting": len(self.waiting_room),
+            "to treatment": len(self.patients_for_processing),
+            "treated": len(self.patients_in_treatment),
+            "for auditing": len(self.insured_for_auditing),
+        }
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    reply = await self.handle(request)
+                except ValueError as error:
+                    reply = {"ok": False, "error": str(error)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if self.payment_register is not None:
+                self.payment_register.commit()
+            writer.close()
+
+    async def start(self, host=HOST, port=PORT):
+        return await asyncio.start_server(self.serve_client, host, port, limit=2 ** 20)
+
+
+async def serve(host=HOST, port=PORT):
+    payment_register = PaymentLedger(hbilling.PAYMENT_LEDGER_FILE, initial_balance=hbilling.INITIAL_CLINIC_BALANCE)
+    billing = BillingServer(payment_register)
+    server = await billing.start(host, port)
+    print("hbilling server listening on " + host + ":" + str(port))
+    if hbilling.METRICS_PORT:
+        serve_metrics(billing.metrics.registry, int(hbilling.METRICS_PORT))
+        print("metrics at http://127.0.0.1:" + str(hbilling.METRICS_PORT) + "/metrics")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        payment_register.close()
+
+
+async def client(host, port, requests):
+    """Send a list of requests over one connection and return the replies."""
+    reader, writer = await asyncio.open_connection(host, port)
+    replies = []
+    for request in requests:
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        replies.append(json.loads(await reader.readline()))
+    writer.close()
+    await writer.wait_closed()
+    return replies
+
+
+async def load_test(clients_per_role=200, claims_per_client=10):
+    """
+    Start a server on a free localhost port, run clients_per_role clients for
+    every role at once, and check that every claim was settled exactly once.
+    """
+    billing = BillingServer()
+    server = await billing.start(HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+    codes = list(hbilling.PAYMENT_CODES)
+    jobs = []
+    expected_balance = 0
+    for c in range(clients_per_role):
+        admits = []
+        for i in range(claims_per_client):
+            pid = str(c * claims_per_client + i)
+            admits.append({"role": "patient", "pid": pid, "first": "Fred", "last": "Flintstone",
+                           "complaint": "foot pain"})
+        jobs.append(client(HOST, port, admits))
+        code = codes[c % len(codes)]
+        for role in ["receptionist", "clinician", "insurer"]:
+            jobs.append(client(HOST, port, [{"role": role, "code": code}] * claims_per_client))
+        jobs.append(client(HOST, port, [{"role": "auditor"}] * claims_per_client))
+    start = time.perf_counter()
+    results = await asyncio.gather(*jobs)
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+
+    failures = sum(1 for replies in results for reply in replies if not reply["ok"])
+    settled_pids = [reply["sheet"][0] for replies in results for reply in replies if "payment" in reply]
+    for reply in [reply for replies in results for reply in replies if "payment" in reply]:
+        expected_balance += hbilling.PAYMENT_CODES[reply["sheet"][4]]
+    total = clients_per_role * claims_per_client
+    passed = (failures == 0 and billing.settled == total and len(set(settled_pids)) == total
+              and billing.current_balance == expected_balance)
+    print("Clients: " + str(clients_per_role * len(ROLES)) + " (" + str(clients_per_role) + " per role)")
+    print("Claims settled: " + str(billing.settled) + " of " + str(total) + " in " + str(round(elapsed, 2)) + " seconds")
+    print("Requests per second: " + str(int(total * len(ROLES) / elapsed)))
+    print("Claims per second: " + str(int(total / elapsed)))
+    print("Balance: $" + str(billing.current_balance))
+    return passed
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "loadtest":
+        clients_per_role = 200
+        claims_per_client = 10
+        if len(args) > 1:
+            clients_per_role = int(args[1])
+        if len(args) > 2:
+            claims_per_client = int(args[2])
+        if not asyncio.run(load_test(clients_per_role, claims_per_client)):
+            print("LOAD TEST FAILED")
+            sys.exit(1)
+        print("LOAD TEST PASSED")
+    else:
+        asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
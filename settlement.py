@@ -0,0 +1,226 @@
+"""
+Batch settlement for hbilling.
+
+process_payment() settles one invoice at a time: a dict lookup in
+PAYMENT_CODES, a printed line, and an addition to the balance.
+For month-end runs settle_batch() takes arrays of audited codes
+(optionally with the insurer and clinic of each claim), maps them to
+dense integer ids, and computes every amount and the per-account totals
+in one NumPy pass. Unknown codes are reported together instead of
+raising KeyError one claim at a time. Codes are keyed by code_key, so
+0 and "0000" are the same code.
+
+Example:
+  result = settle_batch(["1111", "2222", "9999"],
+                        insurers=[INS1, INS1, INS2], clinics=[CLC1, CLC2, CLC1])
+  result["total"]        # 3003
+  result["by_clinic"]    # {CLC1: 1001, CLC2: 2002}
+  result["unknown"]      # {"9999": 1}
+
+Running this file benchmarks a million invoices against the per-claim path:
+  python settlement.py
+  python settlement.py 5000000
+"""
+
+import random
+import sys
+import time
+from collections import defaultdict
+
+# If the following line fails, "numpy" needs to be installed
+import numpy as np
+
+import hbilling
+
+
+#service codes are four digits, so a code given as the integer 0 is "0000"
+CODE_DIGITS = 4
+
+
+def code_key(code):
+    """The PAYMENT_CODES key for a code given as a string or an integer."""
+    if isinstance(code, (int, np.integer)):
+        return str(int(code)).zfill(CODE_DIGITS)
+    return str(code)
+
+
+def dense_ids(keys):
+    """
+    Map a sequence of keys to dense integer ids. Returns (unique_keys, ids)
+    where unique_keys[ids[i]] == keys[i]; the keys are returned as given
+    (integers stay integers).
+    """
+    if isinstance(keys, np.ndarray) and keys.dtype.kind in "iu":
+        unique_keys, ids = np.unique(keys, return_inverse=True)
+        return unique_keys.tolist(), ids.reshape(-1)
+    #a missing key gets the next id from the dict's own length, so one pass of C-level
+    #lookups both finds the distinct keys and numbers every claim
+    index = defaultdict()
+    index.default_factory = index.__len__
+    ids = np.fromiter(map(index.__getitem__, keys), dtype=np.intp, count=len(keys))
+    return list(index), ids
+
+
+def code_ids(codes):
+    """
+    dense_ids() for service codes: returns (unique_keys, ids) where the
+    unique keys are code_key()s, so codes that differ only in type (0 and
+    "0000") share one id.
+    """
+    unique_codes, ids = dense_ids(codes)
+    keys = [code_key(code) for code in unique_codes]
+    if len(set(keys)) == len(keys):
+        return keys, ids
+    #renumber the ids of codes with the same key; this is a pass over the distinct codes
+    #plus one array take, so the claims themselves are not keyed again
+    index = {}
+    remap = np.fromiter((index.setdefault(key, len(index)) for key in keys), dtype=np.intp, count=len(keys))
+    return list(index), remap[ids]
+
+
+def settle_batch(codes, insurers=None, clinics=None, payment_codes=None, contracts=None):
+    """
+    Settle a batch of audited service codes and return a dict with:
+      amounts     int64 array, the payment for each claim (0 if unknown)
+      settled     boolean array, True where the code is in payment_codes
+      total       sum of all payments
+      by_insurer  {insurer: total} if insurers were given
+      by_clinic   {clinic: total} if clinics were given
+      by_pair     {(insurer, clinic): total} if both were given
+      unknown     {code: count} for codes that could not be priced
+    When a ContractRates table is given as contracts, each claim is priced
+    by its (insurer, clinic, code) rate instead of PAYMENT_CODES, and the
+    result also has
+      no_contract {(insurer, clinic): count} for claims between an insurer
+                  and clinic with no contract, which are not in unknown
+    """
+    if payment_codes is None:
+        payment_codes = hbilling.PAYMENT_CODES
+    for name, accounts in (("insurers", insurers), ("clinics", clinics)):
+        if accounts is not None and len(accounts) != len(codes):
+            raise ValueError(name + " has " + str(len(accounts)) + " entries for " + str(len(codes)) + " codes")
+    if contracts is not None and (insurers is None or clinics is None):
+        raise ValueError("pricing by contracts needs the insurers and clinics of the claims")
+    result = {}
+
+    #every distinct code is priced once, then the prices are spread over the claims by id
+    unique_codes, claim_code_ids = code_ids(codes)
+    no_contract = None
+    if contracts is None:
+        prices = np.zeros(len(unique_codes), dtype=np.int64)
+        known = np.zeros(len(unique_codes), dtype=bool)
+        for i in range(len(unique_codes)):
+            if unique_codes[i] in payment_codes:
+                prices[i] = int(payment_codes[unique_codes[i]])
+                known[i] = True
+        amounts = prices[claim_code_ids]
+        settled = known[claim_code_ids]
+    else:
+        #imported here so that settling without contracts does not need the contract table
+        from contracts import NO_CONTRACT
+        amounts = contracts.lookup_batch(insurers, clinics, codes)
+        no_contract = amounts == NO_CONTRACT
+        settled = amounts >= 0
+        amounts[~settled] = 0
+    result["amounts"] = amounts
+    result["settled"] = settled
+    result["total"] = int(amounts.sum())
+
+    unknown = {}
+    if not settled.all():
+        unpriced = ~settled if no_contract is None else ~settled & ~no_contract
+        code_counts = np.bincount(claim_code_ids[unpriced], minlength=len(unique_codes))
+        for i in np.flatnonzero(code_counts):
+            unknown[unique_codes[i]] = int(code_counts[i])
+    result["unknown"] = unknown
+
+    if insurers is not None:
+        unique_insurers, insurer_ids = dense_ids(insurers)
+        result["by_insurer"] = account_totals(unique_insurers, insurer_ids, amounts)
+    if clinics is not None:
+        unique_clinics, clinic_ids = dense_ids(clinics)
+        result["by_clinic"] = account_totals(unique_clinics, clinic_ids, amounts)
+    if insurers is not None and clinics is not None:
+        pair_ids = insurer_ids * len(unique_clinics) + clinic_ids
+        sums = np.bincount(pair_ids, weights=amounts, minlength=len(unique_insurers) * len(unique_clinics))
+        by_pair = {}
+        for pair_id in np.flatnonzero(sums):
+            insurer = unique_insurers[pair_id // len(unique_clinics)]
+            clinic = unique_clinics[pair_id % len(unique_clinics)]
+            by_pair[(insurer, clinic)] = int(sums[pair_id])
+        result["by_pair"] = by_pair
+    if no_contract is not None:
+        pair_counts = np.bincount(pair_ids[no_contract], minlength=len(unique_insurers) * len(unique_clinics))
+        result["no_contract"] = {(unique_insurers[pair_id // len(unique_clinics)],
+                                  unique_clinics[pair_id % len(unique_clinics)]): int(pair_counts[pair_id])
+                                 for pair_id in np.flatnonzero(pair_counts)}
+    return result
+
+
+def account_totals(unique_keys, ids, amounts):
+    """Sum amounts per account id and return {account: total}."""
+    #bincount sums in float64, which is exact for integer totals below 2**53
+    sums = np.bincount(ids, weights=amounts, minlength=len(unique_keys))
+    return {unique_keys[i]: int(sums[i]) for i in range(len(unique_keys))}
+
+
+def main():
+    """
+    Benchmark settle_batch() on a million random invoices (or the count given
+    on the command line) and check it against the per-claim path.
+    """
+    args = sys.argv[1:]
+    count = 1000000
+    if len(args) == 1:
+        count = int(args[0])
+    rng = random.Random(2021)
+    code_mix = list(hbilling.PAYMENT_CODES) + ["0000"]
+    codes = [rng.choice(code_mix) for i in range(count)]
+    insurers = [rng.choice([hbilling.INS1, hbilling.INS2, hbilling.INS3]) for i in range(count)]
+    clinics = [rng.choice([hbilling.CLC1, hbilling.CLC2, hbilling.CLC3]) for i in range(count)]
+
+    start = time.perf_counter()
+    result = settle_batch(codes, insurers, clinics)
+    batch_seconds = time.perf_counter() - start
+
+    #the per-claim path doing the same work, without the printed line for each invoice
+    start = time.perf_counter()
+    current_balance = int(hbilling.INITIAL_CLINIC_BALANCE)
+    per_claim = []
+    unknown = {}
+    by_insurer = {}
+    by_clinic = {}
+    by_pair = {}
+    for code, insurer, clinic in zip(codes, insurers, clinics):
+        if code in hbilling.PAYMENT_CODES:
+            payment = hbilling.service_payment(code)
+        else:
+            payment = 0
+            unknown[code] = unknown.get(code, 0) + 1
+        per_claim.append(payment)
+        current_balance += payment
+        by_insurer[insurer] = by_insurer.get(insurer, 0) + payment
+        by_clinic[clinic] = by_clinic.get(clinic, 0) + payment
+        by_pair[(insurer, clinic)] = by_pair.get((insurer, clinic), 0) + payment
+    loop_seconds = time.perf_counter() - start
+
+    matches = (result["total"] == current_balance and result["amounts"].tolist() == per_claim
+               and result["unknown"] == unknown and result["by_insurer"] == by_insurer
+               and result["by_clinic"] == by_clinic
+               and result["by_pair"] == {pair: total for pair, total in by_pair.items() if total})
+    faster = batch_seconds < loop_seconds
+    print("Invoices: " + str(count))
+    print("Batch settlement: " + str(round(batch_seconds, 3)) + " seconds")
+    print("Per-claim loop: " + str(round(loop_seconds, 3)) + " seconds")
+    print("Speedup: " + str(round(loop_seconds / batch_seconds, 1)) + "x")
+    print("Total: $" + str(result["total"]) + ", unknown codes: " + str(result["unknown"]))
+    print("Results match the per-claim path: " + str(matches))
+    if not matches:
+        sys.exit(1)
+    if not faster:
+        print("BENCHMARK FAILED: the batch path is not faster than the per-claim loop")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
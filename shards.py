@@ -0,0 +1,175 @@
+"""
+Sharded batch pipeline for hbilling.
+
+For bulk re-adjudication the reception -> clinic -> insurer -> auditor ->
+payment stages of batchingest.run_claim() are run across all cores.
+Claims are split into SHARDS shards by a CRC32 hash of the pid, each shard
+is settled on its own in a worker process, and the shard results are
+merged in shard order at the end. At most IN_FLIGHT chunks per worker
+are submitted and not yet collected; reading waits on the oldest chunk
+before it submits another, so a large input is never all held in the
+pool's queue at once.
+
+The number of shards does not depend on the number of workers, and every
+shard is settled in input order, so the merged result (balance, counts,
+per-code totals and a digest of every settled claim) is the same no
+matter how many workers are used.
+
+Usage:
+  python shards.py claims.csv               # settle a file on every core
+  python shards.py claims.csv 4             # ... on 4 workers
+  python shards.py bench                    # scaling benchmark for 1, 2, 4 and 8 workers
+  python shards.py bench 400000
+"""
+
+import os
+import random
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import batchingest
+import hbilling
+
+SHARDS = 64
+#claims sent to a worker at a time
+CHUNK = 5000
+#chunks submitted but not yet collected, per worker
+IN_FLIGHT = 2
+
+
+def shard_of(pid, shards=SHARDS):
+    """Stable shard number for a pid (Python's hash() is randomized per process)."""
+    return zlib.crc32(str(pid).encode()) % shards
+
+
+def empty_summary():
+    return {"claims": 0, "settled": 0, "rejected": {}, "balance": 0, "by_code": {}, "digest": 0}
+
+
+def settle_chunk(rows):
+    """Worker: settle a list of claim rows in order and return their summary."""
+    summary = empty_summary()
+    digest = 0
+    for row in rows:
+        summary["claims"] += 1
+        sheet, result = batchingest.run_claim(row)
+        if isinstance(result, str):
+            summary["rejected"][result] = summary["rejected"].get(result, 0) + 1
+            continue
+        summary["settled"] += 1
+        summary["balance"] += result
+        summary["by_code"][sheet.code] = summary["by_code"].get(sheet.code, 0) + result
+        digest = zlib.crc32((sheet.pid + "," + sheet.code + "," + str(result) + "\n").encode(), digest)
+    summary["digest"] = digest
+    return summary
+
+
+def merge(total, part):
+    """Add one summary into another; parts must be merged in (shard, chunk) order for the digest."""
+    total["claims"] += part["claims"]
+    total["settled"] += part["settled"]
+    total["balance"] += part["balance"]
+    for reason in part["rejected"]:
+        total["rejected"][reason] = total["rejected"].get(reason, 0) + part["rejected"][reason]
+    for code in part["by_code"]:
+        total["by_code"][code] = total["by_code"].get(code, 0) + part["by_code"][code]
+    total["digest"] = zlib.crc32(str(part["digest"]).encode(), total["digest"])
+    return total
+
+
+def settle_sharded(claims, workers=None, shards=SHARDS, chunk=CHUNK):
+    """
+    Settle an iterable of claim rows (as from batchingest.read_claims) over
+    a pool of worker processes and return the merged summary.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    buffers = [[] for shard in range(shards)]
+    # ((shard, chunk number), future) in the order they were submitted
+    in_flight = deque()
+    # (shard, chunk number) -> summary of a collected chunk
+    parts = {}
+    chunk_numbers = [0] * shards
+    window = workers * IN_FLIGHT
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def submit(shard):
+            if len(in_flight) >= window:
+                key, future = in_flight.popleft()
+                parts[key] = future.result()
+            in_flight.append(((shard, chunk_numbers[shard]), pool.submit(settle_chunk, buffers[shard])))
+            chunk_numbers[shard] += 1
+            buffers[shard] = []
+
+        for row in claims:
+            shard = shard_of(row[0], shards)
+            buffers[shard].append(row)
+            if len(buffers[shard]) >= chunk:
+                submit(shard)
+        for shard in range(shards):
+            if buffers[shard]:
+                submit(shard)
+        for key, future in in_flight:
+            parts[key] = future.result()
+    total = empty_summary()
+    for key in sorted(parts):
+        merge(total, parts[key])
+    total["balance"] += int(hbilling.INITIAL_CLINIC_BALANCE)
+    return total
+
+
+def synthetic_claims(count, seed=2021):
+    rng = random.Random(seed)
+    codes = list(hbilling.PAYMENT_CODES) + ["0000"]
+    rows = []
+    for i in range(count):
+        rows.append(batchingest.claim_row([str(rng.randrange(count * 10)), "fred", "flintstone", "foot pain",
+                                           rng.choice(codes)]))
+    return rows
+
+
+def benchmark(count=200000, worker_counts=(1, 2, 4, 8)):
+    rows = synthetic_claims(count)
+    results = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        summary = settle_sharded(rows, workers)
+        elapsed = time.perf_counter() - start
+        results.append(summary)
+        print(str(workers) + " workers: " + str(round(elapsed, 2)) + " seconds, "
+              + str(int(count / elapsed)) + " claims/sec, digest " + str(summary["digest"]))
+    same = all(summary == results[0] for summary in results)
+    print("Results identical for every worker count: " + str(same))
+    return same
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "bench":
+        count = 200000
+        if len(args) > 1:
+            count = int(args[1])
+        if not benchmark(count):
+            sys.exit(1)
+        return
+    if len(args) not in (1, 2):
+        print("Usage: python shards.py claims.csv [workers] | python shards.py bench [claims]")
+        return
+    workers = None
+    if len(args) == 2:
+        workers = int(args[1])
+    start = time.perf_counter()
+    summary = settle_sharded(batchingest.read_claims(args[0]), workers)
+    elapsed = time.perf_counter() - start
+    print("Claims read: " + str(summary["claims"]))
+    print("Claims settled: " + str(summary["settled"]))
+    for reason in summary["rejected"]:
+        print("Claims rejected (" + reason + "): " + str(summary["rejected"][reason]))
+    print("The new clinic balance is: $" + str(summary["balance"]))
+    print("Throughput: " + str(int(summary["claims"] / elapsed)) + " claims/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Soak test for the hbilling session state machine.
+
+Drives hbilling.main() with scripted answers instead of a keyboard and
+runs a million state transitions made only of restarts and cancels
+(an invalid role, a patient typing EXIT, a receptionist pressing 1).
+Before the state machine each of these re-entered main(), so a session
+like this one hit RecursionError long before the end.
+
+The script checks that
+  - the run finishes without RecursionError,
+  - traced memory stays flat across the run,
+  - a patient admitted before the restarts is still in the waiting room after them.
+
+Usage:
+  python soak.py            # one million transitions
+  python soak.py 200000     # a shorter run
+"""
+
+import builtins
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import hbilling
+
+TRANSITIONS = 1000000
+
+#each cycle below is 5 transitions:
+#  invalid role -> role
+#  patient -> entry -> (EXIT) role
+#  receptionist -> entry -> (press 1) role
+RESTART_CYCLE = ["9", "1", "EXIT", "2", "1"]
+TRANSITIONS_PER_CYCLE = 5
+
+#how much traced memory is allowed to drift over the run
+MEMORY_SLACK = 64 * 1024
+SAMPLES = 10
+
+
+def scripted_answers(cycles, samples, capture):
+    #admit one patient first so we can check the queues survive the restarts
+    for answer in ["1", "Fred", "Flintstone", "12", "foot pain"]:
+        yield answer
+    every = max(1, cycles // SAMPLES)
+    for i in range(cycles):
+        if i % every == 0:
+            samples.append(tracemalloc.get_traced_memory()[0])
+        for answer in RESTART_CYCLE:
+            yield answer
+    samples.append(tracemalloc.get_traced_memory()[0])
+    #admit a second patient and list the waiting room into the capture buffer
+    sys.stdout = capture
+    for answer in ["1", "Barney", "Rubble", "13", "hand pain", "s", "1", "exit"]:
+        yield answer
+
+
+def soak(transitions=TRANSITIONS):
+    """Run the soak and return (seconds, memory samples, captured output)."""
+    cycles = transitions // TRANSITIONS_PER_CYCLE
+    samples = []
+    capture = io.StringIO()
+    answers = scripted_answers(cycles, samples, capture)
+    saved_input = builtins.input
+    saved_stdout = sys.stdout
+    devnull = open(os.devnull, "w")
+    saved_ledger = hbilling.PAYMENT_LEDGER_FILE
+    saved_store = hbilling.CLAIM_STORE_FILE
+    saved_rollups = hbilling.ROLLUP_FILE
+    folder = tempfile.TemporaryDirectory()
+    hbilling.PAYMENT_LEDGER_FILE = os.path.join(folder.name, "soak.ledger")
+    hbilling.CLAIM_STORE_FILE = os.path.join(folder.name, "soak.db")
+    hbilling.ROLLUP_FILE = os.path.join(folder.name, "soak.rollups")
+    builtins.input = lambda prompt="": next(answers)
+    sys.stdout = devnull
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        hbilling.main()
+    finally:
+        elapsed = time.perf_counter() - start
+        tracemalloc.stop()
+        builtins.input = saved_input
+        sys.stdout = saved_stdout
+        hbilling.PAYMENT_LEDGER_FILE = saved_ledger
+        hbilling.CLAIM_STORE_FILE = saved_store
+        hbilling.ROLLUP_FILE = saved_rollups
+        devnull.close()
+        folder.cleanup()
+    return elapsed, samples, capture.getvalue()
+
+
+def main():
+    args = sys.argv[1:]
+    transitions = TRANSITIONS
+    if len(args) == 1:
+        transitions = int(args[0])
+    elapsed, samples, output = soak(transitions)
+    drift = max(samples) - min(samples)
+    print("Transitions: " + str(transitions) + " in " + str(round(elapsed, 2)) + " seconds")
+    print("Traced memory: min " + str(min(samples)) + " max " + str(max(samples)) + " bytes")
+    kept = "fred" in output and "barney" in output
+    print("Waiting room kept across restarts: " + str(kept))
+    if drift > MEMORY_SLACK or not kept:
+        print("SOAK FAILED")
+        sys.exit(1)
+    print("SOAK PASSED")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+StageQueue holds the claims waiting at one stage of the hbilling workflow
+(waiting room, processing, treatment, auditing).
+
+A plain list pays O(n) for every pop(0) and needs a linear scan to find
+a patient. StageQueue keeps the records in arrival order with O(1)
+append/popleft, and keeps a pid index so that a claim can be looked up,
+moved to another stage, or pulled out of the middle of the queue in O(1).
+
+Records are the usual admit sheets [pid, first, last, complaint, code].
+The stages edit sheets in place (reception re-enters the pid), so a record
+stays indexed under the pid it had when it was appended.
+
+Example:
+  waiting_room = StageQueue("waiting room")
+  waiting_room.append(["12", "fred", "flintstone", "foot", "xxxx"])
+  sheet = waiting_room.first()
+  sheet = waiting_room.find("12")
+  waiting_room.move("12", patients_for_processing)
+  sheet = waiting_room.popleft()
+"""
+
+from collections import OrderedDict
+
+
+class StageQueue(object):
+    def __init__(self, name="", records=None):
+        self.name = name
+        # seq -> (pid, record), kept in arrival order
+        self._records = OrderedDict()
+        # pid -> OrderedDict of seq -> None, oldest first
+        self._pids = {}
+        self._next_seq = 0
+        if records:
+            for record in records:
+                self.append(record)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __bool__(self):
+        return len(self._records) > 0
+
+    def __iter__(self):
+        for pid, record in self._records.values():
+            yield record
+
+    def __contains__(self, pid):
+        return str(pid) in self._pids
+
+    def __repr__(self):
+        return 'StageQueue(' + repr(self.name) + ', ' + str(len(self)) + ' records)'
+
+    def append(self, record):
+        """Add a record at the back of the queue."""
+        pid = str(record[0])
+        seq = self._next_seq
+        self._next_seq += 1
+        self._records[seq] = (pid, record)
+        self._pids.setdefault(pid, OrderedDict())[seq] = None
+
+    def first(self):
+        """Return the record at the front of the queue without removing it."""
+        if not self._records:
+            raise IndexError('first from an empty StageQueue')
+        pid, record = next(iter(self._records.values()))
+        return record
+
+    def popleft(self):
+        """Remove and return the record at the front of the queue."""
+        if not self._records:
+            raise IndexError('pop from an empty StageQueue')
+        seq, (pid, record) = self._records.popitem(last=False)
+        self._unindex(pid, seq)
+        return record
+
+    def find(self, pid):
+        """Return the oldest record for pid, or None if it is not queued here."""
+        seqs = self._pids.get(str(pid))
+        if not seqs:
+            return None
+        seq = next(iter(seqs))
+        return self._records[seq][1]
+
+    def find_all(self, pid):
+        """Return every record for pid, oldest first."""
+        seqs = self._pids.get(str(pid), ())
+        return [self._records[seq][1] for seq in seqs]
+
+    def remove(self, pid):
+        """Pull the oldest record for pid out of the queue and return it."""
+        pid = str(pid)
+        seqs = self._pids.get(pid)
+        if not seqs:
+            raise KeyError('pid ' + pid + ' is not in ' + repr(self))
+        seq = next(iter(seqs))
+        record = self._records.pop(seq)[1]
+        self._unindex(pid, seq)
+        return record
+
+    def move(self, pid, other):
+        """Move the oldest record for pid to the back of another StageQueue."""
+        record = self.remove(pid)
+        other.append(record)
+        return record
+
+    def clear(self):
+        self._records.clear()
+        self._pids.clear()
+
+    def _unindex(self, pid, seq):
+        seqs = self._pids[pid]
+        del seqs[seq]
+        if not seqs:
+            del self._pids[pid]
@@ -0,0 +1,80 @@
+"""
+StatusView reports on the hbilling stage queues without reprinting them.
+
+After each role action main() used to print every record in every queue,
+which costs O(total claims) per step. StatusView keeps the count of each
+stage from the last report and by default emits only what changed plus
+the current counts, for example:
+  +1 to treatment, -1 waiting | 3,412 waiting, 1 to treatment, 0 treated, 0 for auditing
+
+A full listing of one stage is available on demand, one page at a time.
+
+Example:
+  status = StatusView([("waiting", waiting_room), ("to treatment", patients_for_processing)])
+  print(status.report())
+  print(status.page("waiting", 2))
+"""
+
+from itertools import islice
+
+PAGE_SIZE = 20
+
+
+def count_text(number):
+    """Format a count with thousands separators, like 3,412."""
+    return "{:,}".format(number)
+
+
+class StatusView(object):
+    def __init__(self, stages, page_size=PAGE_SIZE):
+        """
+        stages is a list of (label, queue) pairs in workflow order.
+        Any queue with len() and iteration works (StageQueue, list).
+        """
+        self.stages = list(stages)
+        self.page_size = page_size
+        self._last_counts = [len(queue) for label, queue in self.stages]
+
+    def counts(self):
+        """Return the current {label: count} for every stage."""
+        return {label: len(queue) for label, queue in self.stages}
+
+    def report(self):
+        """Return the changes since the last report and the current counts."""
+        changes = []
+        totals = []
+        for i in range(len(self.stages)):
+            label, queue = self.stages[i]
+            count = len(queue)
+            change = count - self._last_counts[i]
+            if change > 0:
+                changes.append("+" + count_text(change) + " " + label)
+            elif change < 0:
+                changes.append("-" + count_text(-change) + " " + label)
+            totals.append(count_text(count) + " " + label)
+            self._last_counts[i] = count
+        if not changes:
+            changes.append("no change")
+        return ", ".join(changes) + " | " + ", ".join(totals)
+
+    def page_count(self, label):
+        count = len(self._queue(label))
+        return max(1, (count + self.page_size - 1) // self.page_size)
+
+    def page(self, label, page_number=1):
+        """Return one page (numbered from 1) of the records in a stage as text."""
+        queue = self._queue(label)
+        pages = self.page_count(label)
+        page_number = min(max(1, page_number), pages)
+        start = (page_number - 1) * self.page_size
+        lines = [label + ": page " + str(page_number) + " of " + str(pages)
+                 + " (" + count_text(len(queue)) + " records)"]
+        for record in islice(queue, start, start + self.page_size):
+            lines.append(str(record))
+        return "\n".join(lines)
+
+    def _queue(self, label):
+        for stage_label, queue in self.stages:
+            if stage_label == label:
+                return queue
+        raise KeyError("no stage called " + repr(label))
@@ -0,0 +1,266 @@
+"""
+SQLite storage for hbilling patients, insured and claims.
+
+The module docstring of hbilling says the internal lists would be
+substituted by external storage in a full deployment. ClaimStore keeps
+every admit sheet in a local SQLite database as it moves through the
+stages, with indexes on pid, last name and stage so that lookups stay
+sub-millisecond with millions of patients on file.
+
+Tables:
+  patients  pid, first, last                 (one row per pid, as first registered)
+  insured   iid, first, last, insurer        (one row per iid)
+  claims    id, pid, first, last, complaint, code, stage
+
+All roles share one connection per database file through get_store(),
+and every read and write takes the store's lock. Writes outside a batch
+commit right away; inside "with store.batch():" they are grouped into a
+single transaction. A saved sheet remembers its claim row in
+sheet.claim_id until it is settled. open_claims() lists the claims still
+at a stage, which hbilling queues again when it starts.
+
+Example:
+  store = get_store("hbilling.db")
+  store.save(sheet, "waiting")
+  with store.batch():
+      for sheet in sheets:
+          store.save(sheet, "waiting")
+  store.last_name_for("12")          # "flintstone"
+  store.find_by_last_name("rubble")
+"""
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    pid TEXT PRIMARY KEY,
+    first TEXT,
+    last TEXT
+);
+CREATE INDEX IF NOT EXISTS patients_last ON patients (last);
+CREATE TABLE IF NOT EXISTS insured (
+    iid TEXT PRIMARY KEY,
+    first TEXT,
+    last TEXT,
+    insurer TEXT
+);
+CREATE INDEX IF NOT EXISTS insured_last ON insured (last);
+CREATE TABLE IF NOT EXISTS claims (
+    id INTEGER PRIMARY KEY,
+    pid TEXT,
+    first TEXT,
+    last TEXT,
+    complaint TEXT,
+    code TEXT,
+    stage TEXT
+);
+CREATE INDEX IF NOT EXISTS claims_pid ON claims (pid);
+CREATE INDEX IF NOT EXISTS claims_last ON claims (last);
+CREATE INDEX IF NOT EXISTS claims_stage ON claims (stage);
+"""
+
+#rows read at a time by the queries that stream their results
+STREAM_PAGE = 1000
+
+#one shared store per database file
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(filename):
+    """Return the shared ClaimStore for filename, opening it the first time."""
+    with _stores_lock:
+        store = _stores.get(filename)
+        if store is None:
+            store = ClaimStore(filename)
+            _stores[filename] = store
+        return store
+
+
+def close_stores():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+
+class ClaimStore(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        #every use of the shared connection, reads included, holds this lock
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+
+    @contextmanager
+    def batch(self):
+        """Group every write inside the with block into one transaction."""
+        with self._lock:
+            if self._batch_depth == 0:
+                self.connection.execute("BEGIN")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.connection.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.connection.execute("COMMIT")
+
+    def save(self, sheet, stage, replaces=None):
+        """
+        Save a ClaimSheet at a stage. The sheet keeps the id of its claim row
+        in sheet.claim_id, so a sheet saved before is updated in place. If the
+        stage handed on a different sheet (a 'diff' patient swap), pass the
+        old one as replaces so its claim is marked as replaced.
+        """
+        with self.batch():
+            if replaces is not None and replaces is not sheet and replaces.claim_id is not None:
+                self.connection.execute("UPDATE claims SET stage = 'replaced' WHERE id = ?", (replaces.claim_id,))
+                replaces.claim_id = None
+            pid, first, last, complaint, code = [str(value) for value in sheet[:5]]
+            self.connection.execute("INSERT OR IGNORE INTO patients (pid, first, last) VALUES (?, ?, ?)",
+                                    (pid, first, last))
+            row = sheet.claim_id
+            if row is None:
+                cursor = self.connection.execute(
+                    "INSERT INTO claims (pid, first, last, complaint, code, stage) VALUES (?, ?, ?, ?, ?, ?)",
+                    (pid, first, last, complaint, code, stage))
+                sheet.claim_id = cursor.lastrowid
+            else:
+                self.connection.execute(
+                    "UPDATE claims SET pid = ?, first = ?, last = ?, complaint = ?, code = ?, stage = ? WHERE id = ?",
+                    (pid, first, last, complaint, code, stage, row))
+
+    def settle(self, sheet, stage="settled", replaces=None):
+        """Save the sheet at its final stage and stop tracking it."""
+        self.save(sheet, stage, replaces=replaces)
+        sheet.claim_id = None
+
+    def save_many(self, sheets, stage):
+        """Bulk insert finished claims (for batch jobs) in one transaction."""
+        rows = [[str(value) for value in sheet[:5]] for sheet in sheets]
+        with self.batch():
+            self.connection.executemany("INSERT OR IGNORE INTO patients (pid, first, last) VALUES (?, ?, ?)",
+                                        [row[:3] for row in rows])
+            self.connection.executemany(
+                "INSERT INTO claims (pid, first, last, complaint, code, stage) VALUES (?, ?, ?, ?, ?, ?)",
+                [row + [stage] for row in rows])
+
+    def save_insured(self, iid, first, last, insurer=None):
+        with self.batch():
+            self.connection.execute("INSERT OR REPLACE INTO insured (iid, first, last, insurer) VALUES (?, ?, ?, ?)",
+                                    (str(iid), first, last, insurer))
+
+    def _fetch(self, query, parameters=()):
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def _fetch_one(self, query, parameters=()):
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+    def _stream(self, query, parameters=()):
+        #the lock is held for each page, not while the caller works through it
+        with self._lock:
+            cursor = self.connection.execute(query, parameters)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(STREAM_PAGE)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def last_name_for(self, pid):
+        """Return the last name on file for a pid, or None for a new patient."""
+        row = self._fetch_one("SELECT last FROM patients WHERE pid = ?", (str(pid),))
+        if row is None:
+            return None
+        return row[0]
+
+    def find_patient(self, pid):
+        """Return [pid, first, last] for a pid on file, or None."""
+        row = self._fetch_one("SELECT pid, first, last FROM patients WHERE pid = ?", (str(pid),))
+        if row is None:
+            return None
+        return list(row)
+
+    def find_by_last_name(self, last):
+        rows = self._fetch("SELECT pid, first, last FROM patients WHERE last = ?", (last,))
+        return [list(row) for row in rows]
+
+    def patients(self):
+        """Yield (pid, first, last) for every patient on file, in the order they were registered."""
+        return self._stream("SELECT pid, first, last FROM patients ORDER BY rowid")
+
+    def confirmed_patients(self):
+        """
+        Yield (pid, first, last) for every pid reception has confirmed, in the
+        order they were confirmed, under the name of its first confirmed claim.
+        The patients table also holds pids as they were typed at admission.
+        """
+        #with MIN() SQLite takes the bare columns from the row with the smallest id
+        return ((pid, first, last) for pid, first, last, first_id in self._stream(
+            "SELECT pid, first, last, MIN(id) FROM claims WHERE stage NOT IN ('waiting', 'replaced') "
+            "GROUP BY pid ORDER BY MIN(id)"))
+
+    def find_insured(self, iid):
+        row = self._fetch_one("SELECT iid, first, last, insurer FROM insured WHERE iid = ?", (str(iid),))
+        if row is None:
+            return None
+        return list(row)
+
+    def claims_for(self, pid):
+        """Return every claim for a pid as [pid, first, last, complaint, code, stage]."""
+        rows = self._fetch(
+            "SELECT pid, first, last, complaint, code, stage FROM claims WHERE pid = ? ORDER BY id", (str(pid),))
+        return [list(row) for row in rows]
+
+    def claims_in_stage(self, stage, limit=None):
+        query = "SELECT pid, first, last, complaint, code, stage FROM claims WHERE stage = ? ORDER BY id"
+        parameters = (stage,)
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters = (stage, limit)
+        return [list(row) for row in self._fetch(query, parameters)]
+
+    def claims_after(self, after_id=0, limit=1000, stage=None):
+        """
+        Return up to limit claims with an id above after_id, in id order, as
+        [id, pid, first, last, complaint, code, stage]. Paging by id keeps
+        each page an index range scan however deep into the table it is.
+        """
+        query = "SELECT id, pid, first, last, complaint, code, stage FROM claims WHERE id > ?"
+        parameters = (after_id,)
+        if stage is not None:
+            query += " AND stage = ?"
+            parameters = (after_id, stage)
+        query += " ORDER BY id LIMIT ?"
+        return [list(row) for row in self._fetch(query, parameters + (limit,))]
+
+    def open_claims(self, stages):
+        """
+        Yield the claims at any of the given stages in id order, as
+        [id, pid, first, last, complaint, code, stage], so the claims a
+        session left open can be queued again at the next start.
+        """
+        stages = list(stages)
+        query = ("SELECT id, pid, first, last, complaint, code, stage FROM claims WHERE stage IN ("
+                 + ", ".join("?" * len(stages)) + ") ORDER BY id")
+        return (list(row) for row in self._stream(query, stages))
+
+    def count_in_stage(self, stage):
+        return self._fetch_one("SELECT COUNT(*) FROM claims WHERE stage = ?", (stage,))[0]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
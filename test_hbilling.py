@@ -0,0 +1,199 @@
+"""
+Invariant tests for the hbilling data structures, plus the crash, soak and
+startup checks that otherwise only run as "python x.py <mode>".
+
+Usage:
+  python -m pytest -q
+"""
+
+import os
+import random
+
+import bench
+import soak
+from accounts import Accounts, to_cents
+from identity import BloomFilter, HashTable, IdentityIndex, key_hash, PID_REUSED, NAME_REUSED
+from invoicing import InvoiceBook
+from ledger import crash_test
+from photohash import MultiIndex, hamming
+from photoregistry import PhotoRegistry
+from rollups import TopSpenders
+from stagequeue import StageQueue
+from triage import TriageQueue, SimulatedClock, URGENT, ROUTINE
+
+
+def sheet(pid, complaint="checkup"):
+    return [str(pid), "fred", "flintstone", complaint, "xxxx"]
+
+
+def test_stage_queue_keeps_arrival_order_and_pid_index():
+    queue = StageQueue("waiting room", [sheet(i) for i in range(5)])
+    other = StageQueue("processing")
+    assert queue.first()[0] == "0"
+    assert queue.find("3")[0] == "3"
+    assert queue.remove("2")[0] == "2"
+    queue.move("4", other)
+    assert "2" not in queue and "4" not in queue and "4" in other
+    assert [record[0] for record in queue] == ["0", "1", "3"]
+    assert [queue.popleft()[0] for i in range(len(queue))] == ["0", "1", "3"]
+    assert not queue and queue.find("0") is None
+
+
+def test_triage_queue_orders_by_class_with_aging():
+    clock = SimulatedClock()
+    queue = TriageQueue("waiting room", clock=clock)
+    queue.append(sheet(1, "sprained toe"), ROUTINE)
+    clock.now = 30 * 60
+    queue.append(sheet(2, "head injury"), URGENT)
+    #the urgent claim is due at 30 minutes, the routine one at 60
+    assert queue.first()[0] == "2"
+    clock.now = 90 * 60
+    queue.append(sheet(3, "head injury"), URGENT)
+    assert [queue.popleft()[0] for i in range(3)] == ["2", "1", "3"]
+
+
+def test_triage_queue_skips_removed_claims():
+    queue = TriageQueue("waiting room", clock=SimulatedClock())
+    for i in range(100):
+        queue.append(sheet(i), URGENT)
+    for i in range(0, 100, 2):
+        queue.remove(str(i))
+    assert [queue.popleft()[0] for i in range(len(queue))] == [str(i) for i in range(1, 100, 2)]
+
+
+def test_hash_table_keeps_first_value_across_growth():
+    table = HashTable(expected=4)
+    keys = [key_hash("pid" + str(i)) for i in range(5000)]
+    for i in range(len(keys)):
+        assert table.setdefault(keys[i], i) == i
+    assert len(table) == len(keys)
+    assert table.setdefault(keys[7], 99) == 7
+    assert all(table.get(keys[i]) == i for i in range(len(keys)))
+    assert table.get(key_hash("never added")) is None
+    assert dict(table.items()) == {keys[i]: i for i in range(len(keys))}
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(expected=10000)
+    values = [key_hash("pid" + str(i)) for i in range(10000)]
+    for value in values:
+        bloom.add(value)
+    assert all(value in bloom for value in values)
+    false_positives = sum(key_hash("other" + str(i)) in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_identity_index_flags_reused_pids_and_names():
+    index = IdentityIndex(expected=16)
+    assert index.add("12", "fred", "flintstone") == []
+    assert index.check("12", "barney", "rubble") == [PID_REUSED]
+    assert index.check("13", "Fred", "Flintstone") == [NAME_REUSED]
+    assert index.check("12", "fred", "flintstone") == []
+    assert "12" in index and "13" not in index
+
+
+def test_invoice_book_keeps_totals_after_items_are_paid():
+    invoices = InvoiceBook()
+    invoices.add("12", "1111", 1001, "INS1", "CLC1")
+    invoices.add("12", "2222", 2002, "INS1", "CLC2")
+    invoices.add("13", "1111", 1001, "INS2", "CLC1")
+    assert [item.visit for item in invoices.line_items("12")] == [1, 2]
+    assert [item.amount for item in invoices.take_unpaid()] == [1001, 2002, 1001]
+    assert invoices.unpaid() == [] and invoices.line_items("12") == []
+    assert invoices.take_unpaid() == []
+    assert invoices.add("12", "3333", 3033).visit == 3
+    assert invoices.visits("12") == 3 and len(invoices) == 4
+    assert invoices.pid_total("12") == 6036
+    assert invoices.clinic_total("CLC1") == 2002
+    assert invoices.pair_total("INS1", "CLC2") == 2002
+    assert invoices.total == 7037
+
+
+def test_top_spenders_matches_a_full_sort():
+    rng = random.Random(2021)
+    top = TopSpenders(top_size=10)
+    totals = {}
+    for i in range(5000):
+        pid = str(rng.randrange(300))
+        totals[pid] = totals.get(pid, 0) + rng.randrange(1, 5000)
+        top.update(pid, totals[pid])
+    expected = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:10]
+    assert top.top(10) == expected
+
+
+def test_accounts_stay_balanced():
+    insurers = ["INS1", "INS2"]
+    clinics = ["CLC1", "CLC2", "CLC3"]
+    accounts = Accounts(insurers, clinics)
+    accounts.open("CLC4", "clinic", opening_cents=to_cents(500))
+    rng = random.Random(2021)
+    owed = dict.fromkeys(clinics, 0)
+    for i in range(2000):
+        clinic = rng.choice(clinics)
+        cents = to_cents(rng.choice([1001, 2002, -1001]))
+        accounts.accrue(rng.choice(insurers), clinic, cents)
+        owed[clinic] += cents
+        if i % 100 == 99:
+            assert accounts.balance(clinic, pending=True) == owed[clinic]
+            accounts.settle_cycle()
+    accounts.settle_cycle()
+    assert accounts.check(replay=True) == []
+    assert all(accounts.balance(clinic) == owed[clinic] for clinic in clinics)
+    assert accounts.balance("CLC4") == to_cents(500)
+    #at most one transfer per (insurer, clinic) pair each cycle, plus the opening balance
+    assert len(accounts.journal) <= accounts.cycles * len(insurers) * len(clinics) + 1
+
+
+def test_multi_index_finds_every_hash_a_full_scan_finds():
+    rng = random.Random(2021)
+    index = MultiIndex(max_distance=6)
+    values = [rng.getrandbits(64) for i in range(500)]
+    #near copies of some hashes, a few bits apart
+    for value in values[:100]:
+        values.append(value ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)))
+    for value in values:
+        index.add(value)
+    assert not index.add(values[0])
+    for value in values[:150]:
+        expected = sorted((hamming(value, other), other) for other in set(values) if hamming(value, other) <= 6)
+        assert sorted(index.query(value)) == expected
+
+
+def test_photo_registry_refresh_sees_added_removed_and_replaced_photos(tmp_path):
+    folder = str(tmp_path)
+    os.makedirs(os.path.join(folder, "3f"))
+    fred = os.path.join(folder, "fredflintstone.jpg")
+    barney = os.path.join(folder, "3f", "13_barney_rubble.png")
+    with open(fred, "wb") as photo:
+        photo.write(b"fred")
+    registry = PhotoRegistry(folder, max_age=0)
+    assert registry.find(first="Fred", last="Flintstone") == fred
+    assert registry.find(pid="13") is None
+
+    with open(barney, "wb") as photo:
+        photo.write(b"barney")
+    assert registry.find(pid="13") == barney
+    assert registry.find(name="Barney Rubble") == barney
+
+    before = registry.mtime(fred)
+    os.utime(fred, ns=(before + 10 ** 9, before + 10 ** 9))
+    assert registry.mtime(fred) == before + 10 ** 9
+
+    os.remove(fred)
+    assert registry.find(first="fred", last="flintstone") is None
+    assert registry.mtime(fred) is None
+    assert len(registry) == 1
+
+
+def test_ledger_survives_a_crash_mid_batch():
+    assert crash_test()
+
+
+def test_soak_keeps_memory_flat_and_queues_across_restarts():
+    elapsed, samples, output = soak.soak(200000)
+    assert max(samples) - min(samples) <= soak.MEMORY_SLACK
+    assert "fred" in output and "barney" in output
+
+
+def test_import_stays_within_the_startup_budget():
+    assert bench.startup_problems(bench.startup_benchmark()) == []
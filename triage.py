@@ -0,0 +1,241 @@
+"""
+Priority triage for the hbilling stage queues.
+
+StageQueue is first come, first served, so a patient with a head injury
+waits behind every sprained ankle that arrived before them. TriageQueue
+is a StageQueue that hands out claims by triage class instead, with a
+delay for each class (AGING_SECONDS):
+  urgent    no delay
+  soon      20 minutes
+  routine   60 minutes
+Each claim's place in line is its arrival time plus the delay of its
+class, so a routine claim that has waited an hour goes ahead of an urgent
+claim that just arrived (aging): nobody waits more than their class delay
+longer than they would have in a first come, first served queue. That
+place never changes once a claim is queued, so the queue is a binary heap
+and append, first and popleft are O(log n). Claims pulled out of the
+middle (remove, move) are dropped from the heap lazily.
+
+The class comes from the sheet's priority if reception set one, or from
+the complaint otherwise (triage_class). The pid index, find and move work
+as in StageQueue; iterating lists the claims in arrival order.
+
+Example:
+  waiting_room = TriageQueue("waiting room")
+  waiting_room.append(ClaimSheet("12", "fred", "flintstone", "foot pain"))
+  waiting_room.append(ClaimSheet("13", "barney", "rubble", "head injury"))
+  waiting_room.popleft().pid           # "13"
+  triage_class("burned hand")          # URGENT
+
+Running this file simulates a clinic's waiting room with Poisson arrivals
+and compares time to treatment, first come first served against triage:
+  python triage.py
+  python triage.py 50000
+"""
+
+import heapq
+import random
+import sys
+import time
+
+from stagequeue import StageQueue
+
+URGENT = "urgent"
+SOON = "soon"
+ROUTINE = "routine"
+CLASSES = [URGENT, SOON, ROUTINE]
+
+#how much later than an urgent claim a claim of each class may arrive and still be seen before it
+AGING_SECONDS = {URGENT: 0, SOON: 20 * 60, ROUTINE: 60 * 60}
+
+#words in a complaint that triage it, checked urgent first; anything else is routine
+TRIAGE_WORDS = [
+    (URGENT, ["head injury", "burn", "chest", "breath", "bleeding", "unconscious", "dizzy", "seizure", "stroke"]),
+    (SOON, ["broken", "fracture", "fever", "flu", "cut", "sprained", "swollen", "migraine", "infection"]),
+]
+
+
+def triage_class(complaint):
+    """The triage class of a complaint, from TRIAGE_WORDS."""
+    complaint = str(complaint).lower()
+    for triage, words in TRIAGE_WORDS:
+        for word in words:
+            if word in complaint:
+                return triage
+    return ROUTINE
+
+
+def sheet_class(record):
+    """The class reception set on a sheet, or the class of its complaint."""
+    triage = getattr(record, "priority", None)
+    if triage in AGING_SECONDS:
+        return triage
+    return triage_class(record[3])
+
+
+class TriageQueue(StageQueue):
+    def __init__(self, name="", records=None, clock=time.monotonic, aging=None):
+        self.clock = clock
+        self.aging = aging if aging is not None else AGING_SECONDS
+        # (arrival + class delay, seq); seqs no longer in _records are stale
+        self._heap = []
+        StageQueue.__init__(self, name, records)
+
+    def __repr__(self):
+        return 'TriageQueue(' + repr(self.name) + ', ' + str(len(self)) + ' records)'
+
+    def append(self, record, priority=None):
+        """Queue a record by its triage class, or by priority if one is given."""
+        if priority is None:
+            priority = sheet_class(record)
+        StageQueue.append(self, record)
+        heapq.heappush(self._heap, (self.clock() + self.aging[priority], self._next_seq - 1))
+
+    def first(self):
+        """Return the record that popleft() would take, without removing it."""
+        if not self._records:
+            raise IndexError('first from an empty TriageQueue')
+        return self._records[self._head()][1]
+
+    def popleft(self):
+        """Remove and return the record whose turn it is."""
+        if not self._records:
+            raise IndexError('pop from an empty TriageQueue')
+        seq = self._head()
+        heapq.heappop(self._heap)
+        pid, record = self._records.pop(seq)
+        self._unindex(pid, seq)
+        return record
+
+    def remove(self, pid):
+        record = StageQueue.remove(self, pid)
+        if len(self._heap) > 2 * len(self._records) + 64:
+            self._compact()
+        return record
+
+    def clear(self):
+        StageQueue.clear(self)
+        self._heap = []
+
+    def _head(self):
+        heap = self._heap
+        while heap[0][1] not in self._records:
+            heapq.heappop(heap)
+        return heap[0][1]
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if entry[1] in self._records]
+        heapq.heapify(self._heap)
+
+
+#a clinic morning: arrivals per hour, minutes per treatment and the share of each class
+ARRIVALS_PER_HOUR = 9
+TREATMENT_MINUTES = 12
+CLINICIANS = 2
+CLASS_MIX = {URGENT: 0.1, SOON: 0.3, ROUTINE: 0.6}
+
+
+class SimulatedClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(queue, clock, count, seed=2021, arrivals_per_hour=ARRIVALS_PER_HOUR,
+             treatment_minutes=TREATMENT_MINUTES, clinicians=CLINICIANS, class_mix=CLASS_MIX):
+    """
+    Run count patients through a queue with Poisson arrivals and exponential
+    treatment times; returns {class: [waits in minutes]} including "all".
+    """
+    rng = random.Random(seed)
+    classes = list(class_mix)
+    weights = [class_mix[triage] for triage in classes]
+    arrivals = []
+    now = 0.0
+    for i in range(count):
+        now += rng.expovariate(arrivals_per_hour / 3600.0)
+        arrivals.append((now, rng.choices(classes, weights)[0], rng.expovariate(1.0 / (treatment_minutes * 60))))
+
+    # the times the clinicians are next free
+    free = [0.0] * clinicians
+    waits = {triage: [] for triage in classes}
+    waits["all"] = []
+    next_arrival = 0
+    while next_arrival < count or queue:
+        if queue and (next_arrival == count or free[0] < arrivals[next_arrival][0]):
+            #a clinician is free before the next patient arrives, so the queue goes first
+            clock.now = free[0]
+            i = int(queue.popleft()[0])
+        else:
+            clock.now = arrivals[next_arrival][0]
+            i = next_arrival
+            next_arrival += 1
+            if queue or free[0] > clock.now:
+                if isinstance(queue, TriageQueue):
+                    queue.append([str(i), "", "", "", ""], arrivals[i][1])
+                else:
+                    queue.append([str(i), "", "", "", ""])
+                continue
+        arrived, triage, treatment = arrivals[i]
+        wait = (clock.now - arrived) / 60
+        waits[triage].append(wait)
+        waits["all"].append(wait)
+        heapq.heapreplace(free, clock.now + treatment)
+    return waits
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def wait_summary(waits):
+    """{class: (p50, p95, max)} in minutes."""
+    summary = {}
+    for triage in waits:
+        ordered = sorted(waits[triage])
+        summary[triage] = (round(percentile(ordered, 50), 1), round(percentile(ordered, 95), 1),
+                           round(ordered[-1] if ordered else 0, 1))
+    return summary
+
+
+def benchmark(count=20000, queued=100000):
+    clock = SimulatedClock()
+    fifo = wait_summary(simulate(StageQueue("fifo"), clock, count))
+    clock = SimulatedClock()
+    triaged = wait_summary(simulate(TriageQueue("triage", clock=clock), clock, count))
+    print("Patients: " + str(count) + ", " + str(ARRIVALS_PER_HOUR) + " an hour, " + str(CLINICIANS)
+          + " clinicians, " + str(TREATMENT_MINUTES) + " minutes a treatment")
+    print("Minutes to treatment        FIFO p50 / p95 / max        triage p50 / p95 / max")
+    for triage in CLASSES + ["all"]:
+        print(triage.ljust(12) + " " * 16 + " / ".join(str(value) for value in fifo[triage]).ljust(28)
+              + " / ".join(str(value) for value in triaged[triage]))
+
+    queue = TriageQueue("bench")
+    records = [[str(i), "", "", "", ""] for i in range(queued)]
+    priorities = [CLASSES[i % 3] for i in range(queued)]
+    start = time.perf_counter()
+    for i in range(queued):
+        queue.append(records[i], priorities[i])
+    for i in range(queued):
+        queue.popleft()
+    elapsed = time.perf_counter() - start
+    print("Queue operations: " + str(int(2 * queued / elapsed)) + " appends and pops/sec with up to "
+          + str(queued) + " queued")
+    return triaged[URGENT][1] < fifo[URGENT][1]
+
+
+def main():
+    args = sys.argv[1:]
+    count = 20000
+    if args:
+        count = int(args[0])
+    if not benchmark(count):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
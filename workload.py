@@ -0,0 +1,205 @@
+"""
+Seeded synthetic workload for hbilling.
+
+generate() makes a reproducible list of patient visits: admit details, the
+codes each role types, receptionists who mistype the ID number first, and
+"diff" swaps where the receptionist or clinician replaces the patient on
+the sheet. The *_answers() functions turn a visit into exactly the answers
+the matching hbilling entry function asks for, so stage functions and the
+whole main() loop can be driven without anyone at the keyboard (see
+bench.py).
+
+Example:
+  visits = generate(1000, seed=7)
+  answers = iter(session_answers(visits))
+  builtins.input = lambda prompt="": next(answers)
+  hbilling.main()            # admits, treats, codes and settles all 1000 visits
+
+Usage:
+  python workload.py 20      # print 20 visits
+"""
+
+import random
+import sys
+from collections import namedtuple
+
+import hbilling
+from triage import AGING_SECONDS, triage_class
+
+SEED = 2021
+
+FIRST_NAMES = ["fred", "wilma", "pebbles", "barney", "betty", "bamm-bamm", "dino", "george", "jane", "judy",
+               "elroy", "rosie", "mr slate", "gazoo", "arnold"]
+LAST_NAMES = ["flintstone", "rubble", "jetson", "slate", "gravelberg", "rockhead", "stonewall", "boulder"]
+COMPLAINTS = {
+    "1111": ["foot pain", "sprained ankle", "broken toe", "swollen foot", "heel pain"],
+    "2222": ["hand pain", "cut finger", "sprained wrist", "burned hand", "swollen knuckle"],
+    "3333": ["headache", "head injury", "dizzy spells", "bumped head", "migraine"],
+    "4444": ["fever", "full checkup", "aches all over", "flu symptoms", "rash on body"],
+}
+
+#how often each code is the right one for a visit
+CODE_MIX = {"1111": 0.4, "2222": 0.3, "3333": 0.2, "4444": 0.1}
+#share of visits where the receptionist types a wrong ID number first
+MISMATCH_RATE = 0.05
+#share of visits where the receptionist or clinician swaps in a different patient
+SWAP_RATE = 0.02
+#share of visits where the clinic or insurer types a wrong code the next role corrects
+MISCODE_RATE = 0.1
+#share of visits the receptionist sends on as 0000 (code unknown)
+UNKNOWN_RATE = 0.2
+#share of visits where the receptionist looks at the photo
+PHOTO_RATE = 0.3
+
+Visit = namedtuple("Visit", ["pid", "first", "last", "complaint", "code", "photo", "wrong_cid", "reception_swap",
+                             "clinic_swap", "reception_code", "clinic_code", "insurer_code", "auditor_codes"])
+#the admit details typed when a patient is swapped in: (first, last, pid, complaint)
+Swap = namedtuple("Swap", ["first", "last", "pid", "complaint"])
+
+
+def generate(count, seed=SEED, code_mix=CODE_MIX, mismatch_rate=MISMATCH_RATE, swap_rate=SWAP_RATE,
+             miscode_rate=MISCODE_RATE, unknown_rate=UNKNOWN_RATE, photo_rate=PHOTO_RATE):
+    """Return count visits; the same arguments always give the same visits."""
+    rng = random.Random(seed)
+    codes = list(code_mix)
+    weights = [code_mix[code] for code in codes]
+    visits = []
+    for i in range(count):
+        code = rng.choices(codes, weights)[0]
+        pid = str(100000 + i)
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        complaint = rng.choice(COMPLAINTS[code])
+
+        wrong_cid = None
+        if rng.random() < mismatch_rate:
+            wrong_cid = str(rng.randrange(100000, 100000 + count + 1000))
+        reception_swap = None
+        clinic_swap = None
+        if rng.random() < swap_rate:
+            swap = Swap(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), str(900000 + i), rng.choice(COMPLAINTS[code]))
+            if rng.random() < 0.5:
+                reception_swap = swap
+            else:
+                clinic_swap = swap
+
+        reception_code = code
+        if rng.random() < unknown_rate:
+            reception_code = "0000"
+        clinic_code = code
+        if rng.random() < miscode_rate:
+            clinic_code = rng.choice(codes)
+        insurer_code = code
+        if rng.random() < miscode_rate:
+            insurer_code = rng.choice(codes)
+        #the auditor always settles on a known code, sometimes after a typo caught by the double check
+        auditor_codes = [code, code]
+        if rng.random() < miscode_rate:
+            auditor_codes = [code, rng.choice(codes) + "0", code]
+
+        visits.append(Visit(pid, first, last, complaint, code, rng.random() < photo_rate, wrong_cid,
+                            reception_swap, clinic_swap, reception_code, clinic_code, insurer_code, auditor_codes))
+    return visits
+
+
+def patient_answers(visit):
+    return [visit.first, visit.last, visit.pid, visit.complaint]
+
+
+def reception_answers(visit):
+    answers = [""]
+    if visit.photo:
+        answers.append("p")
+    else:
+        answers.append("")
+    pid = visit.pid
+    complaint = visit.complaint
+    if visit.reception_swap is not None:
+        swap = visit.reception_swap
+        answers += ["diff", swap.first, swap.last, swap.pid, swap.complaint]
+        pid = swap.pid
+        complaint = swap.complaint
+    else:
+        answers.append("")
+    if visit.wrong_cid is not None and visit.wrong_cid != pid:
+        answers += [visit.wrong_cid, pid]
+    else:
+        answers.append(pid)
+    #the triage class suggested from the complaint is kept
+    answers += [complaint, visit.reception_code, ""]
+    return answers
+
+
+def clinic_answers(visit):
+    if visit.clinic_swap is not None:
+        swap = visit.clinic_swap
+        answers = ["diff", swap.first, swap.last, swap.pid, swap.complaint]
+    else:
+        answers = [""]
+    return answers + ["", visit.clinic_code]
+
+
+def insurer_answers(visit):
+    return ["", visit.insurer_code]
+
+
+def auditor_answers(visit):
+    return [""] + list(visit.auditor_codes)
+
+
+STAGE_ANSWERS = [("1", patient_answers), ("2", reception_answers), ("3", clinic_answers), ("4", insurer_answers),
+                 ("5", auditor_answers)]
+
+
+def queued_complaint(visit, role):
+    """The complaint on a visit's sheet while it waits for a role (2 to 5), which decides its triage class."""
+    if role == "2":
+        return visit.complaint
+    if role != "3" and visit.clinic_swap is not None:
+        return visit.clinic_swap.complaint
+    if visit.reception_swap is not None:
+        return visit.reception_swap.complaint
+    return visit.complaint
+
+
+def session_answers(visits, batch=1):
+    """
+    Answers for a whole hbilling.main() session: every role works each batch
+    of visits in turn (all admits, then all receptions, ...), then exit.
+    The stage queues hand out a batch by triage class, so each role answers
+    for the visits in the order its queue takes them: a session is far
+    shorter than any AGING_SECONDS delay, so that is by class, then by the
+    order the stage before finished them.
+    """
+    for start in range(0, len(visits), batch):
+        order = visits[start:start + batch]
+        for role, answers in STAGE_ANSWERS:
+            if role != "1":
+                order = sorted(order, key=lambda visit: AGING_SECONDS[triage_class(queued_complaint(visit, role))])
+            for visit in order:
+                yield role
+                for answer in answers(visit):
+                    yield answer
+    yield "exit"
+
+
+def final_code(visit):
+    return visit.auditor_codes[-1]
+
+
+def expected_balance(visits):
+    """The clinic balance a session over these visits should end with."""
+    return int(hbilling.INITIAL_CLINIC_BALANCE) + sum(hbilling.PAYMENT_CODES[final_code(visit)] for visit in visits)
+
+
+def main():
+    args = sys.argv[1:]
+    count = 10
+    if args:
+        count = int(args[0])
+    for visit in generate(count):
+        print(visit)
+
+
+if __name__ == '__main__':
+    main()